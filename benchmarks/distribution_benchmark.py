@@ -0,0 +1,334 @@
+"""Measure how long distribution takes to bring a fleet of proxy servers up.
+
+Local https servers stand in for the proxy servers.  Each accepts pushed keys
+at /key like a real one, after a set latency, and fails a set fraction of
+them.  They are registered as proxy servers in an App Engine testbed and
+health checked once, and the distribution cron handler is run as in
+production, followed by every task it queues, with failed tasks retried as
+the queue would.  This is done once to send every proxy server the whole key
+set, and once more to send the delta after a user is added.
+
+Users are added with User.InsertUsers, as adding them from the directory
+does, given key pairs from a pool filled with fake key pairs as long as real
+ones of the configured KEY_TYPE.
+
+Run from the repository root with openssl installed, and the App Engine SDK
+and the app's libraries in lib/ on the path:
+
+  python benchmarks/distribution_benchmark.py [--proxies 10,100,1000]
+      [--latency-ms 20] [--failure-rate 0.05] [--users 1000]
+"""
+
+import argparse
+import base64
+import BaseHTTPServer
+import hashlib
+import os
+import random
+import resource
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from config import KEY_TYPE
+from config import PATHS
+from datastore import PooledKeyPair
+from datastore import ProxyServer
+from datastore import User
+import key_distributor
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+import webtest
+
+
+DEFAULT_PROXIES = '10,100,1000'
+DEFAULT_LATENCY_MS = 20
+DEFAULT_FAILURE_RATE = 0.05
+DEFAULT_USERS = 1000
+# As many tasks run at once as the distribution queue allows in queue.yaml.
+MAX_CONCURRENT_TASKS = 100
+# How many times a failing task is run before it is given up on.
+MAX_TASK_ATTEMPTS = 10
+
+
+class _KeyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  """Accept pushed keys like a proxy server, slowly and sometimes failing."""
+
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+
+  def _AcceptKeys(self):
+    """Read the pushed keys and answer after the stand-in's latency."""
+    stand_in = self.server.stand_in
+    # The bytes on the wire are counted, compressed or not.
+    body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+    time.sleep(stand_in.latency_seconds)
+    failed = random.random() < stand_in.failure_rate
+    stand_in.RecordPush(len(body), failed)
+    self.send_response(503 if failed else 200)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  do_PUT = _AcceptKeys  # pylint: disable=invalid-name
+  do_PATCH = _AcceptKeys  # pylint: disable=invalid-name
+
+  def do_HEAD(self):  # pylint: disable=invalid-name
+    """Answer a health check probe, advertising gzip compressed pushes."""
+    self.server.stand_in.RecordProbe()
+    self.send_response(200)
+    self.send_header('Accept-Encoding', 'gzip')
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, *args):
+    """Keep the benchmark output quiet."""
+    pass
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+
+  """Serve each connection on its own thread."""
+
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    """Ignore clients closing their connection without a TLS shutdown."""
+    pass
+
+
+class _StandInProxyServer(object):
+
+  """A local https server standing in for a proxy server, counting traffic."""
+
+  def __init__(self, cert_path, key_path, latency_seconds, failure_rate):
+    self.latency_seconds = latency_seconds
+    self.failure_rate = failure_rate
+    self.pushes = 0
+    self.failed_pushes = 0
+    self.probes = 0
+    self.bytes_received = 0
+    self._lock = threading.Lock()
+    self.server = _ThreadedHTTPServer(('127.0.0.1', 0), _KeyHandler)
+    self.server.socket = ssl.wrap_socket(self.server.socket,
+                                         certfile=cert_path,
+                                         keyfile=key_path, server_side=True)
+    self.server.stand_in = self
+    self.address = '127.0.0.1:%d' % self.server.server_address[1]
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def RecordPush(self, body_length, failed):
+    """Count a push and the bytes of its body."""
+    with self._lock:
+      self.pushes += 1
+      self.failed_pushes += int(failed)
+      self.bytes_received += body_length
+
+  def RecordProbe(self):
+    """Count a health check or circuit breaker probe."""
+    with self._lock:
+      self.probes += 1
+
+  def TakeCounts(self):
+    """Get the counts so far as a dictionary and start counting again."""
+    with self._lock:
+      counts = {'pushes': self.pushes, 'failed_pushes': self.failed_pushes,
+                'probes': self.probes, 'bytes': self.bytes_received}
+      self.pushes = self.failed_pushes = self.probes = 0
+      self.bytes_received = 0
+    return counts
+
+  def Close(self):
+    """Stop serving."""
+    self.server.shutdown()
+    self.server.server_close()
+
+
+def _MakeCertificate(directory):
+  """Make a self-signed certificate and key, and return their paths."""
+  cert_path = os.path.join(directory, 'cert.pem')
+  key_path = os.path.join(directory, 'key.pem')
+  subprocess.check_call(
+      ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+       '-subj', '/CN=localhost', '-days', '1',
+       '-keyout', key_path, '-out', cert_path],
+      stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+  return cert_path, key_path
+
+
+def _RaiseOpenFileLimit():
+  """Allow as many open sockets as the system does, for large fleets."""
+  _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+  resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+
+def _MakeFakeKey(real_key):
+  """Make random base64 the same length as a real base64 key."""
+  return base64.urlsafe_b64encode(
+      os.urandom(len(base64.urlsafe_b64decode(str(real_key)))))
+
+
+def _FillKeyPairPool(count):
+  """Pool fake key pairs as long as real ones, without generating each one.
+  """
+  # pylint: disable=protected-access
+  real_key_pair = User._GenerateKeyPair()
+  ndb.put_multi([PooledKeyPair(
+      private_key=_MakeFakeKey(real_key_pair['private_key']),
+      public_key=_MakeFakeKey(real_key_pair['public_key']),
+      key_type=KEY_TYPE) for _ in range(count)])
+
+
+def _AddUsers(first_index, count):
+  """Add users from the pool, as adding them from the directory does."""
+  _FillKeyPairPool(count)
+  missing_ids = User.InsertUsers([
+      {'primaryEmail': 'user%d@example.com' % index,
+       'name': {'fullName': 'User %d' % index}}
+      for index in range(first_index, first_index + count)])
+  assert not missing_ids, 'the key pair pool ran short'
+
+
+def _RunTasks(testapp, tasks):
+  """Run queued tasks like the queue, retrying the failures.
+
+  Returns:
+    A tuple of the number of retries and the tasks still failing at the end.
+  """
+  retries = 0
+  for attempt in range(MAX_TASK_ATTEMPTS):
+    if not tasks:
+      break
+    if attempt:
+      retries += len(tasks)
+    statuses = key_distributor.RunConcurrently(
+        lambda task: testapp.post(task.url, task.payload,
+                                  expect_errors=True).status_int,
+        tasks, max_workers=MAX_CONCURRENT_TASKS)
+    tasks = [task for task, status in zip(tasks, statuses) if status != 200]
+  return retries, len(tasks)
+
+
+def _RunDistribution(testapp, taskqueue_stub, stand_ins):
+  """Run the distribution cron handler and all its tasks, and measure them."""
+  start_time = time.time()
+  testapp.get(PATHS['cron_proxy_server_distribute_key'])
+  tasks = taskqueue_stub.get_filtered_tasks(
+      queue_names=key_distributor.DISTRIBUTION_QUEUE)
+  taskqueue_stub.FlushQueue(key_distributor.DISTRIBUTION_QUEUE)
+  retries, given_up = _RunTasks(testapp, tasks)
+  wall_time = time.time() - start_time
+
+  totals = {'pushes': 0, 'failed_pushes': 0, 'probes': 0, 'bytes': 0}
+  for stand_in in stand_ins:
+    for name, count in stand_in.TakeCounts().items():
+      totals[name] += count
+  totals.update(wall_time=wall_time, retries=retries, given_up=given_up)
+  return totals
+
+
+def _Benchmark(proxy_count, args, cert_path, key_path, fingerprint):
+  """Distribute to a fresh fleet of stand-in proxy servers twice.
+
+  Returns:
+    A list of the measurements of the snapshot round and the delta round.
+  """
+  local_testbed = testbed.Testbed()
+  local_testbed.activate()
+  local_testbed.init_datastore_v3_stub()
+  local_testbed.init_memcache_stub()
+  local_testbed.init_taskqueue_stub(root_path=os.path.dirname(
+      os.path.dirname(os.path.abspath(__file__))))
+  local_testbed.init_user_stub()
+  # Cron requests are made as an admin.
+  local_testbed.setup_env(user_email='cron@example.com', user_id='0',
+                          user_is_admin='1', overwrite=True)
+  # Each request would get a fresh context in production, so nothing read by
+  # one cron run may be cached for the next.
+  ndb.get_context().set_cache_policy(False)
+  # The handlers' module reads the datastore when imported, so needs the
+  # testbed.
+  import proxy_server  # pylint: disable=g-import-not-at-top
+
+  stand_ins = [_StandInProxyServer(cert_path, key_path,
+                                   args.latency_ms / 1000.0,
+                                   args.failure_rate)
+               for _ in range(proxy_count)]
+  try:
+    ndb.put_multi([ProxyServer(name='stand-in %d' % index,
+                               ip_address=stand_in.address,
+                               fingerprint=fingerprint,
+                               auth_token='unused')
+                   for index, stand_in in enumerate(stand_ins)])
+    _AddUsers(0, args.users)
+    testapp = webtest.TestApp(proxy_server.APP)
+    # The health check learns which proxy servers accept gzip, and its
+    # probes are not counted against the distribution.
+    testapp.get(PATHS['cron_proxy_server_health_check'])
+    for stand_in in stand_ins:
+      stand_in.TakeCounts()
+
+    snapshot = _RunDistribution(testapp, local_testbed.get_stub(
+        testbed.TASKQUEUE_SERVICE_NAME), stand_ins)
+    _AddUsers(args.users, 1)
+    delta = _RunDistribution(testapp, local_testbed.get_stub(
+        testbed.TASKQUEUE_SERVICE_NAME), stand_ins)
+  finally:
+    for stand_in in stand_ins:
+      stand_in.Close()
+    key_distributor.CONNECTION_POOL.CloseAll()
+    key_distributor.PROBE_CONNECTION_POOL.CloseAll()
+    local_testbed.deactivate()
+  return [('snapshot', snapshot), ('delta', delta)]
+
+
+def main(argv):
+  """Run the benchmark for each fleet size and print a table of the results."""
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--proxies', default=DEFAULT_PROXIES,
+                      help='comma separated fleet sizes to measure')
+  parser.add_argument('--latency-ms', type=float, default=DEFAULT_LATENCY_MS,
+                      help='how long each stand-in takes to answer a push')
+  parser.add_argument('--failure-rate', type=float,
+                      default=DEFAULT_FAILURE_RATE,
+                      help='the fraction of pushes each stand-in fails')
+  parser.add_argument('--users', type=int, default=DEFAULT_USERS,
+                      help='how many users have keys')
+  args = parser.parse_args(argv[1:])
+  _RaiseOpenFileLimit()
+
+  directory = tempfile.mkdtemp()
+  try:
+    cert_path, key_path = _MakeCertificate(directory)
+    der_certificate = ssl.PEM_cert_to_DER_cert(open(cert_path).read())
+    fingerprint = hashlib.sha256(der_certificate).hexdigest()
+
+    print ('Users: %d, latency: %g ms, failure rate: %g' %
+           (args.users, args.latency_ms, args.failure_rate))
+    print '%7s  %-8s  %8s  %6s  %7s  %6s  %7s  %8s  %12s' % (
+        'Proxies', 'Round', 'Wall (s)', 'Pushes', 'Failed', 'Probes',
+        'Retries', 'Given up', 'Bytes sent')
+    for proxy_count in [int(count) for count in args.proxies.split(',')]:
+      for round_name, result in _Benchmark(proxy_count, args, cert_path,
+                                           key_path, fingerprint):
+        print '%7d  %-8s  %8.2f  %6d  %7d  %6d  %7d  %8d  %12d' % (
+            proxy_count, round_name, result['wall_time'], result['pushes'],
+            result['failed_pushes'], result['probes'], result['retries'],
+            result['given_up'], result['bytes'])
+  finally:
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
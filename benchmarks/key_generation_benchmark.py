@@ -0,0 +1,89 @@
+"""Measure how bulk key generation for new users scales with keygen instances.
+
+Adding users the key pair pool runs short for splits them into key generation
+tasks of user.KEY_PAIRS_PER_TASK, run in parallel on the keygen module, whose
+instances each take one task at a time.  Here each instance is emulated by a
+separate process taking tasks off a shared queue, the same number of key
+pairs is generated for each instance count, and the users per second is
+reported along with the speedup over the first instance count.
+
+Run from the repository root, with the App Engine SDK on the path as for the
+tests:
+
+  python benchmarks/key_generation_benchmark.py [--users 160]
+      [--instances 1,2,4,8]
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from Crypto import Random
+import datastore
+
+
+DEFAULT_USERS = 160
+DEFAULT_INSTANCES = '1,2,4,8'
+# The same as user.KEY_PAIRS_PER_TASK, which is not imported as the user
+# module needs the oauth client libraries.
+KEY_PAIRS_PER_TASK = 20
+
+
+def _RunKeyGenerationTask(count):
+  """Generate one key generation task's key pairs, as a keygen instance."""
+  # pylint: disable=protected-access
+  return [key_pair['public_key']
+          for key_pair in datastore.User._GenerateKeyPairs(count)]
+
+
+def _TimeKeyGeneration(users, instances):
+  """Time generating a key pair for each user across the instances."""
+  task_sizes = [min(KEY_PAIRS_PER_TASK, users - start)
+                for start in range(0, users, KEY_PAIRS_PER_TASK)]
+  # Each process must reseed the random number generator it forked with, or
+  # it would generate the same keys as its siblings.
+  pool = multiprocessing.Pool(instances, initializer=Random.atfork)
+  try:
+    start_time = time.time()
+    # One task at a time per process, like max_concurrent_requests: 1.
+    public_keys = sum(pool.map(_RunKeyGenerationTask, task_sizes,
+                               chunksize=1), [])
+    elapsed = time.time() - start_time
+  finally:
+    pool.close()
+    pool.join()
+  assert len(set(public_keys)) == users
+  return elapsed
+
+
+def main(argv):
+  """Run the benchmark for each instance count and print a table."""
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--users', type=int, default=DEFAULT_USERS,
+                      help='how many key pairs to generate per run')
+  parser.add_argument('--instances', default=DEFAULT_INSTANCES,
+                      help='comma separated keygen instance counts to '
+                           'measure')
+  args = parser.parse_args(argv[1:])
+
+  print 'Users: %d, key pairs per task: %d, cores: %d' % (
+      args.users, KEY_PAIRS_PER_TASK, multiprocessing.cpu_count())
+  print '%9s  %8s  %9s  %7s' % ('Instances', 'Wall (s)', 'Users/s',
+                                'Speedup')
+  serial_time = None
+  for instances in [int(count) for count in args.instances.split(',')]:
+    elapsed = _TimeKeyGeneration(args.users, instances)
+    if serial_time is None:
+      serial_time = elapsed
+    print '%9d  %8.2f  %9.2f  %6.2fx' % (instances, elapsed,
+                                         args.users / elapsed,
+                                         serial_time / elapsed)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,87 @@
+"""Compare the key types users can be given by generation time and size.
+
+For each key type that can be generated here, key pairs are generated one
+after another and timed.  The size of the authorized keys that many users
+would push to every proxy server is estimated from the generated keys, plain
+and gzip compressed as a snapshot is sent.  The invite code grows with the
+private key, which is measured too.
+
+Run from the repository root, with the App Engine SDK on the path as for the
+tests:
+
+  python benchmarks/key_type_benchmark.py [--keys 20] [--users 1000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import datastore
+import key_distributor
+
+
+DEFAULT_KEYS = 20
+DEFAULT_USERS = 1000
+
+
+def _MeasureKeyType(key_type, keys, users):
+  """Generate key pairs of a type and measure them.
+
+  Returns:
+    A dictionary of the milliseconds per key pair, the average private key
+    and key line bytes, and the estimated plain and gzip bytes of a snapshot
+    for the users.
+  """
+  start_time = time.time()
+  # pylint: disable=protected-access
+  key_pairs = [datastore.User._GenerateKeyPair(key_type)
+               for _ in range(keys)]
+  elapsed = time.time() - start_time
+
+  # Repeating keys would compress better than distinct users' keys do, so
+  # the snapshot is scaled up from one line per generated key.
+  key_string = ''.join(
+      datastore.User.MakeKeyLine(key_pair['public_key'],
+                                 'user%d@example.com' % index, key_type) + '\n'
+      for index, key_pair in enumerate(key_pairs))
+  return {
+      'ms_per_key': elapsed * 1000 / keys,
+      'private_bytes': sum(len(key_pair['private_key'])
+                           for key_pair in key_pairs) / keys,
+      'line_bytes': len(key_string) / keys,
+      'snapshot_bytes': len(key_string) * users / keys,
+      'gzip_bytes': (len(key_distributor.GzipCompress(key_string)) * users /
+                     keys),
+  }
+
+
+def main(argv):
+  """Run the benchmark for each key type and print a table of the results."""
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--keys', type=int, default=DEFAULT_KEYS,
+                      help='how many key pairs of each type to generate')
+  parser.add_argument('--users', type=int, default=DEFAULT_USERS,
+                      help='how many users the snapshot has keys for')
+  args = parser.parse_args(argv[1:])
+
+  print 'Key pairs per type: %d, users per snapshot: %d' % (args.keys,
+                                                            args.users)
+  print '%-10s  %9s  %13s  %10s  %14s  %10s' % (
+      'Key type', 'ms/key', 'Private bytes', 'Line bytes', 'Snapshot bytes',
+      'Gzip bytes')
+  for key_type in sorted(datastore.SSH_KEY_TYPES):
+    if not datastore.IsKeyTypeAvailable(key_type):
+      print '%-10s  skipped, its library is not installed' % key_type
+      continue
+    result = _MeasureKeyType(key_type, args.keys, args.users)
+    print '%-10s  %9.2f  %13d  %10d  %14d  %10d' % (
+        key_type, result['ms_per_key'], result['private_bytes'],
+        result['line_bytes'], result['snapshot_bytes'], result['gzip_bytes'])
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,150 @@
+"""Measure the TLS handshake cost saved by pooling pinned connections.
+
+A local https server with a freshly made self-signed certificate stands in
+for a proxy server.  Keys are pushed to it repeatedly, first opening a new
+pinned connection for every push as a push without pooling would, and then
+through a connection pool as key_distributor does.
+
+Run from the repository root, with openssl on the path:
+
+  python benchmarks/tls_handshake_benchmark.py [pushes]
+"""
+
+import BaseHTTPServer
+import functools
+import hashlib
+import os
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import connection_pool
+import pinned_connection
+
+
+DEFAULT_PUSHES = 200
+FAKE_BODY = 'ssh-rsa %s user@example.com\n' % ('A' * 372) * 100
+
+
+class _KeyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  """Accept pushed keys over a kept-alive connection."""
+
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+
+  def do_PUT(self):  # pylint: disable=invalid-name
+    """Read and drop the pushed keys."""
+    self.rfile.read(int(self.headers.getheader('content-length', 0)))
+    self.send_response(200)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, *args):
+    """Keep the benchmark output quiet."""
+    pass
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+
+  """Serve each connection on its own thread."""
+
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    """Ignore clients closing their connection without a TLS shutdown."""
+    pass
+
+
+def _MakeCertificate(directory):
+  """Make a self-signed certificate and key, and return their paths."""
+  cert_path = os.path.join(directory, 'cert.pem')
+  key_path = os.path.join(directory, 'key.pem')
+  subprocess.check_call(
+      ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+       '-subj', '/CN=localhost', '-days', '1',
+       '-keyout', key_path, '-out', cert_path],
+      stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+  return cert_path, key_path
+
+
+def _StartServer(cert_path, key_path):
+  """Start the stand-in proxy server and return it."""
+  server = _ThreadedHTTPServer(('127.0.0.1', 0), _KeyHandler)
+  server.socket = ssl.wrap_socket(server.socket, certfile=cert_path,
+                                  keyfile=key_path, server_side=True)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def _Push(http, address, fingerprint):
+  """Push the fake keys once over the given http object."""
+  response, _ = http.request(
+      'https://%s/key' % address, method='PUT', body=FAKE_BODY,
+      headers={'content-type': 'text/plain'},
+      connection_type=functools.partial(
+          pinned_connection.PinnedHTTPSConnection, fingerprint=fingerprint))
+  assert response.status == 200
+
+
+def _TimeUnpooled(address, fingerprint, pushes):
+  """Time pushes that each open a new pinned connection."""
+  pool = connection_pool.ConnectionPool(disable_ssl_certificate_validation=True)
+  start_time = time.time()
+  for _ in range(pushes):
+    http = pool.Checkout(address)
+    _Push(http, address, fingerprint)
+    pool.Discard(http)
+  return time.time() - start_time
+
+
+def _TimePooled(address, fingerprint, pushes):
+  """Time pushes that reuse one pinned connection from the pool."""
+  pool = connection_pool.ConnectionPool(disable_ssl_certificate_validation=True)
+  start_time = time.time()
+  for _ in range(pushes):
+    http = pool.Checkout(address)
+    _Push(http, address, fingerprint)
+    pool.Release(address, http)
+  elapsed = time.time() - start_time
+  pool.CloseAll()
+  return elapsed
+
+
+def main(argv):
+  """Run the benchmark and print the time per push with and without pooling."""
+  pushes = int(argv[1]) if len(argv) > 1 else DEFAULT_PUSHES
+  directory = tempfile.mkdtemp()
+  try:
+    cert_path, key_path = _MakeCertificate(directory)
+    der_certificate = ssl.PEM_cert_to_DER_cert(open(cert_path).read())
+    fingerprint = hashlib.sha256(der_certificate).hexdigest()
+    server = _StartServer(cert_path, key_path)
+    address = '127.0.0.1:%d' % server.server_address[1]
+
+    unpooled = _TimeUnpooled(address, fingerprint, pushes)
+    pooled = _TimePooled(address, fingerprint, pushes)
+    server.shutdown()
+  finally:
+    shutil.rmtree(directory)
+
+  print 'Pushes of %d bytes: %d' % (len(FAKE_BODY), pushes)
+  print 'New connection per push:    %.2f ms/push' % (unpooled * 1000 / pushes)
+  print 'Pooled pinned connection:   %.2f ms/push' % (pooled * 1000 / pushes)
+  print 'Handshake cost saved:       %.2f ms/push' % (
+      (unpooled - pooled) * 1000 / pushes)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
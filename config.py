@@ -9,6 +9,7 @@ PATHS = {
     'user_details_path': '/user/details',
     'user_get_invite_code_path': '/user/getInviteCode',
     'user_get_new_key_pair_path': '/user/getNewKeyPair',
+    'user_rotate_keys_path': '/user/rotateKeys',
     'user_toggle_revoked_path': '/user/toggleRevoked',
 
     'setup_oauth_path': '/setup',
@@ -16,9 +17,25 @@ PATHS = {
     'proxy_server_add': '/proxyserver/add',
     'proxy_server_delete': '/proxyserver/delete',
     'proxy_server_edit': '/proxyserver/edit',
+    'proxy_server_keys': '/proxyserver/keys',
+    'proxy_server_watch_keys': '/proxyserver/keys/watch',
+    'proxy_server_key_tree': '/proxyserver/keys/tree',
+    'proxy_server_key_buckets': '/proxyserver/keys/buckets',
     'proxy_server_list': '/proxyserver/list',
+    'proxy_server_register': '/proxyserver/fleet/register',
+    'proxy_server_heartbeat': '/proxyserver/fleet/heartbeat',
+    'proxy_server_deregister': '/proxyserver/fleet/deregister',
+    'proxy_server_convergence': '/proxyserver/convergence',
 
     'cron_proxy_server_distribute_key': '/cron/proxyserver/distributekey',
+    'task_proxy_server_distribute_key': '/cron/proxyserver/distributekey/task',
+    'cron_proxy_server_health_check': '/cron/proxyserver/healthcheck',
+    'cron_user_refill_key_pairs': '/cron/user/refillkeypairs',
+    'task_user_fill_key_pairs': '/cron/user/keygen/fill',
+    'task_user_generate_key_pairs': '/cron/user/keygen/users',
+    'task_user_rotate_keys': '/cron/user/rotatekeys/task',
+    'cron_user_build_key_buckets': '/cron/user/buildkeybuckets',
+    'task_user_build_key_buckets': '/cron/user/buildkeybuckets/task',
 
     'receive_push_notifications': '/receive',
     'sync_top_level_path': '/sync',
@@ -30,3 +47,12 @@ PATHS = {
     'logout': '/logout',
 }
 
+# The kind of key pair new users are given: rsa-2048, rsa-4096, ecdsa-p256 or
+# ed25519.  Users keep the kind of key they have until they get a new one.
+# The ecdsa and ed25519 kinds need the cryptography package.
+KEY_TYPE = 'rsa-2048'
+
+# True to add users without a key pair, and give each one a key pair the first
+# time an invite code is made for them, so users who never accept an invite
+# never cost a key.
+LAZY_KEY_GENERATION = False
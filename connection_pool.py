@@ -0,0 +1,124 @@
+"""The module for reusing http connections to the proxy servers."""
+
+import threading
+import time
+
+import httplib2
+
+
+# How long a connection may sit unused in the pool before it is closed.
+IDLE_TIMEOUT_SECONDS = 60
+
+
+def _CloseHttp(http):
+  """Close every connection an http object holds open.
+
+  Args:
+    http: An httplib2.Http object.
+  """
+  for connection in http.connections.values():
+    connection.close()
+  http.connections.clear()
+
+
+class ConnectionPool(object):
+
+  """Keep idle http objects per address so their connections are reused.
+
+  An httplib2.Http object keeps its connection to an address open between
+  requests, but may only be used by one thread at a time.  So each request
+  checks one out for its address and releases it afterwards for the next
+  request to the same address, skipping the connection setup.  Objects left
+  idle for too long are closed rather than kept open indefinitely.
+  """
+
+  def __init__(self, timeout=None, idle_timeout_seconds=IDLE_TIMEOUT_SECONDS,
+               disable_ssl_certificate_validation=False):
+    """Create an empty pool.
+
+    Args:
+      timeout: The socket timeout in seconds for new http objects.
+      idle_timeout_seconds: How long an http object may stay idle in the pool.
+      disable_ssl_certificate_validation: True if new http objects should not
+          validate certificates against the certificate authorities, for
+          connections that check them some other way.
+    """
+    self.timeout = timeout
+    self.disable_ssl_certificate_validation = (
+        disable_ssl_certificate_validation)
+    self.idle_timeout_seconds = idle_timeout_seconds
+    # A dictionary of address to a list of (http object, time released).
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def Checkout(self, address):
+    """Take an http object for the address, reusing an idle one if possible.
+
+    Args:
+      address: The host (and optional port) the http object will be used for.
+
+    Returns:
+      http: An httplib2.Http object to be given back with Release or Discard.
+    """
+    with self._lock:
+      self._EvictIdle()
+      idle = self._idle.get(address)
+      if idle:
+        http, _ = idle.pop()
+        return http
+    return httplib2.Http(timeout=self.timeout,
+                         disable_ssl_certificate_validation=(
+                             self.disable_ssl_certificate_validation))
+
+  def Release(self, address, http):
+    """Return an http object after a successful request for reuse.
+
+    Args:
+      address: The address the http object was checked out for.
+      http: The http object from Checkout.
+    """
+    with self._lock:
+      self._idle.setdefault(address, []).append((http, time.time()))
+
+  @staticmethod
+  def Discard(http):
+    """Close an http object whose connection may be broken.
+
+    Args:
+      http: The http object from Checkout.
+    """
+    _CloseHttp(http)
+
+  def GetIdleCount(self, address):
+    """Get how many idle http objects the pool holds for an address.
+
+    Args:
+      address: The address to count for.
+
+    Returns:
+      An integer of the idle http objects.
+    """
+    with self._lock:
+      return len(self._idle.get(address, []))
+
+  def CloseAll(self):
+    """Close and forget every idle http object."""
+    with self._lock:
+      for idle in self._idle.values():
+        for http, _ in idle:
+          _CloseHttp(http)
+      self._idle.clear()
+
+  def _EvictIdle(self):
+    """Close the http objects idle for too long.  The lock must be held."""
+    oldest_allowed = time.time() - self.idle_timeout_seconds
+    for address, idle in self._idle.items():
+      for http, released_time in idle:
+        if released_time < oldest_allowed:
+          _CloseHttp(http)
+      fresh = [(http, released_time) for http, released_time in idle
+               if released_time >= oldest_allowed]
+      if fresh:
+        self._idle[address] = fresh
+      else:
+        del self._idle[address]
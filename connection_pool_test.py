@@ -0,0 +1,88 @@
+"""Test connection pool module functionality."""
+import unittest
+
+from mock import MagicMock
+from mock import patch
+
+import connection_pool
+
+
+FAKE_ADDRESS = '111.222.333.444'
+OTHER_ADDRESS = '555.666.777.888'
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  """Test connection pool functionality."""
+
+  def setUp(self):
+    """Create an empty pool for each test."""
+    self.pool = connection_pool.ConnectionPool(timeout=5,
+                                               idle_timeout_seconds=60)
+
+  def testCheckoutCreatesHttp(self):
+    """Test a new http object with the timeout is made for a new address."""
+    http = self.pool.Checkout(FAKE_ADDRESS)
+
+    self.assertEqual(http.timeout, 5)
+    self.assertEqual(self.pool.GetIdleCount(FAKE_ADDRESS), 0)
+
+  def testReleasedHttpIsReused(self):
+    """Test a released http object is handed out again for its address."""
+    http = self.pool.Checkout(FAKE_ADDRESS)
+    self.pool.Release(FAKE_ADDRESS, http)
+
+    self.assertEqual(self.pool.GetIdleCount(FAKE_ADDRESS), 1)
+    self.assertTrue(self.pool.Checkout(FAKE_ADDRESS) is http)
+    self.assertFalse(self.pool.Checkout(OTHER_ADDRESS) is http)
+    self.assertEqual(self.pool.GetIdleCount(FAKE_ADDRESS), 0)
+
+  def testCheckedOutHttpIsNotShared(self):
+    """Test two checkouts for the same address get different objects."""
+    first = self.pool.Checkout(FAKE_ADDRESS)
+    second = self.pool.Checkout(FAKE_ADDRESS)
+
+    self.assertFalse(first is second)
+
+  @patch('time.time')
+  def testIdleHttpIsEvicted(self, mock_time):
+    """Test an http object idle past the timeout is closed, not reused."""
+    mock_connection = MagicMock()
+    http = self.pool.Checkout(FAKE_ADDRESS)
+    http.connections['http:' + FAKE_ADDRESS] = mock_connection
+    mock_time.return_value = 1000.0
+    self.pool.Release(FAKE_ADDRESS, http)
+
+    mock_time.return_value = 1061.0
+    reused = self.pool.Checkout(FAKE_ADDRESS)
+
+    self.assertFalse(reused is http)
+    mock_connection.close.assert_called_once_with()
+    self.assertEqual(http.connections, {})
+    self.assertEqual(self.pool.GetIdleCount(FAKE_ADDRESS), 0)
+
+  def testDiscardClosesConnections(self):
+    """Test a discarded http object has its connections closed."""
+    mock_connection = MagicMock()
+    http = self.pool.Checkout(FAKE_ADDRESS)
+    http.connections['http:' + FAKE_ADDRESS] = mock_connection
+
+    self.pool.Discard(http)
+
+    mock_connection.close.assert_called_once_with()
+    self.assertEqual(self.pool.GetIdleCount(FAKE_ADDRESS), 0)
+
+  def testCloseAll(self):
+    """Test closing the pool closes and forgets every idle object."""
+    mock_connection = MagicMock()
+    http = self.pool.Checkout(FAKE_ADDRESS)
+    http.connections['http:' + FAKE_ADDRESS] = mock_connection
+    self.pool.Release(FAKE_ADDRESS, http)
+
+    self.pool.CloseAll()
+
+    mock_connection.close.assert_called_once_with()
+    self.assertEqual(self.pool.GetIdleCount(FAKE_ADDRESS), 0)
+
+if __name__ == '__main__':
+  unittest.main()
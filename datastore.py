@@ -4,13 +4,60 @@ TODO(henry): Refactor the common methods (get, insert, delete) into base class.
 """
 
 import base64
+import binascii
+from config import KEY_TYPE
+from config import LAZY_KEY_GENERATION
+import datetime
 import hashlib
+import hmac
+import os
 
 from Crypto.PublicKey import RSA
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
+try:
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  from cryptography.hazmat.primitives.asymmetric import ec
+  from cryptography.hazmat.primitives.asymmetric import ed25519
+except ImportError:
+  # Only rsa keys can be generated without the cryptography package.
+  serialization = None
+
+
+# The open ssh key type that starts the authorized keys line for each kind of
+# key pair a user can be given.
+SSH_KEY_TYPES = {
+    'rsa-2048': 'ssh-rsa',
+    'rsa-4096': 'ssh-rsa',
+    'ecdsa-p256': 'ecdsa-sha2-nistp256',
+    'ed25519': 'ssh-ed25519',
+}
+# The kind of key pair users saved before there was a choice were given.
+DEFAULT_KEY_TYPE = 'rsa-2048'
+RSA_KEY_BITS = {
+    'rsa-2048': 2048,
+    'rsa-4096': 4096,
+}
+
+
+def IsKeyTypeAvailable(key_type):
+  """Check whether key pairs of a kind can be generated here.
+
+  Args:
+    key_type: The kind of key pair, such as 'ed25519'.
+
+  Returns:
+    True if the key type is known and its library is installed.
+  """
+  if key_type not in SSH_KEY_TYPES:
+    return False
+  return key_type in RSA_KEY_BITS or serialization is not None
+
 
 class BaseModel(ndb.Model):
 
@@ -106,9 +153,149 @@ class User(BaseModel):
 
   email = ndb.StringProperty()
   name = ndb.StringProperty()
+  # Both None for users added without a key pair, until their first invite.
   private_key = ndb.TextProperty()
   public_key = ndb.TextProperty()
   is_key_revoked = ndb.BooleanProperty()
+  # None for users given a key before there was a choice of DEFAULT_KEY_TYPE.
+  key_type = ndb.StringProperty(choices=SSH_KEY_TYPES.keys())
+  # When the user was given their key pair, or None if that was before this
+  # was recorded or they have no key pair yet.
+  key_created = ndb.DateTimeProperty()
+
+  # The most users written in one transaction with the key change they make.
+  # Each user and their bucket are an entity group each, as are the key set
+  # version, change and convergence, and a cross group transaction may span
+  # at most 25.
+  MAX_USERS_PER_TRANSACTION = 10
+
+  @classmethod
+  def Delete(cls, entity_id):
+    """Delete a user from the datastore and revoke their key.
+
+    Args:
+      cls is an object that holds the sub-class itself, not an instance
+      of the sub-class.
+      entity_id: A string of the user's id.
+    """
+    User._DeleteKey(ndb.Key(User, entity_id))
+
+  @classmethod
+  def DeleteByKey(cls, url_key):
+    """Delete a user from the datastore and revoke their key.
+
+    Args:
+      cls is an object that holds the sub-class itself, not an instance
+      of the sub-class.
+      url_key: The url encoded key for a user in the datastore.
+    """
+    User._DeleteKey(ndb.Key(urlsafe=url_key))
+
+  @staticmethod
+  def _DeleteKey(key):
+    """Delete a user, removing their key line and recording the revocation.
+
+    Args:
+      key: The datastore key of the user.
+    """
+    def _Delete(user_key, user):
+      """Delete the user."""
+      # pylint: disable=unused-argument
+      user_key.delete()
+      return None
+
+    User._CommitUsers([key], _Delete)
+
+  @staticmethod
+  def _CommitUsers(user_keys, change_user):
+    """Change users and record the change to their keys atomically.
+
+    The users are changed in batches, each in one cross group transaction
+    that reads them as committed, sets their lines in their buckets and
+    records the change to their key lines under the next key set version.
+    So a key is never granted or revoked without the buckets and proxy
+    servers being told, and a batch that fails changes nothing and can
+    simply be tried again.
+
+    Args:
+      user_keys: A list of the datastore keys of the users.
+      change_user: A function given a user's key and the user as committed,
+                   or None if there is no such user.  It puts or deletes the
+                   user, and returns the user as changed, or None if it no
+                   longer exists.  It is called again if the transaction is
+                   retried.
+
+    Returns:
+      A list of the users as changed, in the same order as user_keys.
+    """
+    def _CommitBatch(batch):
+      """Change a batch of users and record their key change."""
+      # Read the buckets and key set version with the users, before any
+      # writes, so a request that changes them meanwhile fails this commit,
+      # which is retried.
+      bucket_keys = sorted(set(
+          ndb.Key(KeyBucket, KeyBucket.GetBucketId(user_key.id()))
+          for user_key in batch))
+      version_key = ndb.Key(KeySetVersion, KeySetVersion.VERSION_ID)
+      entities = ndb.get_multi(batch + bucket_keys + [version_key])
+      users = entities[:len(batch)]
+      buckets = entities[len(batch):-1]
+      old_key_lines = set(User._GetKeyLines(users))
+      changed_users = [change_user(user_key, user)
+                       for user_key, user in zip(batch, users)]
+      key_lines = set(User._GetKeyLines(changed_users))
+      # pylint: disable=protected-access
+      for bucket_key, bucket in zip(bucket_keys, buckets):
+        KeyBucket._PutUsers(
+            bucket or KeyBucket(key=bucket_key),
+            [(user_key.id(), user)
+             for user_key, user in zip(batch, changed_users)
+             if KeyBucket.GetBucketId(user_key.id()) == bucket_key.id()])
+      version = KeyChange._RecordInTransaction(
+          sorted(key_lines - old_key_lines),
+          sorted(old_key_lines - key_lines))
+      return changed_users, version
+
+    changed_users = []
+    for start in range(0, len(user_keys), User.MAX_USERS_PER_TRANSACTION):
+      batch = user_keys[start:start + User.MAX_USERS_PER_TRANSACTION]
+      batch_users, version = ndb.transaction(lambda: _CommitBatch(batch),
+                                             xg=True)
+      if version is not None:
+        KeySetVersion.CacheLatest(version)
+      changed_users.extend(batch_users)
+    return changed_users
+
+  @staticmethod
+  def MakeKeyLine(public_key, email, key_type=None):
+    """Make the open ssh authorized keys line that grants a user access.
+
+    Args:
+      public_key: The user's public key in b64 value.
+      email: The user's email.
+      key_type: The kind of the user's key pair, or None for
+                DEFAULT_KEY_TYPE.
+
+    Returns:
+      A string of the key type, public key and email without a newline.
+    """
+    return '%s %s %s' % (SSH_KEY_TYPES[key_type or DEFAULT_KEY_TYPE],
+                         public_key, email)
+
+  @staticmethod
+  def _GetKeyLines(users):
+    """Get the authorized keys lines for the users whose keys are active.
+
+    Args:
+      users: A list of user entities.  Missing users may be passed as None.
+
+    Returns:
+      A list of authorized keys lines, one per user with an active key.
+    """
+    return [User.MakeKeyLine(user.public_key, user.email, user.key_type)
+            for user in users
+            if user is not None and user.public_key is not None and
+            not user.is_key_revoked]
 
   @staticmethod
   def _CreateUser(directory_user, key_pair):
@@ -116,7 +303,8 @@ class User(BaseModel):
 
     Args:
       directory_user: A dictionary of the dasher user.
-      key_pair: A dictionary with private_key and public_key in b64 value.
+      key_pair: A dictionary with private_key and public_key in b64 value,
+                and optionally the key_type.
 
     Returns:
       user_entity: An appengine datastore entity of the user.
@@ -126,29 +314,105 @@ class User(BaseModel):
     user_entity = User(key=user_key,
                        email=directory_user['primaryEmail'],
                        name=directory_user['name']['fullName'],
-                       public_key=key_pair['public_key'],
-                       private_key=key_pair['private_key'],
                        is_key_revoked=False)
+    if key_pair['public_key'] is not None:
+      User._AssignKeyPair(user_entity, key_pair)
     return user_entity
 
   @staticmethod
-  def _GenerateKeyPair():
+  def _AssignKeyPair(user, key_pair):
+    """Give a user entity a new key pair, without saving it.
+
+    Args:
+      user: The user entity.
+      key_pair: A dictionary with private_key and public_key in b64 value,
+                and optionally the key_type.
+    """
+    user.public_key = key_pair['public_key']
+    user.private_key = key_pair['private_key']
+    user.key_type = key_pair.get('key_type')
+    user.key_created = datetime.datetime.utcnow()
+
+  @staticmethod
+  def _GenerateKeyPair(key_type=None):
     """Generate a private and public key pair in base64.
 
+    Both keys are PEM encoded before base64, except ed25519 private keys,
+    which are in the open ssh format that ssh clients read them in.
+
+    Args:
+      key_type: The kind of key pair to generate, or None for KEY_TYPE.
+
     Returns:
-      key_pair: A dictionary with private_key and public_key in b64 value.
+      key_pair: A dictionary with private_key and public_key in b64 value,
+                and the key_type.
+
+    Raises:
+      ValueError: The key type is unknown or its library is not installed.
     """
-    rsa_key = RSA.generate(2048)
-    private_key = base64.urlsafe_b64encode(rsa_key.exportKey())
-    public_key = base64.urlsafe_b64encode(rsa_key.publickey().exportKey())
+    key_type = key_type or KEY_TYPE
+    if not IsKeyTypeAvailable(key_type):
+      raise ValueError('Cannot generate %s key pairs here.' % key_type)
+    if key_type in RSA_KEY_BITS:
+      rsa_key = RSA.generate(RSA_KEY_BITS[key_type])
+      private_pem = rsa_key.exportKey()
+      public_pem = rsa_key.publickey().exportKey()
+    else:
+      if key_type == 'ed25519':
+        key = ed25519.Ed25519PrivateKey.generate()
+        private_format = serialization.PrivateFormat.OpenSSH
+      else:
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        private_format = serialization.PrivateFormat.TraditionalOpenSSL
+      private_pem = key.private_bytes(serialization.Encoding.PEM,
+                                      private_format,
+                                      serialization.NoEncryption())
+      public_pem = key.public_key().public_bytes(
+          serialization.Encoding.PEM,
+          serialization.PublicFormat.SubjectPublicKeyInfo)
+    private_key = base64.urlsafe_b64encode(private_pem)
+    public_key = base64.urlsafe_b64encode(public_pem)
 
     key_pair = {
         'private_key': private_key,
-        'public_key': public_key
+        'public_key': public_key,
+        'key_type': key_type,
     }
 
     return key_pair
 
+  @staticmethod
+  def _GetKeyPairs(count):
+    """Get new key pairs from the pool, generating any it is short of.
+
+    Args:
+      count: How many key pairs are needed.
+
+    Returns:
+      A list of count dictionaries with private_key and public_key in b64
+      value.
+    """
+    key_pairs = PooledKeyPair.Take(count)
+    return key_pairs + User._GenerateKeyPairs(count - len(key_pairs))
+
+  @staticmethod
+  def _GenerateKeyPairs(count, key_type=None):
+    """Generate key pairs one after another.
+
+    Bulk generation is spread over tasks on the key generation module
+    instead, as a request can only use the one core it runs on.
+
+    Args:
+      count: How many key pairs to generate.
+      key_type: The kind of key pairs to generate, or None for KEY_TYPE.
+
+    Returns:
+      A list of count dictionaries with private_key and public_key in b64
+      value.
+    """
+    key_type = key_type or KEY_TYPE
+    return [User._GenerateKeyPair(key_type) for _ in range(count)]
+
   @staticmethod
   def UpdateKeyPair(key):
     """Update an existing appengine datastore user entity with a new key pair.
@@ -156,22 +420,121 @@ class User(BaseModel):
     Args:
       key: A user's key in order to find the user's datastore entity.
     """
-    user = User.GetByKey(key)
-    key_pair = User._GenerateKeyPair()
-    user.public_key = key_pair['public_key']
-    user.private_key = key_pair['private_key']
-    user.put()
+    key_pair = User._GetKeyPairs(1)[0]
+
+    def _SetKeyPair(user_key, user):
+      """Give the user as committed the new key pair."""
+      # pylint: disable=unused-argument
+      if user is not None:
+        User._AssignKeyPair(user, key_pair)
+        user.put()
+      return user
+
+    User._CommitUsers([ndb.Key(urlsafe=key)], _SetKeyPair)
+
+  @staticmethod
+  def _SetMissingKeyPairs(user_keys):
+    """Save a key pair on each user unless they already have one.
+
+    Args:
+      user_keys: A list of the datastore keys of the users.
+
+    Returns:
+      A list of the keys of the users given a key pair, leaving out those
+      deleted or given a key pair by another request first.
+    """
+    key_pairs = dict(zip(user_keys, User._GetKeyPairs(len(user_keys))))
+    # Whether each user was given a key pair in the attempt that committed.
+    is_given = {}
+
+    def _SetKeyPair(user_key, user):
+      """Save the key pair on the user unless another request did first."""
+      is_given[user_key] = user is not None and user.public_key is None
+      if is_given[user_key]:
+        User._AssignKeyPair(user, key_pairs[user_key])
+        user.put()
+      return user
+
+    User._CommitUsers(user_keys, _SetKeyPair)
+    return [user_key for user_key in user_keys if is_given[user_key]]
+
+  @staticmethod
+  def AddMissingKeyPair(key):
+    """Give a user added without a key pair one, exactly once.
+
+    The key pair is only saved if the user still has none when it is
+    written, so requests racing to give the same user a key pair agree on
+    one of them.  Only the request whose transaction committed records the
+    key change and sets the user's bucket line, both from the user as it
+    committed, so snapshots and deltas agree on the winning key.
+
+    Args:
+      key: A user's key in order to find the user's datastore entity.
+
+    Returns:
+      True if this call gave the user a key pair, or False if they already
+      had one.
+    """
+    if User.GetByKey(key).public_key is not None:
+      return False
+    return bool(User._SetMissingKeyPairs([ndb.Key(urlsafe=key)]))
+
+  @staticmethod
+  def AddMissingKeyPairs(user_ids):
+    """Give each of the users still without a key pair one.
+
+    This is the work of one key generation task.  As with AddMissingKeyPair,
+    only the key pairs that were saved are recorded.
+
+    Args:
+      user_ids: A list of the ids of users added without a key pair.
+
+    Returns:
+      The number of users given a key pair.
+    """
+    users = ndb.get_multi([ndb.Key(User, user_id) for user_id in user_ids])
+    return len(User._SetMissingKeyPairs(
+        [user.key for user in users
+         if user is not None and user.public_key is None]))
 
   @staticmethod
   def ToggleKeyRevoked(entity_key):
     """Change the value of key revoked for an existing user to !revoked.
 
+    A user without a key pair has no key to grant or revoke until they are
+    given one, so only the flag changes.
+
     Args:
       entity_key: A user's key in order to find the user's datastore entity.
     """
-    user = User.GetByKey(entity_key)
-    user.is_key_revoked = not user.is_key_revoked
-    user.put()
+    def _Toggle(user_key, user):
+      """Flip the revoked flag of the user as committed."""
+      # pylint: disable=unused-argument
+      if user is not None:
+        user.is_key_revoked = not user.is_key_revoked
+        user.put()
+      return user
+
+    User._CommitUsers([ndb.Key(urlsafe=entity_key)], _Toggle)
+
+  @staticmethod
+  def _ReplaceUsers(users):
+    """Save new user entities over any users with the same keys.
+
+    Users added again get a new key, so their old one is revoked.
+
+    Args:
+      users: A list of user entities.
+    """
+    users_by_key = dict((user.key, user) for user in users)
+
+    def _Replace(user_key, user):
+      """Put the new entity in place of the user as committed."""
+      # pylint: disable=unused-argument
+      users_by_key[user_key].put()
+      return users_by_key[user_key]
+
+    User._CommitUsers(sorted(users_by_key), _Replace)
 
   @staticmethod
   def InsertUser(directory_user, key_pair):
@@ -181,34 +544,237 @@ class User(BaseModel):
       directory_user: A dictionary of the dasher user.
       key_pair: A dictionary with private_key and public_key in b64 value.
     """
-    user = User._CreateUser(directory_user, key_pair)
-    user.put()
+    User._ReplaceUsers([User._CreateUser(directory_user, key_pair)])
 
   @staticmethod
   def InsertUsers(directory_users):
     """Insert users into datastore.
 
+    The users are given key pairs from the pool.  Those it runs short for
+    are added without one, and their ids returned for tasks on the key
+    generation module to give them key pairs in parallel.
+
+    With LAZY_KEY_GENERATION, the users are all added without key pairs, and
+    AddMissingKeyPair gives each one a key pair when it is first needed.
+
     Args:
       directory_users: A list of dasher users.
+
+    Returns:
+      A list of the ids of the users still waiting for a key pair to be
+      generated, which is empty with LAZY_KEY_GENERATION.
+    """
+    missing_key_pair = {'private_key': None, 'public_key': None}
+    if LAZY_KEY_GENERATION:
+      key_pairs = []
+    else:
+      key_pairs = PooledKeyPair.Take(len(directory_users))
+    key_pairs += [missing_key_pair] * (len(directory_users) - len(key_pairs))
+    user_entities = [User._CreateUser(directory_user, key_pair)
+                     for directory_user, key_pair
+                     in zip(directory_users, key_pairs)]
+    User._ReplaceUsers(user_entities)
+    if LAZY_KEY_GENERATION:
+      return []
+    return [user.key.id() for user in user_entities
+            if user.public_key is None]
+
+
+class PooledKeyPair(BaseModel):
+
+  """A key pair generated ahead of time, waiting to be given to a user.
+
+  Generating a key pair takes a prime search, so users are given key pairs
+  from this pool when they are added or get a new key, and the pool is
+  refilled in the background.  Each key pair is deleted as it is taken, so
+  it is only ever given to one user.  Only key pairs of the configured
+  KEY_TYPE are given out.
+  """
+
+  private_key = ndb.TextProperty()
+  public_key = ndb.TextProperty()
+  key_type = ndb.StringProperty(choices=SSH_KEY_TYPES.keys())
+
+  # The pool is refilled once it has fewer key pairs than this.
+  LOW_WATERMARK = 50
+  # How many key pairs a refill brings the pool up to.
+  TARGET_SIZE = 200
+  # The most entity groups a cross group transaction may take key pairs from.
+  MAX_TAKEN_PER_TRANSACTION = 25
+
+  @staticmethod
+  def _QueryKeyType():
+    """Query the pooled key pairs of the configured key type."""
+    return PooledKeyPair.query(PooledKeyPair.key_type == KEY_TYPE)
+
+  @staticmethod
+  def Take(count):
+    """Take key pairs out of the pool.
+
+    Key pairs another request takes first are skipped, so fewer than count
+    may be returned even when the pool is not empty.
+
+    Args:
+      count: The most key pairs to take.
+
+    Returns:
+      A list of up to count dictionaries with private_key and public_key in
+      b64 value, and the key_type.
+    """
+    if count <= 0:
+      return []
+    keys = PooledKeyPair._QueryKeyType().fetch(count, keys_only=True)
+
+    def _TakeBatch(batch):
+      """Delete the key pairs in a batch that are still there."""
+      entities = [entity for entity in ndb.get_multi(batch)
+                  if entity is not None]
+      ndb.delete_multi([entity.key for entity in entities])
+      return entities
+
+    key_pairs = []
+    for start in range(0, len(keys), PooledKeyPair.MAX_TAKEN_PER_TRANSACTION):
+      batch = keys[start:start + PooledKeyPair.MAX_TAKEN_PER_TRANSACTION]
+      try:
+        entities = ndb.transaction(lambda: _TakeBatch(batch), xg=True)
+      except datastore_errors.TransactionFailedError:
+        # Other requests kept taking the same key pairs.
+        continue
+      key_pairs.extend({'private_key': entity.private_key,
+                        'public_key': entity.public_key,
+                        'key_type': entity.key_type}
+                       for entity in entities)
+    return key_pairs
+
+  @staticmethod
+  def IsLow():
+    """Check whether the pool has run low enough to be refilled.
+
+    Returns:
+      True if the pool has fewer than LOW_WATERMARK key pairs.
+    """
+    return (PooledKeyPair._QueryKeyType().count(
+        limit=PooledKeyPair.LOW_WATERMARK) < PooledKeyPair.LOW_WATERMARK)
+
+  @staticmethod
+  def GetShortfall():
+    """Count how many key pairs the pool is short of its target size.
+
+    Key pairs left in the pool from before the key type was changed are
+    deleted, as they will never be given out.
+
+    Returns:
+      The number of key pairs a refill should generate.
+    """
+    ndb.delete_multi(PooledKeyPair.query(
+        PooledKeyPair.key_type != KEY_TYPE).fetch(keys_only=True))
+    size = PooledKeyPair._QueryKeyType().count(
+        limit=PooledKeyPair.TARGET_SIZE)
+    return PooledKeyPair.TARGET_SIZE - size
+
+  @staticmethod
+  def Fill(max_count):
+    """Generate key pairs into the pool until it reaches its target size.
+
+    A refill is split across key generation tasks that each call this, so
+    tasks running at once each add at most max_count.
+
+    Args:
+      max_count: The most key pairs to generate, so a task fits within the
+                 request deadline.
+
+    Returns:
+      The number of key pairs added to the pool.
     """
-    user_entities = []
-    for directory_user in directory_users:
-      key_pair = User._GenerateKeyPair()
-      user_entities.append(User._CreateUser(directory_user, key_pair))
-    ndb.put_multi(user_entities)
+    count = min(max_count, PooledKeyPair.GetShortfall())
+    if count <= 0:
+      return 0
+    # pylint: disable=protected-access
+    key_pairs = User._GenerateKeyPairs(count)
+    ndb.put_multi([PooledKeyPair(private_key=key_pair['private_key'],
+                                 public_key=key_pair['public_key'],
+                                 key_type=key_pair['key_type'])
+                   for key_pair in key_pairs])
+    return count
 
 
 class ProxyServer(BaseModel):
 
   """Store data related to the proxy servers."""
 
+  # How keys are delivered: pushed over https, or written as an
+  # authorized_keys file over ssh with the stored ssh private key.
+  HTTPS_DELIVERY = 'https'
+  SSH_DELIVERY = 'ssh'
+  # The states of the circuit breaker around pushes to the proxy server.
+  # Closed pushes as normal.  Open only probes, until a probe succeeds and
+  # the circuit is half open for a single trial push.
+  CIRCUIT_CLOSED = 'closed'
+  CIRCUIT_OPEN = 'open'
+  CIRCUIT_HALF_OPEN = 'half-open'
+  # How long a proxy server that registered itself is alive for after its
+  # last heartbeat, and how much longer it is kept before being deleted.
+  HEARTBEAT_TIMEOUT_SECONDS = 90
+  EXPIRED_RETENTION_SECONDS = 24 * 60 * 60
+
   ip_address = ndb.StringProperty()
   name = ndb.StringProperty()
   ssh_private_key = ndb.TextProperty()
   fingerprint = ndb.StringProperty()
+  # The secret the proxy server presents when pulling its keys.
+  auth_token = ndb.StringProperty()
+  delivery_method = ndb.StringProperty(
+      choices=[HTTPS_DELIVERY, SSH_DELIVERY], default=HTTPS_DELIVERY)
+  # The id of the relay proxy server this one is sent its keys through, or
+  # None if the keys are pushed to it directly.
+  relay_id = ndb.IntegerProperty()
+  # Whether this proxy server advertised gzip compressed pushes in the
+  # Accept-Encoding of its last probe, or None if it has not answered one.
+  # Only True gets a compressed push.
+  accepts_gzip = ndb.BooleanProperty()
+  # The key set version this proxy server last accepted.
+  key_set_version = ndb.IntegerProperty()
+  # The key set version whose revocations this proxy server has applied,
+  # which runs ahead of key_set_version while additions are still pending.
+  revoked_key_set_version = ndb.IntegerProperty()
+  # When this proxy server last accepted keys and how long that push took.
+  last_distribution_success = ndb.DateTimeProperty()
+  last_distribution_latency = ndb.FloatProperty()
+  # How many pushes in a row have failed since the last success.
+  consecutive_distribution_failures = ndb.IntegerProperty(default=0)
+  # The circuit breaker's state, and when the circuit last opened.
+  circuit_state = ndb.StringProperty(
+      choices=[CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN],
+      default=CIRCUIT_CLOSED)
+  circuit_opened = ndb.DateTimeProperty()
+  # Rolling averages from the periodic health checks of the round trip time
+  # in seconds of the successful probes, and of the fraction that failed.
+  health_rtt = ndb.FloatProperty()
+  health_error_rate = ndb.FloatProperty()
+  last_health_check = ndb.DateTimeProperty()
+  # When this proxy server last sent a heartbeat, or None if it was added by
+  # hand rather than registering itself, in which case it is always alive.
+  last_heartbeat = ndb.DateTimeProperty()
+
+  def IsAlive(self, now=None):
+    """Check whether this proxy server should be sent keys and users.
+
+    Args:
+      now: The current utc datetime, or None to read the clock.
+
+    Returns:
+      False if this proxy server registered itself and its heartbeat has
+      expired, otherwise True.
+    """
+    if self.last_heartbeat is None:
+      return True
+    now = now or datetime.datetime.utcnow()
+    timeout = datetime.timedelta(seconds=ProxyServer.HEARTBEAT_TIMEOUT_SECONDS)
+    return now - self.last_heartbeat <= timeout
 
   @staticmethod
-  def Insert(name, ip_address, ssh_private_key, fingerprint):
+  def Insert(name, ip_address, ssh_private_key, fingerprint,
+             delivery_method=HTTPS_DELIVERY, relay_id=None):
     """Insert a new ProxyServer entity in the datastore with the given values.
 
     Args:
@@ -216,15 +782,23 @@ class ProxyServer(BaseModel):
       ip_address: What to set the proxy server's ip_address field to.
       ssh_private_key: What to set the proxy server's ssh_private_key field to.
       fingerprint: What to set the proxy server's fingerprint field to.
+      delivery_method: What to set the proxy server's delivery_method to.
+      relay_id: What to set the proxy server's relay_id to.
     """
-    entity = ProxyServer(name=name,
+    entity_id = ProxyServer.allocate_ids(1)[0]
+    entity = ProxyServer(id=entity_id,
+                         name=name,
                          ip_address=ip_address,
                          ssh_private_key=ssh_private_key,
-                         fingerprint=fingerprint)
+                         fingerprint=fingerprint,
+                         delivery_method=delivery_method,
+                         relay_id=relay_id,
+                         auth_token=ProxyServer._MakeAuthToken(entity_id))
     entity.put()
 
   @staticmethod
-  def Update(entity_id, name, ip_address, ssh_private_key, fingerprint):
+  def Update(entity_id, name, ip_address, ssh_private_key, fingerprint,
+             delivery_method=HTTPS_DELIVERY, relay_id=None):
     """Update a ProxyServer with the given id in the datastore with new values.
 
     Args:
@@ -234,13 +808,870 @@ class ProxyServer(BaseModel):
       ip_address: What to set the proxy server's ip_address field to.
       ssh_private_key: What to set the proxy server's ssh_private_key field to.
       fingerprint: What to set the proxy server's fingerprint field to.
+      delivery_method: What to set the proxy server's delivery_method to.
+      relay_id: What to set the proxy server's relay_id to.
     """
     entity = ProxyServer.Get(entity_id)
     entity.name = name
     entity.ip_address = ip_address
     entity.ssh_private_key = ssh_private_key
     entity.fingerprint = fingerprint
+    entity.delivery_method = delivery_method
+    entity.relay_id = relay_id
+    if not entity.auth_token:
+      entity.auth_token = ProxyServer._MakeAuthToken(entity_id)
+    entity.put()
+
+  @staticmethod
+  def GetPeers(relay_id):
+    """Get the proxy servers sent their keys through a relay.
+
+    Args:
+      relay_id: The relay proxy server's datastore id.
+
+    Returns:
+      A list of proxy server entities.
+    """
+    return [peer for peer
+            in ProxyServer.query(ProxyServer.relay_id == relay_id).fetch()
+            if peer.IsAlive()]
+
+  @staticmethod
+  def GetAlive():
+    """Get every proxy server whose heartbeat has not expired.
+
+    Returns:
+      A list of proxy server entities.
+    """
+    now = datetime.datetime.utcnow()
+    return [proxy_server for proxy_server in ProxyServer.GetAll()
+            if proxy_server.IsAlive(now)]
+
+  @staticmethod
+  def Register(name, ip_address, fingerprint):
+    """Add or refresh a proxy server that registered itself.
+
+    A proxy server registering again from the same address, such as after a
+    restart, keeps its id and token.  Its first heartbeat is the
+    registration.
+
+    Args:
+      name: What to set the proxy server's name field to.
+      ip_address: What to set the proxy server's ip_address field to.
+      fingerprint: What to set the proxy server's fingerprint field to.
+
+    Returns:
+      The proxy server entity, or None if the address belongs to a proxy
+      server added by hand.
+    """
+    entity = ProxyServer.query(ProxyServer.ip_address == ip_address).get()
+    if entity is None:
+      entity_id = ProxyServer.allocate_ids(1)[0]
+      entity = ProxyServer(id=entity_id,
+                           ip_address=ip_address,
+                           auth_token=ProxyServer._MakeAuthToken(entity_id))
+    elif entity.last_heartbeat is None:
+      return None
+    entity.name = name
+    entity.fingerprint = fingerprint
+    entity.last_heartbeat = datetime.datetime.utcnow()
     entity.put()
+    return entity
+
+  @staticmethod
+  def RecordHeartbeat(entity):
+    """Mark a proxy server that registered itself as alive.
+
+    Only the heartbeat is saved, in a transaction on the latest copy of the
+    entity, so a distribution finishing during the request is not
+    overwritten.
+
+    Args:
+      entity: The proxy server entity that sent the heartbeat.
+    """
+    entity.last_heartbeat = datetime.datetime.utcnow()
+
+    def _SaveHeartbeat():
+      """Set the heartbeat on the stored proxy server."""
+      latest = entity.key.get()
+      if latest is None:
+        # The proxy server was deleted since the request read it.
+        return
+      latest.last_heartbeat = entity.last_heartbeat
+      latest.put()
+
+    ndb.transaction(_SaveHeartbeat)
+
+  @staticmethod
+  def DeleteExpired():
+    """Delete the proxy servers whose heartbeat expired long ago.
+
+    Returns:
+      The number of proxy servers deleted.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=(ProxyServer.HEARTBEAT_TIMEOUT_SECONDS +
+                 ProxyServer.EXPIRED_RETENTION_SECONDS))
+    # None sorts before every datetime, so proxy servers added by hand match
+    # the query too and are left out here.
+    keys = [entity.key for entity
+            in ProxyServer.query(ProxyServer.last_heartbeat < cutoff)
+            if entity.last_heartbeat is not None]
+    ndb.delete_multi(keys)
+    return len(keys)
+
+  @staticmethod
+  def _MakeAuthToken(entity_id):
+    """Make a new secret token for a proxy server to authenticate with.
+
+    The token starts with the proxy server's id so it can be checked with a
+    lookup by key rather than a query.
+
+    Args:
+      entity_id: The proxy server's datastore id.
+
+    Returns:
+      A string of the id and a random secret.
+    """
+    return '%s.%s' % (entity_id, binascii.hexlify(os.urandom(16)))
+
+  @staticmethod
+  def GetByAuthToken(auth_token):
+    """Get the proxy server a token was issued to.
+
+    Args:
+      auth_token: The token presented by a proxy server.
+
+    Returns:
+      The proxy server entity, or None if the token is not valid.
+    """
+    if not auth_token or '.' not in auth_token:
+      return None
+    entity_id = auth_token.split('.', 1)[0]
+    if not entity_id.isdigit():
+      return None
+    entity = ProxyServer.Get(int(entity_id))
+    if not entity or not entity.auth_token:
+      return None
+    if not hmac.compare_digest(str(entity.auth_token), str(auth_token)):
+      return None
+    return entity
+
+
+class KeyRotationJob(BaseModel):
+
+  """A background job giving a new key pair to every user with an old one.
+
+  The job pages through all users with a query cursor, a batch per task, and
+  rotates the keys made before its cutoff.  The cursor is saved after each
+  batch, so a failed task resumes where the last one stopped.  Users whose
+  key was rotated have a key newer than the cutoff, so running a batch
+  again never rotates them twice.
+  """
+
+  # How many users each task reads and rotates.
+  BATCH_SIZE = 100
+
+  # Keys made before this time are rotated.
+  key_created_before = ndb.DateTimeProperty()
+  started = ndb.DateTimeProperty(auto_now_add=True)
+  # None until every user has been read.
+  finished = ndb.DateTimeProperty()
+  # The url safe query cursor after the last batch, or None to start.
+  cursor = ndb.StringProperty(indexed=False)
+  batches = ndb.IntegerProperty(default=0)
+  rotated = ndb.IntegerProperty(default=0)
+
+  @staticmethod
+  def Start(max_key_age=None):
+    """Create a job to rotate old keys.
+
+    Args:
+      max_key_age: A timedelta of the oldest key to keep, or None to rotate
+                   every key.
+
+    Returns:
+      The new job entity.
+    """
+    now = datetime.datetime.utcnow()
+    job = KeyRotationJob(
+        key_created_before=now - max_key_age if max_key_age else now)
+    job.put()
+    return job
+
+  @staticmethod
+  def GetLatest():
+    """Get the most recently started job.
+
+    Returns:
+      The job entity, or None if no job was ever started.
+    """
+    return KeyRotationJob.query().order(-KeyRotationJob.started).get()
+
+  def _NeedsRotation(self, user):
+    """Check whether a user has a key made before the job's cutoff."""
+    if user.public_key is None:
+      return False
+    return (user.key_created is None or
+            user.key_created < self.key_created_before)
+
+  @staticmethod
+  def RotateBatch(job_id):
+    """Rotate the keys in the next batch of users, and save the job's place.
+
+    The batch is read from a query, which may be stale by the time its key
+    pairs are ready, so the users are rotated in transactions on the users
+    as committed.  Users deleted or given a new key meanwhile are skipped,
+    and nothing else is written back from the query's copy.
+
+    Args:
+      job_id: The id of the job.
+
+    Returns:
+      The job entity after the batch, or None if there is no such job.  Its
+      finished time is set once the last batch is done.
+    """
+    job = KeyRotationJob.Get(job_id)
+    if job is None or job.finished is not None:
+      return job
+    start_cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    users, next_cursor, more = User.query().fetch_page(
+        KeyRotationJob.BATCH_SIZE, start_cursor=start_cursor)
+
+    # pylint: disable=protected-access
+    users = [user for user in users if job._NeedsRotation(user)]
+    public_keys = dict((user.key, user.public_key) for user in users)
+    key_pairs = dict(zip(public_keys, User._GetKeyPairs(len(users))))
+    # Whether each user was rotated in the attempt that committed.
+    is_rotated = {}
+
+    def _Rotate(user_key, user):
+      """Rotate the user as committed, if their key is unchanged."""
+      is_rotated[user_key] = (user is not None and
+                              user.public_key == public_keys[user_key])
+      if is_rotated[user_key]:
+        User._AssignKeyPair(user, key_pairs[user_key])
+        user.put()
+      return user
+
+    User._CommitUsers([user.key for user in users], _Rotate)
+
+    job.batches += 1
+    job.rotated += sum(is_rotated.values())
+    if more and next_cursor:
+      job.cursor = next_cursor.urlsafe()
+    else:
+      job.finished = datetime.datetime.utcnow()
+    job.put()
+    return job
+
+
+class KeySetVersion(BaseModel):
+
+  """Store the current version of the set of authorized keys.
+
+  The version goes up by one with every KeyChange, so a proxy server that has
+  accepted some version only needs the changes recorded after it.
+  """
+
+  VERSION_ID = 'key_set_version'
+  CACHE_KEY = 'key_set_version'
+  CACHE_RETRIES = 5
+  # How long the cached version may be served before it is read again, in
+  # case raising it ever fails.
+  CACHE_SECONDS = 60
+
+  version = ndb.IntegerProperty(default=0)
+  are_key_buckets_built = ndb.BooleanProperty(default=False)
+
+  @staticmethod
+  def GetCurrent():
+    """Get the current key set version.
+
+    Returns:
+      An integer of the latest version, or 0 if nothing was recorded yet.
+    """
+    entity = KeySetVersion.Get(KeySetVersion.VERSION_ID)
+    if not entity:
+      return 0
+    return entity.version
+
+  @staticmethod
+  def GetLatest():
+    """Get the current key set version, from memcache when possible.
+
+    Unlike GetCurrent this bypasses ndb's in-context cache, so calling it
+    again within the same request sees versions recorded since.
+
+    Returns:
+      An integer of the latest version, or 0 if nothing was recorded yet.
+    """
+    version = memcache.get(KeySetVersion.CACHE_KEY)
+    if version is None:
+      entity = ndb.Key(KeySetVersion, KeySetVersion.VERSION_ID).get(
+          use_cache=False)
+      version = entity.version if entity else 0
+      KeySetVersion.CacheLatest(version)
+    return version
+
+  @staticmethod
+  def CacheLatest(version):
+    """Raise the version held in memcache to at least the given version.
+
+    Versions are recorded concurrently, so compare and set is used to keep
+    a late writer from putting back an older version.  If every attempt
+    conflicts, the cached version is deleted so the next read takes it from
+    the datastore rather than serving one older than this version.
+
+    Args:
+      version: A key set version known to be committed.
+    """
+    client = memcache.Client()
+    for _ in range(KeySetVersion.CACHE_RETRIES):
+      cached_version = client.gets(KeySetVersion.CACHE_KEY)
+      if cached_version is None:
+        if client.add(KeySetVersion.CACHE_KEY, version,
+                      time=KeySetVersion.CACHE_SECONDS):
+          return
+      elif cached_version >= version:
+        return
+      elif client.cas(KeySetVersion.CACHE_KEY, version,
+                      time=KeySetVersion.CACHE_SECONDS):
+        return
+    client.delete(KeySetVersion.CACHE_KEY)
+
+
+class KeyBucket(BaseModel):
+
+  """Store the authorized keys lines for one bucket of users.
+
+  Users are bucketed by the first characters of their id, the sha256 of
+  their email, so the authorized keys for everyone live in a small fixed
+  number of chunks.  Each chunk is updated in the same transaction as its
+  users' writes, which lets the whole key string be read without loading
+  every user.  Users written before buckets existed are added by a one-time
+  build, and until it finishes the key string is read from the users
+  instead.
+  """
+
+  BUCKET_ID_LENGTH = 2
+  # How many buckets each task of the one-time build builds.
+  BUILD_BATCH_SIZE = 16
+
+  # A dictionary of user id to that user's authorized keys line.
+  key_lines = ndb.JsonProperty(compressed=True)
+
+  @staticmethod
+  def GetBucketId(user_id):
+    """Get the id of the bucket a user belongs in.
+
+    Args:
+      user_id: The user's datastore id.
+
+    Returns:
+      A string of the leading hex characters of the user id.
+    """
+    return user_id[:KeyBucket.BUCKET_ID_LENGTH]
+
+  @staticmethod
+  def GetAllBucketIds():
+    """Get the id of every bucket, in order.
+
+    Returns:
+      A list of every hex string of the bucket id length.
+    """
+    return ['%0*x' % (KeyBucket.BUCKET_ID_LENGTH, index)
+            for index in range(16 ** KeyBucket.BUCKET_ID_LENGTH)]
+
+  @staticmethod
+  def UpdateUsers(user_ids):
+    """Bring the key lines of users up to date in their buckets.
+
+    User writes keep their buckets up to date themselves, so this is for
+    users written before buckets existed.  Each bucket is read
+    and written in its own transaction, which reads the users again, so the
+    bucket always ends up with their lines as last committed, however
+    writes to the same users interleave.
+
+    Args:
+      user_ids: A list of user datastore ids.
+    """
+    user_ids_by_bucket_id = {}
+    for user_id in user_ids:
+      user_ids_by_bucket_id.setdefault(KeyBucket.GetBucketId(user_id),
+                                       set()).add(user_id)
+    for bucket_id, bucket_user_ids in sorted(user_ids_by_bucket_id.items()):
+      KeyBucket._UpdateBucket(bucket_id, sorted(bucket_user_ids))
+
+  @staticmethod
+  def _UpdateBucket(bucket_id, user_ids):
+    """Set the lines of some users in one bucket from the datastore.
+
+    Args:
+      bucket_id: The id of the bucket the users belong in.
+      user_ids: A list of the users' datastore ids.
+    """
+
+    @ndb.non_transactional
+    def _GetUsers():
+      """Read the users as committed, outside the bucket's entity group."""
+      return ndb.get_multi([ndb.Key(User, user_id) for user_id in user_ids],
+                           use_cache=False, use_memcache=False)
+
+    def _Update():
+      """Read, change and write the bucket without losing other writes.
+
+      The bucket is read before the users, so a user committed after they
+      are read has its own update conflict with this one or follow it.
+      """
+      bucket = KeyBucket.Get(bucket_id)
+      if not bucket:
+        bucket = KeyBucket(id=bucket_id)
+      KeyBucket._PutUsers(bucket, zip(user_ids, _GetUsers()))
+
+    ndb.transaction(_Update)
+
+  @staticmethod
+  def _PutUsers(bucket, users):
+    """Set the lines of some users in their bucket, putting it if changed.
+
+    Args:
+      bucket: The bucket entity the users belong in.
+      users: A list of (user id, user) pairs, where the user is None if it
+             has been deleted.
+    """
+    old_key_lines = bucket.key_lines or {}
+    key_lines = dict(old_key_lines)
+    # pylint: disable=protected-access
+    for user_id, user in users:
+      user_key_lines = User._GetKeyLines([user])
+      if user_key_lines:
+        key_lines[user_id] = user_key_lines[0]
+      else:
+        key_lines.pop(user_id, None)
+    if key_lines != old_key_lines:
+      bucket.key_lines = key_lines
+      bucket.put()
+
+  @staticmethod
+  def _GetBucketKeyStrings(bucket_ids):
+    """Get the authorized keys in each of the given buckets.
+
+    Until the one-time build has finished, the buckets may be missing users
+    written before they existed, so the keys are read from the users.
+
+    Args:
+      bucket_ids: A list of bucket ids.
+
+    Returns:
+      A list of the key string of each bucket, in the same order, with the
+      lines ordered by user id.
+    """
+    if KeyBucket.AreBuilt():
+      key_lines_by_bucket_id = dict(
+          (bucket_id, (bucket and bucket.key_lines) or {})
+          for bucket_id, bucket in zip(bucket_ids, ndb.get_multi(
+              [ndb.Key(KeyBucket, bucket_id) for bucket_id in bucket_ids])))
+    else:
+      key_lines_by_bucket_id = KeyBucket._ReadUserKeyLines(bucket_ids)
+
+    key_strings = []
+    for bucket_id in bucket_ids:
+      key_lines = key_lines_by_bucket_id[bucket_id]
+      key_strings.append(''.join(key_lines[user_id] + '\n'
+                                 for user_id in sorted(key_lines)))
+    return key_strings
+
+  @staticmethod
+  def _ReadUserKeyLines(bucket_ids):
+    """Read the key lines the given buckets should hold from every user.
+
+    Args:
+      bucket_ids: A list of bucket ids.
+
+    Returns:
+      A dictionary of bucket id to a dictionary of user id to key line.
+    """
+    key_lines_by_bucket_id = dict(
+        (bucket_id, {}) for bucket_id in bucket_ids)
+    # pylint: disable=protected-access
+    for user in User.query():
+      key_lines = User._GetKeyLines([user])
+      bucket_id = KeyBucket.GetBucketId(user.key.id())
+      if key_lines and bucket_id in key_lines_by_bucket_id:
+        key_lines_by_bucket_id[bucket_id][user.key.id()] = key_lines[0]
+    return key_lines_by_bucket_id
+
+  @staticmethod
+  def GetKeyString():
+    """Get the authorized keys for all users from the buckets.
+
+    Returns:
+      key_string: A string of every active authorized keys line.
+    """
+    return ''.join(KeyBucket._GetBucketKeyStrings(
+        KeyBucket.GetAllBucketIds()))
+
+  @staticmethod
+  def GetBucketKeyStrings(bucket_ids):
+    """Get the authorized keys in just the given buckets.
+
+    Args:
+      bucket_ids: A list of bucket ids.
+
+    Returns:
+      A dictionary of bucket id to the bucket's key string.
+    """
+    return dict(zip(bucket_ids, KeyBucket._GetBucketKeyStrings(bucket_ids)))
+
+  @staticmethod
+  def GetHashTree():
+    """Get a hash tree over the buckets for finding which ones differ.
+
+    Each node is named by the hex prefix its buckets share, from the root ''
+    through one node per hex character down to the buckets themselves.  A
+    bucket's digest is the sha256 of its key string, and every other node's
+    is the sha256 of its 16 children's hex digests joined in order.  Two
+    copies of the keys match in every bucket under a node whose digests
+    match.
+
+    Returns:
+      tree: A dictionary of node prefix to its hex sha256 digest.
+    """
+    bucket_ids = KeyBucket.GetAllBucketIds()
+    tree = {}
+    for bucket_id, key_string in zip(
+        bucket_ids, KeyBucket._GetBucketKeyStrings(bucket_ids)):
+      tree[bucket_id] = hashlib.sha256(key_string.encode('utf-8')).hexdigest()
+    for length in reversed(range(KeyBucket.BUCKET_ID_LENGTH)):
+      for index in range(16 ** length):
+        prefix = '%0*x' % (length, index) if length else ''
+        tree[prefix] = hashlib.sha256(''.join(
+            tree[child] for child in KeyBucket.GetHashTreeChildren(
+                prefix))).hexdigest()
+    return tree
+
+  @staticmethod
+  def GetHashTreeChildren(prefix):
+    """Get the names of a hash tree node's children, in order.
+
+    Args:
+      prefix: The name of a node above the buckets.
+
+    Returns:
+      A list of the 16 child node names.
+    """
+    return [prefix + '%x' % index for index in range(16)]
+
+  @staticmethod
+  def AreBuilt():
+    """Check whether the one-time build of the buckets has finished.
+
+    Returns:
+      True if the buckets hold every user's key line.
+    """
+    entity = KeySetVersion.Get(KeySetVersion.VERSION_ID)
+    return bool(entity and entity.are_key_buckets_built)
+
+  @staticmethod
+  def BuildBatch(start):
+    """Build the next batch of buckets from the users in the datastore.
+
+    Each bucket is built in the same way users' writes update it, so users
+    written during the build are never overwritten with older lines.
+
+    Args:
+      start: The index in GetAllBucketIds of the first bucket to build.
+
+    Returns:
+      The index of the first bucket of the next batch, or None once every
+      bucket has been built.
+    """
+    bucket_ids = KeyBucket.GetAllBucketIds()
+    for bucket_id in bucket_ids[start:start + KeyBucket.BUILD_BATCH_SIZE]:
+      # Every id starting with the bucket id sorts before this one.
+      end_id = bucket_id[:-1] + chr(ord(bucket_id[-1]) + 1)
+      query = User.query(User.key >= ndb.Key(User, bucket_id),
+                         User.key < ndb.Key(User, end_id))
+      user_ids = set(key.id() for key in query.iter(keys_only=True))
+      bucket = KeyBucket.Get(bucket_id)
+      if bucket and bucket.key_lines:
+        # Drop the lines of users that no longer exist.
+        user_ids.update(bucket.key_lines)
+      KeyBucket._UpdateBucket(bucket_id, sorted(user_ids))
+
+    start += KeyBucket.BUILD_BATCH_SIZE
+    if start < len(bucket_ids):
+      return start
+
+    def _MarkBuilt():
+      """Flag the buckets as built so they are read from now on."""
+      entity = KeySetVersion.Get(KeySetVersion.VERSION_ID)
+      if not entity:
+        entity = KeySetVersion(id=KeySetVersion.VERSION_ID)
+      entity.are_key_buckets_built = True
+      entity.put()
+
+    ndb.transaction(_MarkBuilt)
+    return None
+
+
+class KeyChange(BaseModel):
+
+  """Store one change to the set of authorized keys.
+
+  The entity id is the key set version that the change produced, so the
+  changes between any two versions can be fetched directly by id.  A change
+  too large for one entity is recorded as several versions in a row.
+  """
+
+  # How many versions behind a proxy server may be and still be sent only the
+  # changes rather than the whole key set.
+  MAX_DELTA_VERSIONS = 1000
+  # The most bytes of key lines one change holds, well under the datastore's
+  # 1 MB entity limit.  A key line for an rsa key is about 630 bytes.
+  MAX_CHANGE_BYTES = 512 * 1024
+
+  added_keys = ndb.TextProperty(repeated=True)
+  removed_keys = ndb.TextProperty(repeated=True)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+  @staticmethod
+  def _SplitKeyLines(key_lines):
+    """Split key lines into lists small enough for one change each.
+
+    Args:
+      key_lines: A list of authorized keys lines.
+
+    Returns:
+      A list of lists of the key lines, in order, each of at most
+      MAX_CHANGE_BYTES unless it is a single line.
+    """
+    parts = []
+    part = []
+    part_bytes = 0
+    for key_line in key_lines:
+      if part and part_bytes + len(key_line) > KeyChange.MAX_CHANGE_BYTES:
+        parts.append(part)
+        part = []
+        part_bytes = 0
+      part.append(key_line)
+      part_bytes += len(key_line)
+    if part:
+      parts.append(part)
+    return parts
+
+  @staticmethod
+  def Record(added_keys, removed_keys):
+    """Record a change to the key set under the next key set version.
+
+    A change larger than MAX_CHANGE_BYTES is recorded as several versions,
+    the revocations before the additions, so no single entity outgrows the
+    datastore's limit.
+
+    Args:
+      added_keys: A list of authorized keys lines that are now granted.
+      removed_keys: A list of authorized keys lines that are now revoked.
+
+    Returns:
+      version: The newest key set version, or None if there was nothing to
+               record.
+    """
+    if not added_keys and not removed_keys:
+      return None
+    if (sum(len(key_line) for key_line in added_keys + removed_keys) <=
+        KeyChange.MAX_CHANGE_BYTES):
+      return KeyChange._RecordPart(added_keys, removed_keys)
+
+    version = None
+    for removed_part in KeyChange._SplitKeyLines(removed_keys):
+      version = KeyChange._RecordPart([], removed_part)
+    for added_part in KeyChange._SplitKeyLines(added_keys):
+      version = KeyChange._RecordPart(added_part, [])
+    return version
+
+  @staticmethod
+  def _RecordInTransaction(added_keys, removed_keys):
+    """Bump the version and store a change under it, in the caller's
+    cross group transaction, so it commits with the writes that made it.
+
+    The version, the change and its convergence are one entity group each.
+    The caller raises the cached version once the transaction commits.
+
+    Args:
+      added_keys: A list of authorized keys lines that are now granted.
+      removed_keys: A list of authorized keys lines that are now revoked.
+
+    Returns:
+      version: The new key set version, or None if there was nothing to
+               record.
+    """
+    if not added_keys and not removed_keys:
+      return None
+    entity = KeySetVersion.Get(KeySetVersion.VERSION_ID)
+    if not entity:
+      entity = KeySetVersion(id=KeySetVersion.VERSION_ID)
+    entity.version += 1
+    change = KeyChange(id=entity.version, added_keys=added_keys,
+                       removed_keys=removed_keys)
+    convergence = KeySetConvergence(id=entity.version,
+                                    is_revocation=not added_keys)
+    ndb.put_multi([entity, change, convergence])
+    return entity.version
+
+  @staticmethod
+  def _RecordPart(added_keys, removed_keys):
+    """Record a change small enough for one entity under the next version.
+
+    Args:
+      added_keys: A list of authorized keys lines that are now granted.
+      removed_keys: A list of authorized keys lines that are now revoked.
+
+    Returns:
+      version: The new key set version.
+    """
+    version = ndb.transaction(
+        lambda: KeyChange._RecordInTransaction(added_keys, removed_keys),
+        xg=True)
+    KeySetVersion.CacheLatest(version)
+    return version
+
+  @staticmethod
+  def GetDelta(base_version, version):
+    """Get the net change to the key set between two versions.
+
+    Keys are added and removed as a set, so only the last change made to any
+    one key line matters.
+
+    Args:
+      base_version: The key set version to start from, or None if unknown.
+      version: The key set version to end at.
+
+    Returns:
+      delta: A tuple of the sorted lists of added and of removed authorized
+             keys lines, or None if the changes are no longer all available.
+    """
+    if (base_version is None or base_version > version or
+        version - base_version > KeyChange.MAX_DELTA_VERSIONS):
+      return None
+
+    keys = [ndb.Key(KeyChange, change_version)
+            for change_version in range(base_version + 1, version + 1)]
+    changes = ndb.get_multi(keys)
+    if None in changes:
+      return None
+
+    is_added = {}
+    for change in changes:
+      for key_line in change.removed_keys:
+        is_added[key_line] = False
+      for key_line in change.added_keys:
+        is_added[key_line] = True
+
+    added_keys = sorted(line for line, added in is_added.items() if added)
+    removed_keys = sorted(line for line, added in is_added.items()
+                          if not added)
+    return added_keys, removed_keys
+
+  @staticmethod
+  def DeleteThrough(version):
+    """Delete every change up to and including the given version.
+
+    Args:
+      version: The newest key set version whose change is no longer needed.
+    """
+    if version < 1:
+      return
+    query = KeyChange.query(KeyChange.key <= ndb.Key(KeyChange, version))
+    ndb.delete_multi(query.fetch(keys_only=True))
+
+
+class DistributionAck(BaseModel):
+
+  """Store when a proxy server acknowledged a key set version."""
+
+  proxy_server_id = ndb.IntegerProperty()
+  version = ndb.IntegerProperty()
+  # True if only the revocations up to the version were applied.
+  is_revocation_only = ndb.BooleanProperty(default=False)
+  acked = ndb.DateTimeProperty(auto_now_add=True)
+
+  @staticmethod
+  def Record(proxy_servers, version, is_revocation_only=False):
+    """Record that each of the proxy servers acknowledged a version.
+
+    Args:
+      proxy_servers: A list of proxy server entities that accepted the push.
+      version: The key set version they accepted.
+      is_revocation_only: True if they were only sent the revocations.
+    """
+    ndb.put_multi([DistributionAck(proxy_server_id=proxy_server.key.id(),
+                                   version=version,
+                                   is_revocation_only=is_revocation_only)
+                   for proxy_server in proxy_servers])
+
+  @staticmethod
+  def GetSince(version):
+    """Get every acknowledgement of the version or a later one.
+
+    Args:
+      version: The oldest key set version to include.
+
+    Returns:
+      A list of distribution ack entities.
+    """
+    return DistributionAck.query(DistributionAck.version >= version).fetch()
+
+  @staticmethod
+  def DeleteBefore(version):
+    """Delete every acknowledgement of a version older than the given one.
+
+    Args:
+      version: The oldest key set version whose acknowledgements are kept.
+    """
+    ndb.delete_multi(DistributionAck.query(
+        DistributionAck.version < version).fetch(keys_only=True))
+
+
+class KeySetConvergence(BaseModel):
+
+  """Store how long one key set version took to reach every proxy server.
+
+  The entity id is the key set version.  It outlives the key change, which
+  is deleted once no proxy server needs it.
+  """
+
+  # How many of the most recent versions convergence is reported over.
+  REPORT_VERSIONS = 1000
+
+  # True if the version only revoked keys.
+  is_revocation = ndb.BooleanProperty(default=False)
+  changed = ndb.DateTimeProperty(auto_now_add=True)
+  converged = ndb.DateTimeProperty()
+  latency_seconds = ndb.FloatProperty()
+
+  @staticmethod
+  def GetPending():
+    """Get the versions that have not reached every proxy server yet.
+
+    Returns:
+      A list of key set convergence entities, oldest version first.
+    """
+    # An ndb filter needs == None to match properties that are unset.
+    # pylint: disable=singleton-comparison
+    query = KeySetConvergence.query(KeySetConvergence.converged == None)
+    pending = query.fetch(KeySetConvergence.REPORT_VERSIONS)
+    return sorted(pending, key=lambda convergence: convergence.key.id())
+
+  @staticmethod
+  def GetRecent():
+    """Get the most recent versions, converged or not.
+
+    Returns:
+      A list of key set convergence entities, newest first.
+    """
+    return KeySetConvergence.query().order(
+        -KeySetConvergence.changed).fetch(KeySetConvergence.REPORT_VERSIONS)
 
 
 class Notification(BaseModel):
@@ -426,3 +1857,61 @@ class DomainVerification(BaseModel):
     entity = DomainVerification.Get(DomainVerification.CONTENT_ID)
     entity.content = new_content
     entity.put()
+
+
+class ProxyRegistration(BaseModel):
+
+  """Store the secret proxy servers present to register themselves.
+
+  The secret is made at random the first time it is needed, and is given to
+  an autoscaled fleet's proxy servers through their instance template.
+  """
+
+  # The comment below disables landscape.io checking on that line so that it
+  # does not think we have an actual secret stored which we do not.
+  SECRET_ID = 'proxy_registration_secret'  # noqa
+
+  secret = ndb.StringProperty()
+
+  @staticmethod
+  def GetOrInsertDefault():
+    """Get the ProxyRegistration entity from the datastore.
+
+    If no entity exists in the datastore currently, this inserts one with a
+    new random secret and returns that.
+
+    Returns:
+      The datastore entity for ProxyRegistration.
+    """
+    return ProxyRegistration.get_or_insert(
+        ProxyRegistration.SECRET_ID,
+        secret=binascii.hexlify(os.urandom(32)))
+
+  @staticmethod
+  def Insert(new_secret):
+    """Insert an entity with the new secret into the datastore.
+
+    By inserting with the set id, we ensure never to generate multiple
+    ProxyRegistration entities.
+
+    Args:
+      new_secret: The secret value to set on the ProxyRegistration entity.
+    """
+    entity = ProxyRegistration(id=ProxyRegistration.SECRET_ID,
+                               secret=new_secret)
+    entity.put()
+
+  @staticmethod
+  def IsValidSecret(secret):
+    """Check a secret presented by a proxy server registering itself.
+
+    Args:
+      secret: The secret the proxy server presented.
+
+    Returns:
+      True if it is the registration secret, otherwise False.
+    """
+    if not secret:
+      return False
+    entity = ProxyRegistration.GetOrInsertDefault()
+    return hmac.compare_digest(str(entity.secret), str(secret))
@@ -0,0 +1,119 @@
+"""The module for checking the health of the proxy servers.
+
+Every live proxy server is probed in parallel on a schedule, and rolling
+averages of its probe round trip time and error rate are saved on its entity.
+Those averages order distribution and choose invite code hosts, and are shown
+on the proxy server list, so nothing has to probe a proxy server on demand.
+"""
+
+import datetime
+import functools
+
+import key_distributor
+from google.appengine.ext import ndb
+
+
+# How much each new probe counts towards the rolling averages.  The rest is
+# the average of the probes before it.
+HEALTH_EWMA_WEIGHT = 0.3
+# Proxy servers failing more of their probes than this are unhealthy.
+MAX_HEALTHY_ERROR_RATE = 0.5
+
+
+def _MovingAverage(average, value):
+  """Fold a new value into an exponentially weighted moving average.
+
+  Args:
+    average: The average so far, or None if there is no value yet.
+    value: The new value.
+
+  Returns:
+    The new average.
+  """
+  if average is None:
+    return value
+  return HEALTH_EWMA_WEIGHT * value + (1 - HEALTH_EWMA_WEIGHT) * average
+
+
+def RecordProbeResult(proxy_server, result, now):
+  """Update a proxy server's rolling health with a probe's result.
+
+  The round trip time only averages the successful probes, as a failed one
+  measures the timeout rather than the proxy server.  Whether the proxy
+  server accepts gzip compressed pushes is taken from its latest answer.
+
+  Args:
+    proxy_server: The proxy server entity that was probed.
+    result: The probe result from key_distributor.ProbeProxyServer, or None
+            if it raised.
+    now: The utc datetime of the health check.
+  """
+  success = key_distributor.IsProbeSuccess(result)
+  proxy_server.health_error_rate = _MovingAverage(
+      proxy_server.health_error_rate, 0.0 if success else 1.0)
+  if success:
+    proxy_server.health_rtt = _MovingAverage(proxy_server.health_rtt,
+                                             result['latency'])
+  key_distributor.RecordProbeEncoding(proxy_server, result)
+  proxy_server.last_health_check = now
+
+
+def _CheckProxyServer(proxy_server, now):
+  """Probe a single proxy server and save its health.
+
+  The health is saved in a transaction on the latest copy of the entity, so
+  a distribution finishing during the probe is not overwritten.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+    now: The utc datetime of the health check.
+
+  Returns:
+    The probe result from key_distributor.ProbeProxyServer.
+  """
+  result = key_distributor.ProbeProxyServer(proxy_server)
+
+  def _SaveHealth():
+    """Fold the probe into the stored proxy server's health."""
+    entity = proxy_server.key.get()
+    if entity is None:
+      # The proxy server was deleted during the probe.
+      return
+    RecordProbeResult(entity, result, now)
+    entity.put()
+
+  ndb.transaction(_SaveHealth)
+  return result
+
+
+def CheckProxyServers(proxy_servers):
+  """Probe every proxy server concurrently and save each one's health.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+
+  Returns:
+    results: A list of the probe result for each proxy server, in the same
+             order as proxy_servers.
+  """
+  now = datetime.datetime.utcnow()
+  return key_distributor.RunConcurrently(
+      functools.partial(_CheckProxyServer, now=now), proxy_servers)
+
+
+def GetHealthyProxyServers(proxy_servers):
+  """Get the proxy servers that are passing their health checks.
+
+  Proxy servers that have not been checked yet count as healthy.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+
+  Returns:
+    A list of the healthy proxy servers, or every proxy server if none of
+    them are healthy, so there is always somewhere to send users.
+  """
+  healthy = [proxy_server for proxy_server in proxy_servers
+             if (proxy_server.health_error_rate or 0.0) <=
+             MAX_HEALTHY_ERROR_RATE]
+  return healthy or list(proxy_servers)
@@ -0,0 +1,123 @@
+"""Test health checker module functionality."""
+import datetime
+import os
+import unittest
+
+from mock import patch
+
+from datastore import ProxyServer
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+import health_checker
+
+
+FAKE_IP_ADDRESS = '111.222.333.444'
+FAKE_FINGERPRINT = ':'.join(['ab'] * 32)
+FAKE_NOW = datetime.datetime(2016, 1, 1)
+OK_RESULT = {'status': 200, 'latency': 0.1, 'accepts_gzip': True}
+FAILED_RESULT = {'status': None, 'latency': 5.0}
+
+
+class HealthCheckerTest(unittest.TestCase):
+
+  """Test health checker functionality."""
+
+  def setUp(self):
+    """Setup the testbed for each test."""
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    """Deactive the testbed."""
+    self.testbed.deactivate()
+
+  def testRecordProbeResult(self):
+    """Test the rolling averages move towards each new probe."""
+    fake_proxy_server = GetFakeProxyServer()
+
+    health_checker.RecordProbeResult(fake_proxy_server, OK_RESULT, FAKE_NOW)
+
+    self.assertEqual(fake_proxy_server.health_error_rate, 0.0)
+    self.assertEqual(fake_proxy_server.health_rtt, 0.1)
+    self.assertEqual(fake_proxy_server.last_health_check, FAKE_NOW)
+    self.assertEqual(fake_proxy_server.accepts_gzip, True)
+
+    health_checker.RecordProbeResult(fake_proxy_server, FAILED_RESULT,
+                                     FAKE_NOW)
+
+    self.assertAlmostEqual(fake_proxy_server.health_error_rate,
+                           health_checker.HEALTH_EWMA_WEIGHT)
+    # A failed probe measures the timeout, so is left out of the rtt.
+    self.assertEqual(fake_proxy_server.health_rtt, 0.1)
+
+  @patch('key_distributor.ProbeProxyServer')
+  def testCheckProxyServers(self, mock_probe):
+    """Test every proxy server is probed and its health saved."""
+    proxy_servers = [ProxyServer(id=index, ip_address=str(index))
+                     for index in range(1, 11)]
+    ndb.put_multi(proxy_servers)
+    mock_probe.side_effect = lambda proxy_server: (
+        FAILED_RESULT if proxy_server.ip_address == '1' else OK_RESULT)
+
+    results = health_checker.CheckProxyServers(proxy_servers)
+
+    self.assertEqual(results, [FAILED_RESULT] + [OK_RESULT] * 9)
+    ndb.get_context().clear_cache()
+    saved = ndb.get_multi([proxy_server.key for proxy_server
+                           in proxy_servers])
+    self.assertEqual(saved[0].health_error_rate, 1.0)
+    self.assertEqual(saved[0].health_rtt, None)
+    for proxy_server in saved[1:]:
+      self.assertEqual(proxy_server.health_error_rate, 0.0)
+      self.assertEqual(proxy_server.health_rtt, 0.1)
+      self.assertNotEqual(proxy_server.last_health_check, None)
+
+  @patch('key_distributor.ProbeProxyServer')
+  def testCheckProxyServersKeepsDistribution(self, mock_probe):
+    """Test a distribution saved during a probe is not overwritten."""
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.put()
+
+    def _DistributeDuringProbe(proxy_server):
+      """Save a newer key set version while the probe is running."""
+      distributed = proxy_server.key.get(use_cache=False)
+      distributed.key_set_version = 7
+      distributed.put()
+      return OK_RESULT
+
+    mock_probe.side_effect = _DistributeDuringProbe
+
+    health_checker.CheckProxyServers([fake_proxy_server])
+
+    ndb.get_context().clear_cache()
+    saved = fake_proxy_server.key.get()
+    self.assertEqual(saved.key_set_version, 7)
+    self.assertEqual(saved.health_rtt, 0.1)
+
+  def testGetHealthyProxyServers(self):
+    """Test proxy servers failing their checks are left out."""
+    unchecked = ProxyServer(name='unchecked')
+    healthy = ProxyServer(name='healthy', health_error_rate=0.1)
+    unhealthy = ProxyServer(name='unhealthy', health_error_rate=0.9)
+
+    self.assertEqual(
+        health_checker.GetHealthyProxyServers([unchecked, healthy,
+                                               unhealthy]),
+        [unchecked, healthy])
+    self.assertEqual(health_checker.GetHealthyProxyServers([unhealthy]),
+                     [unhealthy])
+
+
+def GetFakeProxyServer():
+  """Return an instance of a proxy server with mocked values."""
+  return ProxyServer(id=1,
+                     ip_address=FAKE_IP_ADDRESS,
+                     fingerprint=FAKE_FINGERPRINT)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,1226 @@
+"""The module for distributing authorized keys out to the proxy servers."""
+
+import datetime
+import functools
+import gzip
+import httplib
+import httplib2
+import json
+import logging
+import math
+import Queue
+import socket
+import StringIO
+import threading
+import time
+
+from config import PATHS
+import connection_pool
+from datastore import DistributionAck
+from datastore import KeyChange
+from datastore import KeySetConvergence
+from datastore import KeySetVersion
+from datastore import ProxyServer
+import pinned_connection
+import ssh_distributor
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+
+# The most proxy servers that will be contacted at the same time.
+MAX_CONCURRENT_REQUESTS = 20
+# How long to wait on a single proxy server before giving up on it.
+PUSH_TIMEOUT_SECONDS = 10
+# Headers telling a proxy server which key set version a push brings it to,
+# and for a delta, which version the changes apply on top of.
+KEY_SET_VERSION_HEADER = 'X-Key-Set-Version'
+BASE_KEY_SET_VERSION_HEADER = 'X-Base-Key-Set-Version'
+# The header listing the peers, as comma separated address#fingerprint pairs,
+# that a relay should forward its whole key set to after applying a push.
+RELAY_PEERS_HEADER = 'X-Relay-Peers'
+# The push queue running one distribution task per proxy server.
+DISTRIBUTION_QUEUE = 'key-distribution'
+# The push queue for revocations, kept apart so they never wait behind the
+# distribution tasks for a large batch of new users.
+REVOCATION_QUEUE = 'key-revocation'
+# The module distribution tasks run on.  Key changes made on the keygen module
+# schedule them too, and it only serves key generation.
+DISTRIBUTION_TARGET = 'default'
+# Key changes made within the same window of this many seconds are sent out
+# together by a single distribution.
+COALESCE_WINDOW_SECONDS = 5
+# Revocations are held for a much shorter window before being sent out.
+REVOCATION_COALESCE_WINDOW_SECONDS = 1
+# The memcache key prefix for the authorized keys built at each version.
+KEY_STRING_CACHE_PREFIX = 'key_string_'
+GZIP_KEY_STRING_CACHE_PREFIX = 'gzip_key_string_'
+# The memcache key prefix for the hash tree over the key buckets.
+HASH_TREE_CACHE_PREFIX = 'key_hash_tree_'
+# How long a proxy server's watch request is held open waiting for a new key
+# set version, kept well inside the 60 second request deadline, and how often
+# the version is checked while waiting.
+WATCH_TIMEOUT_SECONDS = 45
+WATCH_POLL_INTERVAL_SECONDS = 1
+# How long to wait on a single proxy server's probe, kept well under a push's
+# timeout as a probe sends almost nothing.
+PROBE_TIMEOUT_SECONDS = 5
+# How many pushes in a row a proxy server may fail before its circuit opens,
+# after which it is only probed until it answers again.
+CIRCUIT_FAILURE_THRESHOLD = 3
+# The proxy server properties a distribution changes, which are the only
+# ones it saves.
+DISTRIBUTION_PROPERTIES = (
+    'accepts_gzip', 'key_set_version', 'revoked_key_set_version',
+    'last_distribution_success', 'last_distribution_latency',
+    'consecutive_distribution_failures', 'circuit_state', 'circuit_opened')
+# The proxy server properties a push was addressed by.  A push is not saved
+# once any of them has changed, as it went somewhere else.
+PUSH_ADDRESS_PROPERTIES = ('ip_address', 'fingerprint', 'delivery_method')
+
+
+# Connections to the proxy servers kept open by this instance between pushes,
+# so the TLS handshake is paid once per connection rather than per push.
+# Proxy server certificates are self-signed and checked by pinning instead.
+CONNECTION_POOL = connection_pool.ConnectionPool(
+    timeout=PUSH_TIMEOUT_SECONDS, disable_ssl_certificate_validation=True)
+# Connections kept open between probes, apart from the push connections so a
+# probe never holds a connection a push is waiting for.
+PROBE_CONNECTION_POOL = connection_pool.ConnectionPool(
+    timeout=PROBE_TIMEOUT_SECONDS, disable_ssl_certificate_validation=True)
+
+
+def RunConcurrently(function, items, max_workers=MAX_CONCURRENT_REQUESTS):
+  """Call the function on every item using a bounded pool of threads.
+
+  App Engine allows request scoped threads, so this lets one slow item (such
+  as an unresponsive proxy server) hold up only its own worker rather than
+  every item queued behind it.
+
+  Args:
+    function: A function taking a single item to run for each item.
+    items: A list of items to pass to the function.
+    max_workers: The maximum number of threads to run at the same time.
+
+  Returns:
+    results: A list of what the function returned for each item, in the same
+             order as items.  An item whose call raised gets None.
+  """
+  results = [None] * len(items)
+  work_queue = Queue.Queue()
+  for index, item in enumerate(items):
+    work_queue.put((index, item))
+
+  def _Worker():
+    """Keep pulling items off the queue until it is empty."""
+    while True:
+      try:
+        index, item = work_queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[index] = function(item)
+      # Any failure must be contained here or it would silently kill the
+      # worker and leave the rest of its share of the items unprocessed.
+      # pylint: disable=broad-except
+      except Exception:
+        logging.exception('Concurrent call failed for %s.', item)
+
+  workers = []
+  for _ in range(min(max_workers, len(items))):
+    worker = threading.Thread(target=_Worker)
+    worker.start()
+    workers.append(worker)
+  for worker in workers:
+    worker.join()
+
+  return results
+
+
+def GzipCompress(data):
+  """Compress a string with gzip for sending with Content-Encoding: gzip.
+
+  The modification time is left out of the header so the same data always
+  compresses to the same bytes.
+
+  Args:
+    data: A string, encoded as utf-8 first if it is unicode.
+
+  Returns:
+    A string of the gzip compressed bytes.
+  """
+  if isinstance(data, unicode):
+    data = data.encode('utf-8')
+  compressed = StringIO.StringIO()
+  gzip_file = gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0)
+  gzip_file.write(data)
+  gzip_file.close()
+  return compressed.getvalue()
+
+
+def GetCachedKeyString(version, make_key_string):
+  """Get the authorized keys at a version, building them only on a miss.
+
+  Key sets too large for a single memcache value are built every time.
+
+  Args:
+    version: The key set version, read before the key string is built.
+    make_key_string: A function returning the authorized keys for all users.
+
+  Returns:
+    key_string: The authorized keys for all users.
+  """
+  cache_key = KEY_STRING_CACHE_PREFIX + str(version)
+  key_string = memcache.get(cache_key)
+  if key_string is None:
+    key_string = make_key_string()
+    try:
+      memcache.set(cache_key, key_string)
+    except ValueError:
+      logging.info('Key string for version %s is too large to cache.', version)
+  return key_string
+
+
+def GetCachedGzipKeyString(version, make_key_string):
+  """Get the gzip compressed authorized keys at a version, cached in memcache.
+
+  Args:
+    version: The key set version, read before the key string is built.
+    make_key_string: A function returning the authorized keys for all users.
+
+  Returns:
+    A string of the gzip compressed authorized keys for all users.
+  """
+  cache_key = GZIP_KEY_STRING_CACHE_PREFIX + str(version)
+  gzip_key_string = memcache.get(cache_key)
+  if gzip_key_string is None:
+    gzip_key_string = GzipCompress(
+        GetCachedKeyString(version, make_key_string))
+    try:
+      memcache.set(cache_key, gzip_key_string)
+    except ValueError:
+      logging.info('Compressed key string for version %s is too large to '
+                   'cache.', version)
+  return gzip_key_string
+
+
+def GetCachedHashTree(version, make_hash_tree):
+  """Get the hash tree over the key buckets at a version, cached in memcache.
+
+  Args:
+    version: The key set version, read before the tree is built.
+    make_hash_tree: A function returning the hash tree over the buckets.
+
+  Returns:
+    tree: A dictionary of hash tree node name to its hex digest.
+  """
+  cache_key = HASH_TREE_CACHE_PREFIX + str(version)
+  tree = memcache.get(cache_key)
+  if tree is None:
+    tree = make_hash_tree()
+    memcache.set(cache_key, tree)
+  return tree
+
+
+def MakeSnapshotPayload(key_string, version):
+  """Make the payload replacing all of a proxy server's keys.
+
+  Args:
+    key_string: The authorized keys for all users.
+    version: The key set version the key string was built at.
+
+  Returns:
+    payload: A dictionary with the body, its gzip compressed form, and the
+             version and base version (None) of the push.
+  """
+  return {
+      'body': key_string,
+      'gzip_body': GzipCompress(key_string),
+      'version': version,
+      'base_version': None,
+  }
+
+
+def MakeDeltaPayload(added_keys, removed_keys, base_version, version):
+  """Make the payload changing a proxy server's keys from one version.
+
+  Each line of the body is an authorized keys line prefixed with + if it
+  should be granted or - if it should be revoked.
+
+  Args:
+    added_keys: A list of authorized keys lines to grant.
+    removed_keys: A list of authorized keys lines to revoke.
+    base_version: The key set version the proxy server currently has.
+    version: The key set version the proxy server will have after applying.
+
+  Returns:
+    payload: A dictionary with the body, its gzip compressed form, and the
+             version and base version of the push.
+  """
+  lines = ['-%s\n' % key_line for key_line in removed_keys]
+  lines.extend('+%s\n' % key_line for key_line in added_keys)
+  body = ''.join(lines)
+  return {
+      'body': body,
+      'gzip_body': GzipCompress(body),
+      'version': version,
+      'base_version': base_version,
+  }
+
+
+def MakeRevocationPayload(removed_keys, base_version):
+  """Make the payload revoking keys without granting any.
+
+  This is a delta that leaves the proxy server at its base version, so the
+  additions made since are still sent by the next full distribution, which
+  revokes the same keys again harmlessly.
+
+  Args:
+    removed_keys: A list of authorized keys lines to revoke.
+    base_version: The key set version the proxy server currently has.
+
+  Returns:
+    payload: A delta payload from MakeDeltaPayload.
+  """
+  return MakeDeltaPayload([], removed_keys, base_version, base_version)
+
+
+def MakeRelayPayload(payload, peers):
+  """Make the payload for a relay to apply and then forward to its peers.
+
+  Args:
+    payload: The payload bringing the relay itself up to date.
+    peers: A list of the proxy server entities the relay should forward to.
+
+  Returns:
+    payload: A copy of the payload that also lists the peers' addresses and
+             certificate fingerprints.  Peers without a valid fingerprint are
+             left out, as the relay could not check their certificates.
+  """
+  relay_peers = []
+  for peer in peers:
+    fingerprint = pinned_connection.NormalizeFingerprint(peer.fingerprint)
+    if fingerprint is not None:
+      relay_peers.append('%s#%s' % (peer.ip_address, fingerprint))
+  return dict(payload, relay_peers=relay_peers)
+
+
+def _ParseRelayStatuses(content):
+  """Parse the report a relay responds with of how each peer answered it.
+
+  Args:
+    content: The response body, a JSON object of peer address to the http
+             status code that peer responded with.
+
+  Returns:
+    A dictionary of peer address to http status code, empty if the relay did
+    not send a report.
+  """
+  try:
+    statuses = json.loads(content)
+  except (TypeError, ValueError):
+    return {}
+  if not isinstance(statuses, dict):
+    return {}
+  return statuses
+
+
+def _SendPayload(proxy_server, payload, use_gzip):
+  """Send a key payload to a single proxy server once.
+
+  A snapshot payload is PUT to replace every key on the proxy server and a
+  delta payload is sent with PATCH on top of the base version.  Keys are only
+  sent over https to a proxy server presenting the certificate matching its
+  stored fingerprint.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+    payload: A payload from MakeSnapshotPayload, MakeDeltaPayload or
+             MakeRelayPayload.
+    use_gzip: True to send the gzip compressed body.
+
+  Returns:
+    result: A dictionary with the http status code the proxy server responded
+            with (None if it could not be reached within the timeout) and the
+            latency in seconds of the push.  For a relay payload, it also has
+            the relay_statuses the relay reported for its peers.
+  """
+  headers = {
+      'content-type': 'text/plain',
+      KEY_SET_VERSION_HEADER: str(payload['version']),
+  }
+  method = 'PUT'
+  if payload['base_version'] is not None:
+    headers[BASE_KEY_SET_VERSION_HEADER] = str(payload['base_version'])
+    method = 'PATCH'
+  if 'relay_peers' in payload:
+    headers[RELAY_PEERS_HEADER] = str(','.join(payload['relay_peers']))
+  body = payload['body']
+  if use_gzip:
+    headers['content-encoding'] = 'gzip'
+    body = payload['gzip_body']
+
+  fingerprint = pinned_connection.NormalizeFingerprint(
+      proxy_server.fingerprint)
+  if fingerprint is None:
+    logging.error('Not distributing keys to %s without a valid certificate '
+                  'fingerprint to pin.', proxy_server.ip_address)
+    return {'status': None, 'latency': 0.0}
+
+  # Connections are pooled per pin so a changed fingerprint is checked anew.
+  pool_key = '%s#%s' % (proxy_server.ip_address, fingerprint)
+  http = CONNECTION_POOL.Checkout(pool_key)
+  start_time = time.time()
+  try:
+    # httplib joins the request line and headers before a str body, so none
+    # of them may be the unicode the datastore returns.
+    response, content = http.request(
+        str('https://%s/key' % proxy_server.ip_address),
+        headers=headers,
+        method=method,
+        body=body,
+        connection_type=functools.partial(
+            pinned_connection.PinnedHTTPSConnection, fingerprint=fingerprint))
+  except (httplib.HTTPException, httplib2.HttpLib2Error,
+          socket.error) as error:
+    CONNECTION_POOL.Discard(http)
+    logging.warning('Failed to distribute keys to %s: %s',
+                    proxy_server.ip_address, error)
+    return {'status': None, 'latency': time.time() - start_time}
+
+  CONNECTION_POOL.Release(pool_key, http)
+  logging.info('Distributed keys to %s. Response: %s, Content: %s',
+               proxy_server.ip_address, response.status, content)
+  result = {'status': response.status, 'latency': time.time() - start_time}
+  if 'relay_peers' in payload:
+    result['relay_statuses'] = _ParseRelayStatuses(content)
+  return result
+
+
+def PushKeysToProxyServer(proxy_server, payload):
+  """Send a key payload to a single proxy server, compressed if it allows.
+
+  The body is only sent gzip compressed to a proxy server whose probe
+  advertised gzip in Accept-Encoding, and plain to one not probed yet.  A
+  proxy server answering a compressed push with 415 anyway is sent the push
+  again uncompressed, and remembered so it is not sent gzip again.
+
+  Proxy servers set to ssh delivery have the snapshot written over ssh
+  instead.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+    payload: A payload from MakeSnapshotPayload or MakeDeltaPayload.
+
+  Returns:
+    result: A dictionary with the http status code the proxy server responded
+            with (None if it could not be reached within the timeout) and the
+            latency in seconds of the push.
+  """
+  if proxy_server.delivery_method == ProxyServer.SSH_DELIVERY:
+    return ssh_distributor.PushKeyString(proxy_server, payload['body'])
+  if proxy_server.accepts_gzip is not True:
+    return _SendPayload(proxy_server, payload, False)
+
+  result = _SendPayload(proxy_server, payload, True)
+  if result['status'] == httplib.UNSUPPORTED_MEDIA_TYPE:
+    proxy_server.accepts_gzip = False
+    return _SendPayload(proxy_server, payload, False)
+  return result
+
+
+def _AcceptsGzip(response):
+  """Check whether a response advertises gzip compressed request bodies.
+
+  Args:
+    response: The httplib2 response from the proxy server.
+
+  Returns:
+    True if its Accept-Encoding header lists gzip without a zero quality.
+  """
+  for coding in response.get('accept-encoding', '').split(','):
+    parts = [part.strip().lower() for part in coding.split(';')]
+    if parts[0] != 'gzip':
+      continue
+    for part in parts[1:]:
+      if part.startswith('q='):
+        try:
+          return float(part[2:]) > 0
+        except ValueError:
+          return False
+    return True
+  return False
+
+
+def ProbeProxyServer(proxy_server):
+  """Check a single proxy server is up and presenting its pinned certificate.
+
+  A proxy server taking its keys over https is sent a HEAD request for its
+  key endpoint, and is up if it answers with anything other than a server
+  error.  The Accept-Encoding header of its answer says whether it takes
+  gzip compressed pushes.  One taking its keys over ssh is up if its ssh port
+  accepts a connection.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+
+  Returns:
+    result: A dictionary with the http status code the proxy server responded
+            with (None if it could not be reached within the timeout) and the
+            round trip time in seconds of the probe.  An https proxy server
+            that answered also has accepts_gzip.
+  """
+  if proxy_server.delivery_method == ProxyServer.SSH_DELIVERY:
+    return ssh_distributor.ProbeSshPort(proxy_server, PROBE_TIMEOUT_SECONDS)
+  fingerprint = pinned_connection.NormalizeFingerprint(
+      proxy_server.fingerprint)
+  if fingerprint is None:
+    return {'status': None, 'latency': 0.0}
+
+  pool_key = '%s#%s' % (proxy_server.ip_address, fingerprint)
+  http = PROBE_CONNECTION_POOL.Checkout(pool_key)
+  start_time = time.time()
+  try:
+    response, _ = http.request(
+        'https://%s/key' % proxy_server.ip_address,
+        method='HEAD',
+        connection_type=functools.partial(
+            pinned_connection.PinnedHTTPSConnection, fingerprint=fingerprint))
+  except (httplib.HTTPException, httplib2.HttpLib2Error,
+          socket.error) as error:
+    PROBE_CONNECTION_POOL.Discard(http)
+    logging.info('Health check of %s failed: %s', proxy_server.ip_address,
+                 error)
+    return {'status': None, 'latency': time.time() - start_time}
+
+  PROBE_CONNECTION_POOL.Release(pool_key, http)
+  return {'status': response.status, 'latency': time.time() - start_time,
+          'accepts_gzip': _AcceptsGzip(response)}
+
+
+def IsProbeSuccess(result):
+  """Check whether a probe found its proxy server up.
+
+  Args:
+    result: The probe result from ProbeProxyServer, or None if it raised.
+
+  Returns:
+    True if the proxy server answered without a server error.
+  """
+  return (result is not None and result['status'] is not None and
+          result['status'] < httplib.INTERNAL_SERVER_ERROR)
+
+
+def RecordProbeEncoding(proxy_server, result):
+  """Remember whether a successful probe found gzip pushes accepted.
+
+  Args:
+    proxy_server: The proxy server entity that was probed.
+    result: The probe result from ProbeProxyServer, or None if it raised.
+  """
+  if IsProbeSuccess(result) and 'accepts_gzip' in result:
+    proxy_server.accepts_gzip = result['accepts_gzip']
+
+
+def PushKeysToProxyServers(proxy_servers, payloads):
+  """Send each proxy server its key payload concurrently.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+    payloads: A list of the payload to send to each proxy server.
+
+  Returns:
+    results: A list of the push result for each proxy server, in the same
+             order as proxy_servers.
+  """
+  def _Push(proxy_server_and_payload):
+    """Send one proxy server its payload."""
+    proxy_server, payload = proxy_server_and_payload
+    return PushKeysToProxyServer(proxy_server, payload)
+
+  return RunConcurrently(_Push, zip(proxy_servers, payloads))
+
+
+def OrderByHealth(proxy_servers):
+  """Sort the proxy servers so the healthiest are contacted first.
+
+  The concurrent pushes start in this order, so proxy servers that are up
+  get their keys before the workers are held up by ones that are timing out.
+  Proxy servers that have not been health checked yet keep their place among
+  the healthy ones.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+
+  Returns:
+    A new list of the proxy servers by rising error rate and then round trip
+    time.
+  """
+  return sorted(proxy_servers, key=lambda proxy_server: (
+      proxy_server.health_error_rate or 0.0, proxy_server.health_rtt or 0.0))
+
+
+def GetOutOfDateProxyServers(proxy_servers, version):
+  """Find the proxy servers that have not accepted the given key set yet.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+    version: The current key set version.
+
+  Returns:
+    A list of the proxy servers whose last accepted key set version differs.
+  """
+  return [proxy_server for proxy_server in proxy_servers
+          if proxy_server.key_set_version != version]
+
+
+def GetUnrevokedProxyServers(proxy_servers, version):
+  """Find the proxy servers that may not have applied the latest revocations.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+    version: The current key set version.
+
+  Returns:
+    A list of the proxy servers that have neither accepted the key set nor
+    applied its revocations.
+  """
+  return [proxy_server for proxy_server in proxy_servers
+          if proxy_server.key_set_version != version and
+          proxy_server.revoked_key_set_version != version]
+
+
+def AllowPushes(proxy_servers):
+  """Find the proxy servers whose circuit breaker lets them be pushed to.
+
+  Each proxy server with an open circuit is probed, concurrently, which costs
+  far less than a push timing out.  Those answering are half opened for a
+  single trial push.  The circuit states are only changed on the entities,
+  which the caller saves.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+
+  Returns:
+    A list of the proxy servers whose circuit is not open, in the same order.
+  """
+  open_proxy_servers = [proxy_server for proxy_server in proxy_servers
+                        if proxy_server.circuit_state ==
+                        ProxyServer.CIRCUIT_OPEN]
+  results = RunConcurrently(ProbeProxyServer, open_proxy_servers)
+  for proxy_server, result in zip(open_proxy_servers, results):
+    RecordProbeEncoding(proxy_server, result)
+    if IsProbeSuccess(result):
+      proxy_server.circuit_state = ProxyServer.CIRCUIT_HALF_OPEN
+  return [proxy_server for proxy_server in proxy_servers
+          if proxy_server.circuit_state != ProxyServer.CIRCUIT_OPEN]
+
+
+def RecordPushFailure(proxy_server):
+  """Count a failed push, opening the proxy server's circuit if it trips.
+
+  The circuit opens after CIRCUIT_FAILURE_THRESHOLD failures in a row, or
+  straight away if the failed push was the trial of a half open circuit.
+
+  Args:
+    proxy_server: The proxy server entity whose push failed.
+  """
+  proxy_server.consecutive_distribution_failures = (
+      (proxy_server.consecutive_distribution_failures or 0) + 1)
+  if (proxy_server.circuit_state == ProxyServer.CIRCUIT_HALF_OPEN or
+      proxy_server.consecutive_distribution_failures >=
+      CIRCUIT_FAILURE_THRESHOLD):
+    if proxy_server.circuit_state != ProxyServer.CIRCUIT_OPEN:
+      logging.warning('Opening the circuit to %s after %d failed pushes.',
+                      proxy_server.ip_address,
+                      proxy_server.consecutive_distribution_failures)
+    proxy_server.circuit_state = ProxyServer.CIRCUIT_OPEN
+    proxy_server.circuit_opened = datetime.datetime.utcnow()
+
+
+def RecordDistributionResult(proxy_server, result, version):
+  """Update a proxy server's distribution status after a push.
+
+  A successful push closes the proxy server's circuit.
+
+  Args:
+    proxy_server: The proxy server entity that was pushed to.
+    result: The push result from PushKeysToProxyServer.
+    version: The key set version that was pushed.
+
+  Returns:
+    True if the proxy server accepted the keys, False otherwise.
+  """
+  if result['status'] == httplib.OK:
+    proxy_server.key_set_version = version
+    proxy_server.last_distribution_success = datetime.datetime.utcnow()
+    proxy_server.last_distribution_latency = result['latency']
+    proxy_server.consecutive_distribution_failures = 0
+    proxy_server.circuit_state = ProxyServer.CIRCUIT_CLOSED
+    return True
+
+  RecordPushFailure(proxy_server)
+  return False
+
+
+def _SaveDistributionStatus(proxy_server):
+  """Save the distribution properties of a single proxy server.
+
+  They are saved in a transaction on the latest copy of the entity, so
+  changes made during the push, such as an edit, a heartbeat or a health
+  check, are not overwritten.
+
+  Args:
+    proxy_server: A proxy server entity whose distribution status changed.
+  """
+
+  def _Save():
+    """Copy the distribution properties onto the stored proxy server."""
+    entity = proxy_server.key.get()
+    if entity is None:
+      # The proxy server was deleted during the push.
+      return
+    for name in PUSH_ADDRESS_PROPERTIES:
+      if getattr(entity, name) != getattr(proxy_server, name):
+        logging.info('Not saving the push to %s as it was edited meanwhile.',
+                     proxy_server.ip_address)
+        return
+    for name in DISTRIBUTION_PROPERTIES:
+      setattr(entity, name, getattr(proxy_server, name))
+    entity.put()
+
+  ndb.transaction(_Save)
+
+
+def SaveDistributionStatus(proxy_servers):
+  """Save the distribution properties of each proxy server concurrently.
+
+  Args:
+    proxy_servers: A list of proxy server entities whose distribution status
+                   changed.
+  """
+  RunConcurrently(_SaveDistributionStatus, proxy_servers)
+
+
+def _MakePayloadBuilders(version, make_key_string):
+  """Make the functions building the payloads bringing proxy servers up.
+
+  Each payload, including the snapshot, is built at most once however many
+  proxy servers it is sent to.
+
+  Args:
+    version: The current key set version.
+    make_key_string: A function returning the authorized keys for all users.
+
+  Returns:
+    A tuple of a function taking a proxy server and returning its payload,
+    and a function returning the snapshot payload.
+  """
+  snapshot = {}
+  payloads_by_base_version = {}
+
+  def _GetSnapshotPayload():
+    """Build the snapshot payload the first time it is needed."""
+    if not snapshot:
+      snapshot.update(MakeSnapshotPayload(
+          GetCachedKeyString(version, make_key_string), version))
+    return snapshot
+
+  def _GetPayload(proxy_server):
+    """Get the delta since the proxy server's version, or the snapshot."""
+    if proxy_server.delivery_method == ProxyServer.SSH_DELIVERY:
+      # An authorized_keys file over ssh is always rewritten whole.
+      return _GetSnapshotPayload()
+    base_version = proxy_server.key_set_version
+    if base_version not in payloads_by_base_version:
+      delta = KeyChange.GetDelta(base_version, version)
+      if delta is None:
+        payloads_by_base_version[base_version] = _GetSnapshotPayload()
+      else:
+        added_keys, removed_keys = delta
+        payloads_by_base_version[base_version] = MakeDeltaPayload(
+            added_keys, removed_keys, base_version, version)
+    return payloads_by_base_version[base_version]
+
+  return _GetPayload, _GetSnapshotPayload
+
+
+def _IsDeltaUnsupported(payload, result):
+  """Check whether a proxy server turned down a delta it does not support.
+
+  Args:
+    payload: The payload that was pushed.
+    result: The push result, or None if the push raised.
+
+  Returns:
+    True if the payload was a delta the proxy server can not apply.
+  """
+  return (payload['base_version'] is not None and result is not None and
+          result['status'] in (httplib.METHOD_NOT_ALLOWED,
+                               httplib.NOT_IMPLEMENTED))
+
+
+def DistributeKeys(proxy_servers, version, make_key_string):
+  """Bring every proxy server up to the given key set version.
+
+  Proxy servers are sent only the changes since the version they last
+  accepted.  A proxy server that has never accepted a version, has fallen too
+  far behind, does not understand deltas, or takes its keys over ssh is sent
+  the whole key set instead, which is built at most once.  The healthiest
+  proxy servers are pushed to first, and those whose circuit is open are
+  only probed.  The distribution status of every out of date proxy server is
+  saved whether or not it accepted the keys.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+    version: The current key set version.
+    make_key_string: A function returning the authorized keys for all users.
+
+  Returns:
+    updated_proxy_servers: A list of the proxy servers that were updated.
+  """
+  out_of_date_proxy_servers = OrderByHealth(
+      GetOutOfDateProxyServers(proxy_servers, version))
+  pushed_proxy_servers = AllowPushes(out_of_date_proxy_servers)
+  get_payload, get_snapshot_payload = _MakePayloadBuilders(version,
+                                                           make_key_string)
+  payloads = [get_payload(proxy_server)
+              for proxy_server in pushed_proxy_servers]
+
+  results = PushKeysToProxyServers(pushed_proxy_servers, payloads)
+
+  # Proxy servers that do not support deltas yet get the whole key set.
+  retry_indexes = [
+      index for index, (payload, result) in enumerate(zip(payloads, results))
+      if _IsDeltaUnsupported(payload, result)]
+  if retry_indexes:
+    retry_results = PushKeysToProxyServers(
+        [pushed_proxy_servers[index] for index in retry_indexes],
+        [get_snapshot_payload()] * len(retry_indexes))
+    for index, result in zip(retry_indexes, retry_results):
+      results[index] = result
+
+  updated_proxy_servers = []
+  for proxy_server, result in zip(pushed_proxy_servers, results):
+    if result is None:
+      result = {'status': None, 'latency': None}
+    if RecordDistributionResult(proxy_server, result, version):
+      updated_proxy_servers.append(proxy_server)
+  SaveDistributionStatus(out_of_date_proxy_servers)
+  DistributionAck.Record(updated_proxy_servers, version)
+
+  return updated_proxy_servers
+
+
+def GroupByRelay(proxy_servers):
+  """Split the proxy servers into those pushed to and those relayed to.
+
+  A proxy server is sent its keys through its relay only if the relay exists
+  and is itself pushed to directly, so relays are never chained.
+
+  Args:
+    proxy_servers: A list of every proxy server entity from the datastore.
+
+  Returns:
+    A list of (proxy server, peers) tuples, one for each proxy server pushed
+    to directly, with the list of the peers it relays to (often empty).
+  """
+  proxy_servers_by_id = dict((proxy_server.key.id(), proxy_server)
+                             for proxy_server in proxy_servers)
+  peers_by_relay_id = {}
+  for proxy_server in proxy_servers:
+    relay = proxy_servers_by_id.get(proxy_server.relay_id)
+    if relay is not None and relay.relay_id is None:
+      peers_by_relay_id.setdefault(relay.key.id(), []).append(proxy_server)
+
+  relayed_ids = set(peer.key.id() for peers in peers_by_relay_id.values()
+                    for peer in peers)
+  return [(proxy_server, peers_by_relay_id.get(proxy_server.key.id(), []))
+          for proxy_server in proxy_servers
+          if proxy_server.key.id() not in relayed_ids]
+
+
+def GetRelayConvergence(proxy_servers, version):
+  """Count how much of each relay's subtree has the current key set.
+
+  Args:
+    proxy_servers: A list of every proxy server entity from the datastore.
+    version: The current key set version.
+
+  Returns:
+    A dictionary of relay id to a tuple of how many of the relay and its
+    peers have accepted the version, and how many there are in all.
+  """
+  convergence = {}
+  for relay, peers in GroupByRelay(proxy_servers):
+    if peers:
+      subtree = [relay] + peers
+      converged = len(subtree) - len(GetOutOfDateProxyServers(subtree,
+                                                              version))
+      convergence[relay.key.id()] = (converged, len(subtree))
+  return convergence
+
+
+def DistributeKeysThroughRelay(relay, peers, version, make_key_string):
+  """Bring a relay and the peers it forwards to up to the key set version.
+
+  The relay is pushed its own payload once, listing its out of date peers.
+  After applying it the relay forwards its whole key set to each of them and
+  reports how each answered, so the app makes one request for the subtree
+  rather than one per proxy server.  Peers the relay could not bring up to
+  date, including every peer when the relay itself is unreachable or its
+  circuit is open, are pushed to directly instead.  A relay set to ssh
+  delivery can not forward, so its subtree is always pushed to directly.
+
+  Args:
+    relay: The relay proxy server entity from the datastore.
+    peers: A list of the proxy server entities the relay forwards to.
+    version: The current key set version.
+    make_key_string: A function returning the authorized keys for all users.
+
+  Returns:
+    updated_proxy_servers: A list of the proxy servers that were updated.
+  """
+  out_of_date_peers = GetOutOfDateProxyServers(peers, version)
+  if (not out_of_date_peers or
+      relay.delivery_method == ProxyServer.SSH_DELIVERY):
+    return DistributeKeys([relay] + peers, version, make_key_string)
+  if not AllowPushes([relay]):
+    logging.warning('The circuit to relay %s is open, pushing to its peers '
+                    'directly.', relay.ip_address)
+    return DistributeKeys(peers, version, make_key_string)
+
+  get_payload, get_snapshot_payload = _MakePayloadBuilders(version,
+                                                           make_key_string)
+  payload = get_payload(relay)
+  result = PushKeysToProxyServer(
+      relay, MakeRelayPayload(payload, out_of_date_peers))
+  if _IsDeltaUnsupported(payload, result):
+    result = PushKeysToProxyServer(
+        relay, MakeRelayPayload(get_snapshot_payload(), out_of_date_peers))
+
+  updated_proxy_servers = []
+  relay_statuses = {}
+  if RecordDistributionResult(relay, result, version):
+    updated_proxy_servers.append(relay)
+    relay_statuses = result.get('relay_statuses', {})
+  relayed_peers = []
+  direct_peers = []
+  for peer in out_of_date_peers:
+    if relay_statuses.get(peer.ip_address) == httplib.OK:
+      RecordDistributionResult(peer, result, version)
+      relayed_peers.append(peer)
+    else:
+      direct_peers.append(peer)
+  SaveDistributionStatus([relay] + relayed_peers)
+  updated_proxy_servers.extend(relayed_peers)
+  DistributionAck.Record(updated_proxy_servers, version)
+
+  if direct_peers:
+    logging.warning('Relay %s did not update %d peers, pushing to them '
+                    'directly.', relay.ip_address, len(direct_peers))
+    updated_proxy_servers.extend(
+        DistributeKeys(direct_peers, version, make_key_string))
+  return updated_proxy_servers
+
+
+def DistributeRevocations(proxy_servers, version, make_key_string):
+  """Send every proxy server the keys revoked since the version it has.
+
+  Only the revocations are sent, so removing a key costs a small push however
+  many users were added alongside it.  The additions are left for the next
+  full distribution.  A proxy server that can not be sent revocations alone,
+  because it has never accepted a version, has fallen too far behind, does
+  not understand deltas, or takes its keys over ssh, is brought fully up to
+  date with DistributeKeys instead.  Proxy servers whose circuit is open are
+  only probed.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+    version: The current key set version.
+    make_key_string: A function returning the authorized keys for all users.
+
+  Returns:
+    revoked_proxy_servers: A list of the proxy servers that have now applied
+                           every revocation up to the version.
+  """
+  unrevoked_proxy_servers = AllowPushes(OrderByHealth(
+      GetUnrevokedProxyServers(proxy_servers, version)))
+  removed_keys_by_base_version = {}
+  full_proxy_servers = []
+  pushed_proxy_servers = []
+  payloads = []
+  revoked_proxy_servers = []
+  for proxy_server in unrevoked_proxy_servers:
+    base_version = proxy_server.key_set_version
+    if (proxy_server.delivery_method == ProxyServer.SSH_DELIVERY or
+        base_version is None):
+      full_proxy_servers.append(proxy_server)
+      continue
+    if base_version not in removed_keys_by_base_version:
+      delta = KeyChange.GetDelta(base_version, version)
+      removed_keys_by_base_version[base_version] = (
+          None if delta is None else delta[1])
+    removed_keys = removed_keys_by_base_version[base_version]
+    if removed_keys is None:
+      full_proxy_servers.append(proxy_server)
+    elif removed_keys:
+      pushed_proxy_servers.append(proxy_server)
+      payloads.append(MakeRevocationPayload(removed_keys, base_version))
+    else:
+      # Nothing has been revoked since the proxy server's version.
+      proxy_server.revoked_key_set_version = version
+      revoked_proxy_servers.append(proxy_server)
+
+  results = PushKeysToProxyServers(pushed_proxy_servers, payloads)
+  snapshot_proxy_servers = []
+  for proxy_server, result in zip(pushed_proxy_servers, results):
+    status = result['status'] if result else None
+    if status == httplib.OK:
+      proxy_server.revoked_key_set_version = version
+      revoked_proxy_servers.append(proxy_server)
+    elif status in (httplib.METHOD_NOT_ALLOWED, httplib.NOT_IMPLEMENTED):
+      snapshot_proxy_servers.append(proxy_server)
+    else:
+      RecordPushFailure(proxy_server)
+
+  revocation_acked_proxy_servers = list(revoked_proxy_servers)
+
+  # Proxy servers that do not support deltas yet get the whole key set.
+  snapshot_acked_proxy_servers = []
+  if snapshot_proxy_servers:
+    snapshot = MakeSnapshotPayload(
+        GetCachedKeyString(version, make_key_string), version)
+    results = PushKeysToProxyServers(
+        snapshot_proxy_servers, [snapshot] * len(snapshot_proxy_servers))
+    for proxy_server, result in zip(snapshot_proxy_servers, results):
+      if result is None:
+        result = {'status': None, 'latency': None}
+      if RecordDistributionResult(proxy_server, result, version):
+        snapshot_acked_proxy_servers.append(proxy_server)
+  revoked_proxy_servers.extend(snapshot_acked_proxy_servers)
+  # Those brought fully up to date are saved by DistributeKeys.
+  full_ids = set(id(proxy_server) for proxy_server in full_proxy_servers)
+  SaveDistributionStatus([proxy_server
+                          for proxy_server in unrevoked_proxy_servers
+                          if id(proxy_server) not in full_ids])
+  DistributionAck.Record(revocation_acked_proxy_servers, version,
+                         is_revocation_only=True)
+  DistributionAck.Record(snapshot_acked_proxy_servers, version)
+
+  if full_proxy_servers:
+    revoked_proxy_servers.extend(
+        DistributeKeys(full_proxy_servers, version, make_key_string))
+  return revoked_proxy_servers
+
+
+def EnqueueDistributionTasks(proxy_servers, revocations_only=False):
+  """Add a task to distribute keys to each of the proxy servers.
+
+  Each task brings its proxy server up to whatever the key set version is
+  when it runs, and is retried with backoff by the queue until it succeeds.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+    revocations_only: True to queue tasks sending only the revocations, on
+                      the revocation queue.
+  """
+  params = {}
+  queue_name = DISTRIBUTION_QUEUE
+  if revocations_only:
+    params['revocations_only'] = '1'
+    queue_name = REVOCATION_QUEUE
+  tasks = [taskqueue.Task(url=PATHS['task_proxy_server_distribute_key'],
+                          params=dict(params, id=proxy_server.key.id()),
+                          target=DISTRIBUTION_TARGET)
+           for proxy_server in proxy_servers]
+  queue = taskqueue.Queue(queue_name)
+  for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+
+
+def _ScheduleNamedTask(name_prefix, window_seconds, queue_name, params=None):
+  """Queue a distribution run at the end of the current window, once.
+
+  The task is named after its window, so however many changes happen within
+  one window only a single distribution is queued for them.
+
+  Args:
+    name_prefix: The start of the task name, unique to the kind of run.
+    window_seconds: How long each window lasts.
+    queue_name: The push queue to add the task to.
+    params: An optional dictionary of query parameters for the task.
+  """
+  window = int(time.time()) // window_seconds
+  countdown = (window + 1) * window_seconds - time.time()
+  task = taskqueue.Task(url=PATHS['cron_proxy_server_distribute_key'],
+                        method='GET',
+                        params=params,
+                        name='%s-%d' % (name_prefix, window),
+                        target=DISTRIBUTION_TARGET,
+                        countdown=max(countdown, 0))
+  try:
+    task.add(queue_name)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # A distribution is already scheduled that will include this change.
+    pass
+
+
+def ScheduleDistribution():
+  """Schedule a distribution to run at the end of the current window.
+
+  This is called after every change to the users' keys so that changes
+  reach the proxy servers in seconds rather than at the next cron run.
+  """
+  _ScheduleNamedTask('distribute-keys', COALESCE_WINDOW_SECONDS,
+                     DISTRIBUTION_QUEUE)
+
+
+def ScheduleRevocation():
+  """Schedule sending out just the revocations, ahead of any distribution.
+
+  This is called after a key is revoked or its user deleted.  The run goes
+  on the revocation queue within a second, so it never waits behind the
+  tasks distributing a large batch of new users.
+  """
+  _ScheduleNamedTask('revoke-keys', REVOCATION_COALESCE_WINDOW_SECONDS,
+                     REVOCATION_QUEUE, {'revocations_only': '1'})
+
+
+def PruneKeyChanges(proxy_servers, version):
+  """Delete the key changes that no proxy server can still need.
+
+  Args:
+    proxy_servers: A list of proxy server entities from the datastore.
+    version: The current key set version.
+  """
+  oldest_needed_version = version - KeyChange.MAX_DELTA_VERSIONS
+  accepted_versions = [proxy_server.key_set_version
+                       for proxy_server in proxy_servers
+                       if proxy_server.key_set_version is not None]
+  if accepted_versions:
+    oldest_needed_version = max(oldest_needed_version,
+                                min(accepted_versions))
+  KeyChange.DeleteThrough(oldest_needed_version)
+
+
+def UpdateConvergence(proxy_servers):
+  """Record when each pending key set version reached every proxy server.
+
+  A version has reached a proxy server once it acknowledged that version or
+  a later one, or, for a version that only revoked keys, had the revocations
+  up to that version or a later one applied.  The convergence latency is
+  from the change being made to the last proxy server reaching it.
+  Acknowledgements older than any pending version are no longer needed and
+  are deleted.
+
+  Args:
+    proxy_servers: A list of every proxy server entity from the datastore.
+
+  Returns:
+    converged: A list of the key set convergence entities that converged.
+  """
+  pending = KeySetConvergence.GetPending()
+  if not pending or not proxy_servers:
+    return []
+
+  acks_by_proxy_server_id = {}
+  for ack in DistributionAck.GetSince(pending[0].key.id()):
+    acks_by_proxy_server_id.setdefault(ack.proxy_server_id, []).append(ack)
+
+  converged = []
+  for convergence in pending:
+    version = convergence.key.id()
+    ack_times = []
+    for proxy_server in proxy_servers:
+      times = [ack.acked for ack
+               in acks_by_proxy_server_id.get(proxy_server.key.id(), [])
+               if ack.version >= version and
+               (convergence.is_revocation or not ack.is_revocation_only)]
+      if not times:
+        break
+      ack_times.append(min(times))
+    else:
+      convergence.converged = max(ack_times)
+      convergence.latency_seconds = max(
+          (convergence.converged - convergence.changed).total_seconds(), 0.0)
+      converged.append(convergence)
+  ndb.put_multi(converged)
+
+  still_pending = [convergence.key.id() for convergence in pending
+                   if convergence.converged is None]
+  if still_pending:
+    DistributionAck.DeleteBefore(min(still_pending))
+  else:
+    DistributionAck.DeleteBefore(pending[-1].key.id() + 1)
+  return converged
+
+
+def GetPercentile(values, percentile):
+  """Get a percentile of the values by the nearest rank.
+
+  Args:
+    values: A list of numbers.
+    percentile: The percentile to get, from 0 to 100.
+
+  Returns:
+    The smallest value at least the percentile of the values are no greater
+    than, or None if there are no values.
+  """
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = int(math.ceil(percentile / 100.0 * len(ordered)))
+  return ordered[max(rank, 1) - 1]
+
+
+def GetConvergenceStats(convergences):
+  """Summarize how long key set versions took to reach every proxy server.
+
+  Args:
+    convergences: A list of key set convergence entities.
+
+  Returns:
+    stats: A dictionary with the count of converged and of pending versions,
+           and the p50 and p99 convergence latency in seconds of all versions
+           and of the revocations alone (None where nothing has converged).
+  """
+  latencies = [convergence.latency_seconds for convergence in convergences
+               if convergence.converged is not None]
+  revocation_latencies = [convergence.latency_seconds
+                          for convergence in convergences
+                          if convergence.converged is not None and
+                          convergence.is_revocation]
+  return {
+      'converged_count': len(latencies),
+      'pending_count': len(convergences) - len(latencies),
+      'p50_seconds': GetPercentile(latencies, 50),
+      'p99_seconds': GetPercentile(latencies, 99),
+      'revocation_p50_seconds': GetPercentile(revocation_latencies, 50),
+      'revocation_p99_seconds': GetPercentile(revocation_latencies, 99),
+  }
+
+
+def WaitForNewVersion(known_version, timeout_seconds=WATCH_TIMEOUT_SECONDS):
+  """Wait until the key set version differs from the one a proxy server has.
+
+  Only memcache is checked while waiting, so holding many proxy servers'
+  requests open costs no datastore reads.
+
+  Args:
+    known_version: The key set version the proxy server has, or None.
+    timeout_seconds: The longest to wait for a new version.
+
+  Returns:
+    version: The current key set version once it differs, or None if it did
+             not change before the timeout.
+  """
+  deadline = time.time() + timeout_seconds
+  while True:
+    version = KeySetVersion.GetLatest()
+    if version != known_version:
+      return version
+    remaining_seconds = deadline - time.time()
+    if remaining_seconds <= 0:
+      return None
+    time.sleep(min(WATCH_POLL_INTERVAL_SECONDS, remaining_seconds))
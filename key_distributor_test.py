@@ -0,0 +1,1068 @@
+"""Test key distributor module functionality."""
+import datetime
+import os
+import socket
+import threading
+import time
+import unittest
+import zlib
+
+from mock import ANY
+from mock import MagicMock
+from mock import patch
+
+from config import PATHS
+from datastore import DistributionAck
+from datastore import KeyChange
+from datastore import KeySetConvergence
+from datastore import ProxyServer
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+import httplib2
+import key_distributor
+import pinned_connection
+
+
+FAKE_IP_ADDRESS = '111.222.333.444'
+FAKE_FINGERPRINT = ':'.join(['ab'] * 32)
+FAKE_POOL_KEY = '%s#%s' % (FAKE_IP_ADDRESS, 'ab' * 32)
+FAKE_KEY_STRING = 'ssh-rsa public_key email'
+OK_RESULT = {'status': 200, 'latency': 0.5}
+FAILED_RESULT = {'status': None, 'latency': 10.0}
+
+
+class KeyDistributorTest(unittest.TestCase):
+
+  """Test key distributor functionality."""
+
+  def setUp(self):
+    """Setup the testbed for each test."""
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Tasks only resolve their target module against the app's hostname.
+    self.testbed.setup_env(default_version_hostname='localhost:8080',
+                           overwrite=True)
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    """Deactive the testbed."""
+    self.testbed.deactivate()
+
+  def testRunConcurrentlyKeepsOrder(self):
+    """Test results are returned in the same order as the items."""
+    items = range(50)
+
+    results = key_distributor.RunConcurrently(lambda item: item * 2, items)
+
+    self.assertEqual(results, [item * 2 for item in items])
+
+  def testRunConcurrentlyIsBounded(self):
+    """Test no more than max_workers calls are ever in flight at once."""
+    lock = threading.Lock()
+    state = {'running': 0, 'most_running': 0}
+
+    def SlowFunction(item):
+      """Track how many calls are running alongside this one."""
+      with lock:
+        state['running'] += 1
+        state['most_running'] = max(state['most_running'], state['running'])
+      time.sleep(0.01)
+      with lock:
+        state['running'] -= 1
+      return item
+
+    key_distributor.RunConcurrently(SlowFunction, range(20), max_workers=4)
+
+    self.assertTrue(state['most_running'] <= 4)
+    self.assertTrue(state['most_running'] > 1)
+
+  def testRunConcurrentlyContainsFailures(self):
+    """Test one failing call does not stop the remaining items."""
+    def SometimesFails(item):
+      """Raise for a single item."""
+      if item == 3:
+        raise ValueError('bad item')
+      return item
+
+    results = key_distributor.RunConcurrently(SometimesFails, range(6),
+                                              max_workers=1)
+
+    self.assertEqual(results, [0, 1, 2, None, 4, 5])
+
+  def testGetCachedKeyString(self):
+    """Test the key string is built once per version."""
+    mock_make_key_string = MagicMock(return_value=FAKE_KEY_STRING)
+
+    first = key_distributor.GetCachedKeyString(1, mock_make_key_string)
+    second = key_distributor.GetCachedKeyString(1, mock_make_key_string)
+    key_distributor.GetCachedKeyString(2, mock_make_key_string)
+
+    self.assertEqual(first, FAKE_KEY_STRING)
+    self.assertEqual(second, FAKE_KEY_STRING)
+    self.assertEqual(mock_make_key_string.call_count, 2)
+
+  def testMakeSnapshotPayload(self):
+    """Test a snapshot payload carries the whole key string."""
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+
+    self.assertEqual(payload, {
+        'body': FAKE_KEY_STRING,
+        'gzip_body': key_distributor.GzipCompress(FAKE_KEY_STRING),
+        'version': 3,
+        'base_version': None})
+
+  def testMakeDeltaPayload(self):
+    """Test a delta payload lists removed then added keys with a prefix."""
+    payload = key_distributor.MakeDeltaPayload(['ssh-rsa new a@b.com'],
+                                               ['ssh-rsa old a@b.com'], 2, 3)
+
+    self.assertEqual(payload['body'],
+                     '-ssh-rsa old a@b.com\n+ssh-rsa new a@b.com\n')
+    self.assertEqual(payload['gzip_body'],
+                     key_distributor.GzipCompress(payload['body']))
+    self.assertEqual(payload['version'], 3)
+    self.assertEqual(payload['base_version'], 2)
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerSnapshot(self, mock_request):
+    """Test a snapshot is put on the proxy server and the status returned."""
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, ''
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+    proxy_server = GetFakeProxyServer()
+    proxy_server.accepts_gzip = True
+
+    result = key_distributor.PushKeysToProxyServer(proxy_server, payload)
+
+    self.assertEqual(result['status'], 200)
+    self.assertTrue(result['latency'] >= 0)
+    mock_request.assert_called_once_with(
+        'https://%s/key' % FAKE_IP_ADDRESS,
+        headers={'content-type': 'text/plain', 'X-Key-Set-Version': '3',
+                 'content-encoding': 'gzip'},
+        method='PUT',
+        body=payload['gzip_body'],
+        connection_type=ANY)
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerDelta(self, mock_request):
+    """Test a delta is patched onto the proxy server's base version."""
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, ''
+    payload = key_distributor.MakeDeltaPayload([FAKE_KEY_STRING], [], 2, 3)
+
+    proxy_server = GetFakeProxyServer()
+    proxy_server.accepts_gzip = False
+
+    key_distributor.PushKeysToProxyServer(proxy_server, payload)
+
+    mock_request.assert_called_once_with(
+        'https://%s/key' % FAKE_IP_ADDRESS,
+        headers={'content-type': 'text/plain', 'X-Key-Set-Version': '3',
+                 'X-Base-Key-Set-Version': '2'},
+        method='PATCH',
+        body=payload['body'],
+        connection_type=ANY)
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerUnicodeAddress(self, mock_request):
+    """Test an address read from the datastore is requested as a str."""
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, ''
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+    proxy_server = GetFakeProxyServer()
+    proxy_server.ip_address = unicode(FAKE_IP_ADDRESS)
+
+    key_distributor.PushKeysToProxyServer(proxy_server, payload)
+
+    self.assertIsInstance(mock_request.call_args[0][0], str)
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerGzipUnknown(self, mock_request):
+    """Test a proxy server not probed yet is sent the plain body."""
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, ''
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+    proxy_server = GetFakeProxyServer()
+
+    key_distributor.PushKeysToProxyServer(proxy_server, payload)
+
+    self.assertEqual(mock_request.call_count, 1)
+    self.assertEqual(mock_request.call_args[1]['body'], FAKE_KEY_STRING)
+    self.assertTrue('content-encoding' not in
+                    mock_request.call_args[1]['headers'])
+    self.assertEqual(proxy_server.accepts_gzip, None)
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerGzipUnsupported(self, mock_request):
+    """Test a proxy server refusing gzip is sent the plain body instead."""
+    unsupported_response = MagicMock()
+    unsupported_response.status = 415
+    ok_response = MagicMock()
+    ok_response.status = 200
+    mock_request.side_effect = [(unsupported_response, ''), (ok_response, '')]
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+    proxy_server = GetFakeProxyServer()
+    proxy_server.accepts_gzip = True
+
+    result = key_distributor.PushKeysToProxyServer(proxy_server, payload)
+
+    self.assertEqual(result['status'], 200)
+    self.assertEqual(proxy_server.accepts_gzip, False)
+    self.assertEqual(mock_request.call_count, 2)
+    self.assertEqual(mock_request.call_args[1]['body'], FAKE_KEY_STRING)
+    self.assertTrue('content-encoding' not in
+                    mock_request.call_args[1]['headers'])
+
+  def testGzipCompress(self):
+    """Test compressed data decompresses back to the original."""
+    compressed = key_distributor.GzipCompress(u'ssh-rsa abc a@b.com\n' * 100)
+
+    self.assertTrue(len(compressed) < 100)
+    self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+                     'ssh-rsa abc a@b.com\n' * 100)
+    self.assertEqual(compressed, key_distributor.GzipCompress(
+        'ssh-rsa abc a@b.com\n' * 100))
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerTimeout(self, mock_request):
+    """Test an unreachable proxy server is reported rather than raised."""
+    mock_request.side_effect = socket.timeout('timed out')
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+    key_distributor.CONNECTION_POOL.CloseAll()
+
+    result = key_distributor.PushKeysToProxyServer(GetFakeProxyServer(),
+                                                   payload)
+
+    self.assertEqual(result['status'], None)
+    self.assertEqual(
+        key_distributor.CONNECTION_POOL.GetIdleCount(FAKE_POOL_KEY), 0)
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerReusesConnection(self, mock_request):
+    """Test pushes to the same proxy server share one pooled connection."""
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, ''
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+    key_distributor.CONNECTION_POOL.CloseAll()
+
+    key_distributor.PushKeysToProxyServer(GetFakeProxyServer(), payload)
+    key_distributor.PushKeysToProxyServer(GetFakeProxyServer(), payload)
+
+    self.assertEqual(mock_request.call_count, 2)
+    self.assertEqual(
+        key_distributor.CONNECTION_POOL.GetIdleCount(FAKE_POOL_KEY), 1)
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerPinsFingerprint(self, mock_request):
+    """Test the push only connects to the proxy's pinned certificate."""
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, ''
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+
+    key_distributor.PushKeysToProxyServer(GetFakeProxyServer(), payload)
+
+    connection_type = mock_request.call_args[1]['connection_type']
+    connection = connection_type(FAKE_IP_ADDRESS, timeout=1)
+    self.assertTrue(isinstance(connection,
+                               pinned_connection.PinnedHTTPSConnection))
+    self.assertEqual(connection.fingerprint, 'ab' * 32)
+
+  @patch('httplib2.Http.request')
+  def testPushKeysToProxyServerWithoutFingerprint(self, mock_request):
+    """Test keys are never sent to a proxy without a fingerprint to pin."""
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+    proxy_server = GetFakeProxyServer()
+    proxy_server.fingerprint = None
+
+    result = key_distributor.PushKeysToProxyServer(proxy_server, payload)
+
+    self.assertEqual(result['status'], None)
+    mock_request.assert_not_called()
+
+  @patch('key_distributor.PushKeysToProxyServer')
+  def testPushKeysToProxyServers(self, mock_push):
+    """Test each proxy server is sent its own payload."""
+    proxy_servers = [GetFakeProxyServer(), GetFakeProxyServer()]
+    payloads = [{'version': 1}, {'version': 2}]
+    mock_push.return_value = OK_RESULT
+
+    results = key_distributor.PushKeysToProxyServers(proxy_servers, payloads)
+
+    self.assertEqual(results, [OK_RESULT, OK_RESULT])
+    self.assertEqual(mock_push.call_count, len(proxy_servers))
+    mock_push.assert_any_call(proxy_servers[0], payloads[0])
+    mock_push.assert_any_call(proxy_servers[1], payloads[1])
+
+  def testGetOutOfDateProxyServers(self):
+    """Test only proxy servers at a different key set version are returned."""
+    up_to_date = GetFakeProxyServer()
+    up_to_date.key_set_version = 5
+    out_of_date = GetFakeProxyServer()
+    out_of_date.key_set_version = 4
+    never_updated = GetFakeProxyServer()
+
+    proxy_servers = key_distributor.GetOutOfDateProxyServers(
+        [up_to_date, out_of_date, never_updated], 5)
+
+    self.assertEqual(proxy_servers, [out_of_date, never_updated])
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeKeys(self, mock_push):
+    """Test each proxy is sent a delta if possible and a snapshot if not."""
+    KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    version = KeyChange.Record(['ssh-rsa c c@d.com'], ['ssh-rsa a a@b.com'])
+    up_to_date = GetFakeProxyServer()
+    up_to_date.key_set_version = version
+    behind = GetFakeProxyServer()
+    behind.key_set_version = version - 1
+    never_updated = GetFakeProxyServer()
+    unreachable = GetFakeProxyServer()
+    mock_push.return_value = [OK_RESULT, OK_RESULT, FAILED_RESULT]
+    mock_make_key_string = MagicMock(return_value=FAKE_KEY_STRING)
+
+    updated = key_distributor.DistributeKeys(
+        [up_to_date, behind, never_updated, unreachable], version,
+        mock_make_key_string)
+
+    snapshot = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, version)
+    delta = key_distributor.MakeDeltaPayload(
+        ['ssh-rsa c c@d.com'], ['ssh-rsa a a@b.com'], version - 1, version)
+    mock_push.assert_called_once_with([behind, never_updated, unreachable],
+                                      [delta, snapshot, snapshot])
+    mock_make_key_string.assert_called_once_with()
+    self.assertEqual(updated, [behind, never_updated])
+    self.assertEqual(behind.key.get().key_set_version, version)
+    self.assertEqual(never_updated.key.get().key_set_version, version)
+    self.assertEqual(unreachable.key.get().key_set_version, None)
+    self.assertEqual(unreachable.consecutive_distribution_failures, 1)
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeKeysKeepsWritesDuringPush(self, mock_push):
+    """Test a push only saves its own fields over writes made meanwhile."""
+    version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    proxy_server = GetFakeProxyServer()
+    heartbeat = datetime.datetime(2016, 1, 1)
+
+    def _PushWhileWritten(proxy_servers, payloads):
+      """Record a health check and a heartbeat during the push."""
+      # pylint: disable=unused-argument
+      stored = proxy_server.key.get(use_cache=False)
+      stored.health_rtt = 0.25
+      stored.last_heartbeat = heartbeat
+      stored.put()
+      return [OK_RESULT]
+
+    mock_push.side_effect = _PushWhileWritten
+
+    key_distributor.DistributeKeys([proxy_server], version,
+                                   MagicMock(return_value=FAKE_KEY_STRING))
+
+    stored = proxy_server.key.get(use_cache=False)
+    self.assertEqual(stored.key_set_version, version)
+    self.assertEqual(stored.health_rtt, 0.25)
+    self.assertEqual(stored.last_heartbeat, heartbeat)
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeKeysEditedDuringPush(self, mock_push):
+    """Test a push is not saved for a proxy server moved meanwhile."""
+    version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    proxy_server = GetFakeProxyServer()
+
+    def _PushWhileEdited(proxy_servers, payloads):
+      """Give the proxy server a new fingerprint during the push."""
+      # pylint: disable=unused-argument
+      stored = proxy_server.key.get(use_cache=False)
+      stored.fingerprint = 'cd' * 32
+      stored.put()
+      return [OK_RESULT]
+
+    mock_push.side_effect = _PushWhileEdited
+
+    key_distributor.DistributeKeys([proxy_server], version,
+                                   MagicMock(return_value=FAKE_KEY_STRING))
+
+    stored = proxy_server.key.get(use_cache=False)
+    self.assertEqual(stored.fingerprint, 'cd' * 32)
+    self.assertEqual(stored.key_set_version, None)
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeKeysWithoutDeltaSupport(self, mock_push):
+    """Test a proxy server rejecting a delta is sent the snapshot instead."""
+    version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    old_proxy_server = GetFakeProxyServer()
+    old_proxy_server.key_set_version = version - 1
+    mock_push.side_effect = [[{'status': 405, 'latency': 0.1}], [OK_RESULT]]
+    mock_make_key_string = MagicMock(return_value=FAKE_KEY_STRING)
+
+    updated = key_distributor.DistributeKeys([old_proxy_server], version,
+                                             mock_make_key_string)
+
+    snapshot = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, version)
+    mock_push.assert_called_with([old_proxy_server], [snapshot])
+    self.assertEqual(updated, [old_proxy_server])
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeKeysOverSsh(self, mock_push):
+    """Test a proxy server taking keys over ssh is always sent a snapshot."""
+    version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    ssh_proxy_server = GetFakeProxyServer()
+    ssh_proxy_server.key_set_version = version - 1
+    ssh_proxy_server.delivery_method = ProxyServer.SSH_DELIVERY
+    mock_push.return_value = [OK_RESULT]
+
+    key_distributor.DistributeKeys([ssh_proxy_server], version,
+                                   MagicMock(return_value=FAKE_KEY_STRING))
+
+    snapshot = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, version)
+    mock_push.assert_called_once_with([ssh_proxy_server], [snapshot])
+
+  def testGetUnrevokedProxyServers(self):
+    """Test proxy servers with the key set or its revocations are skipped."""
+    up_to_date = GetFakeProxyServer()
+    up_to_date.key_set_version = 5
+    revoked = GetFakeProxyServer()
+    revoked.key_set_version = 4
+    revoked.revoked_key_set_version = 5
+    unrevoked = GetFakeProxyServer()
+    unrevoked.key_set_version = 4
+    unrevoked.revoked_key_set_version = 4
+
+    proxy_servers = key_distributor.GetUnrevokedProxyServers(
+        [up_to_date, revoked, unrevoked], 5)
+
+    self.assertEqual(proxy_servers, [unrevoked])
+
+  def testGroupByRelay(self):
+    """Test peers are grouped under their relay, and relays never chain."""
+    direct = ProxyServer(id=1)
+    relay = ProxyServer(id=2)
+    peer = ProxyServer(id=3, relay_id=2)
+    chained = ProxyServer(id=4, relay_id=3)
+    orphan = ProxyServer(id=5, relay_id=99)
+
+    groups = key_distributor.GroupByRelay(
+        [direct, relay, peer, chained, orphan])
+
+    self.assertEqual(groups, [(direct, []), (relay, [peer]), (chained, []),
+                              (orphan, [])])
+
+  def testGetRelayConvergence(self):
+    """Test each relay's subtree is counted against the current version."""
+    relay = ProxyServer(id=1, key_set_version=3)
+    peers = [ProxyServer(id=2, relay_id=1, key_set_version=3),
+             ProxyServer(id=3, relay_id=1, key_set_version=2)]
+    direct = ProxyServer(id=4)
+
+    convergence = key_distributor.GetRelayConvergence(
+        [relay, direct] + peers, 3)
+
+    self.assertEqual(convergence, {1: (2, 3)})
+
+  def testMakeRelayPayload(self):
+    """Test the relay payload lists its peers that can be pinned."""
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+    peer = GetFakeProxyServer()
+    unpinnable_peer = GetFakeProxyServer()
+    unpinnable_peer.fingerprint = None
+
+    relay_payload = key_distributor.MakeRelayPayload(payload,
+                                                     [peer, unpinnable_peer])
+
+    self.assertEqual(relay_payload['relay_peers'],
+                     ['%s#%s' % (FAKE_IP_ADDRESS, 'ab' * 32)])
+    self.assertEqual(relay_payload['body'], FAKE_KEY_STRING)
+    self.assertFalse('relay_peers' in payload)
+
+  @patch('httplib2.Http.request')
+  def testSendRelayPayload(self, mock_request):
+    """Test a relay is told its peers and its report of them is read."""
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, '{"1.1.1.1": 200}'
+    payload = key_distributor.MakeRelayPayload(
+        key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3),
+        [GetFakeProxyServer()])
+
+    # pylint: disable=protected-access
+    result = key_distributor._SendPayload(GetFakeProxyServer(), payload,
+                                          False)
+
+    self.assertEqual(result['relay_statuses'], {'1.1.1.1': 200})
+    headers = mock_request.call_args[1]['headers']
+    self.assertEqual(headers[key_distributor.RELAY_PEERS_HEADER],
+                     '%s#%s' % (FAKE_IP_ADDRESS, 'ab' * 32))
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  @patch('key_distributor.PushKeysToProxyServer')
+  def testDistributeKeysThroughRelay(self, mock_push, mock_push_many):
+    """Test peers the relay reached are not pushed to by the app."""
+    version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    relay = GetFakeProxyServer()
+    relay.key_set_version = version - 1
+    relayed_peer = GetFakeProxyServer()
+    relayed_peer.ip_address = '1.1.1.1'
+    missed_peer = GetFakeProxyServer()
+    missed_peer.ip_address = '2.2.2.2'
+    mock_push.return_value = {'status': 200, 'latency': 0.5,
+                              'relay_statuses': {'1.1.1.1': 200,
+                                                 '2.2.2.2': 500}}
+    mock_push_many.return_value = [OK_RESULT]
+
+    updated = key_distributor.DistributeKeysThroughRelay(
+        relay, [relayed_peer, missed_peer], version,
+        MagicMock(return_value=FAKE_KEY_STRING))
+
+    delta = key_distributor.MakeDeltaPayload(['ssh-rsa a a@b.com'], [],
+                                             version - 1, version)
+    mock_push.assert_called_once_with(
+        relay, key_distributor.MakeRelayPayload(
+            delta, [relayed_peer, missed_peer]))
+    snapshot = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, version)
+    mock_push_many.assert_called_once_with([missed_peer], [snapshot])
+    self.assertEqual(updated, [relay, relayed_peer, missed_peer])
+    self.assertEqual(relay.key.get().key_set_version, version)
+    self.assertEqual(relayed_peer.key.get().key_set_version, version)
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  @patch('key_distributor.PushKeysToProxyServer')
+  def testDistributeKeysThroughUnreachableRelay(self, mock_push,
+                                                mock_push_many):
+    """Test every peer is pushed to directly when its relay is down."""
+    relay = GetFakeProxyServer()
+    peers = [GetFakeProxyServer(), GetFakeProxyServer()]
+    mock_push.return_value = FAILED_RESULT
+    mock_push_many.return_value = [OK_RESULT, OK_RESULT]
+
+    updated = key_distributor.DistributeKeysThroughRelay(
+        relay, peers, 0, MagicMock(return_value=FAKE_KEY_STRING))
+
+    mock_push_many.assert_called_once_with(peers, ANY)
+    self.assertEqual(updated, peers)
+    self.assertEqual(relay.consecutive_distribution_failures, 1)
+
+  @patch('key_distributor.ProbeProxyServer')
+  @patch('key_distributor.PushKeysToProxyServers')
+  @patch('key_distributor.PushKeysToProxyServer')
+  def testDistributeKeysThroughOpenRelay(self, mock_push, mock_push_many,
+                                         mock_probe):
+    """Test a relay whose circuit is open is only probed."""
+    relay = GetFakeProxyServer()
+    relay.circuit_state = ProxyServer.CIRCUIT_OPEN
+    peers = [GetFakeProxyServer(), GetFakeProxyServer()]
+    mock_probe.return_value = FAILED_RESULT
+    mock_push_many.return_value = [OK_RESULT, OK_RESULT]
+
+    updated = key_distributor.DistributeKeysThroughRelay(
+        relay, peers, 0, MagicMock(return_value=FAKE_KEY_STRING))
+
+    mock_push.assert_not_called()
+    mock_push_many.assert_called_once_with(peers, ANY)
+    self.assertEqual(updated, peers)
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeRevocations(self, mock_push):
+    """Test only the removed keys are sent, leaving the additions behind."""
+    base_version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    KeyChange.Record(['ssh-rsa n%d n@b.com' % n for n in range(100)], [])
+    version = KeyChange.Record([], ['ssh-rsa a a@b.com'])
+    behind = GetFakeProxyServer()
+    behind.key_set_version = base_version
+    unreachable = GetFakeProxyServer()
+    unreachable.key_set_version = base_version
+    mock_push.return_value = [OK_RESULT, FAILED_RESULT]
+    mock_make_key_string = MagicMock()
+
+    revoked = key_distributor.DistributeRevocations(
+        [behind, unreachable], version, mock_make_key_string)
+
+    revocation = key_distributor.MakeRevocationPayload(['ssh-rsa a a@b.com'],
+                                                       base_version)
+    self.assertEqual(revocation['body'], '-ssh-rsa a a@b.com\n')
+    self.assertEqual(revocation['version'], base_version)
+    mock_push.assert_called_once_with([behind, unreachable],
+                                      [revocation, revocation])
+    mock_make_key_string.assert_not_called()
+    self.assertEqual(revoked, [behind])
+    saved = behind.key.get()
+    self.assertEqual(saved.key_set_version, base_version)
+    self.assertEqual(saved.revoked_key_set_version, version)
+    self.assertEqual(unreachable.key.get().revoked_key_set_version, None)
+    self.assertEqual(unreachable.consecutive_distribution_failures, 1)
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeRevocationsNothingRevoked(self, mock_push):
+    """Test a proxy server is not pushed to when nothing was revoked."""
+    base_version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    version = KeyChange.Record(['ssh-rsa c c@d.com'], [])
+    behind = GetFakeProxyServer()
+    behind.key_set_version = base_version
+    mock_push.return_value = []
+
+    revoked = key_distributor.DistributeRevocations([behind], version,
+                                                    MagicMock())
+
+    mock_push.assert_called_once_with([], [])
+    self.assertEqual(revoked, [behind])
+    self.assertEqual(behind.key.get().revoked_key_set_version, version)
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeRevocationsFallsBackToFullDistribution(self, mock_push):
+    """Test proxy servers that can not take revocations alone get it all."""
+    base_version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    version = KeyChange.Record([], ['ssh-rsa a a@b.com'])
+    old_proxy_server = GetFakeProxyServer()
+    old_proxy_server.key_set_version = base_version
+    never_updated = GetFakeProxyServer()
+    ssh_proxy_server = GetFakeProxyServer()
+    ssh_proxy_server.key_set_version = base_version
+    ssh_proxy_server.delivery_method = ProxyServer.SSH_DELIVERY
+    mock_push.side_effect = [[{'status': 405, 'latency': 0.1}], [OK_RESULT],
+                             [OK_RESULT, OK_RESULT]]
+
+    revoked = key_distributor.DistributeRevocations(
+        [old_proxy_server, never_updated, ssh_proxy_server], version,
+        MagicMock(return_value=FAKE_KEY_STRING))
+
+    snapshot = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, version)
+    self.assertEqual(mock_push.call_count, 3)
+    mock_push.assert_any_call([old_proxy_server], [snapshot])
+    mock_push.assert_called_with([never_updated, ssh_proxy_server],
+                                 [snapshot, snapshot])
+    self.assertEqual(revoked, [old_proxy_server, never_updated,
+                               ssh_proxy_server])
+    self.assertEqual(old_proxy_server.key.get().key_set_version, version)
+
+  @patch('ssh_distributor.PushKeyString')
+  def testPushKeysToProxyServerOverSsh(self, mock_push_key_string):
+    """Test a proxy server taking keys over ssh is not pushed to by https."""
+    proxy_server = GetFakeProxyServer()
+    proxy_server.delivery_method = ProxyServer.SSH_DELIVERY
+    mock_push_key_string.return_value = OK_RESULT
+    payload = key_distributor.MakeSnapshotPayload(FAKE_KEY_STRING, 3)
+
+    result = key_distributor.PushKeysToProxyServer(proxy_server, payload)
+
+    self.assertEqual(result, OK_RESULT)
+    mock_push_key_string.assert_called_once_with(proxy_server,
+                                                 FAKE_KEY_STRING)
+
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeKeysNothingToDo(self, mock_push):
+    """Test the key string is never built when every proxy is up to date."""
+    up_to_date = GetFakeProxyServer()
+    up_to_date.key_set_version = 0
+    mock_push.return_value = []
+    mock_make_key_string = MagicMock()
+
+    updated = key_distributor.DistributeKeys([up_to_date], 0,
+                                             mock_make_key_string)
+
+    mock_make_key_string.assert_not_called()
+    self.assertEqual(updated, [])
+
+  def testRecordDistributionResultSuccess(self):
+    """Test a success saves the version and latency and clears failures."""
+    proxy_server = GetFakeProxyServer()
+    proxy_server.consecutive_distribution_failures = 3
+
+    accepted = key_distributor.RecordDistributionResult(proxy_server,
+                                                        OK_RESULT, 7)
+
+    self.assertTrue(accepted)
+    self.assertEqual(proxy_server.key_set_version, 7)
+    self.assertEqual(proxy_server.last_distribution_latency, 0.5)
+    self.assertNotEqual(proxy_server.last_distribution_success, None)
+    self.assertEqual(proxy_server.consecutive_distribution_failures, 0)
+
+  def testRecordDistributionResultFailure(self):
+    """Test a failure counts up the consecutive failures, tripping the circuit.
+    """
+    proxy_server = GetFakeProxyServer()
+    proxy_server.key_set_version = 6
+    proxy_server.consecutive_distribution_failures = 3
+
+    accepted = key_distributor.RecordDistributionResult(proxy_server,
+                                                        FAILED_RESULT, 7)
+
+    self.assertFalse(accepted)
+    self.assertEqual(proxy_server.key_set_version, 6)
+    self.assertEqual(proxy_server.last_distribution_success, None)
+    self.assertEqual(proxy_server.consecutive_distribution_failures, 4)
+    self.assertEqual(proxy_server.circuit_state, ProxyServer.CIRCUIT_OPEN)
+    self.assertNotEqual(proxy_server.circuit_opened, None)
+
+  def testRecordPushFailureTripsCircuit(self):
+    """Test the circuit opens only once enough pushes fail in a row."""
+    proxy_server = GetFakeProxyServer()
+
+    for _ in range(key_distributor.CIRCUIT_FAILURE_THRESHOLD - 1):
+      key_distributor.RecordPushFailure(proxy_server)
+    self.assertEqual(proxy_server.circuit_state, ProxyServer.CIRCUIT_CLOSED)
+
+    key_distributor.RecordPushFailure(proxy_server)
+    self.assertEqual(proxy_server.circuit_state, ProxyServer.CIRCUIT_OPEN)
+
+  def testRecordDistributionResultHalfOpen(self):
+    """Test a half open circuit's trial push closes or reopens it."""
+    accepted = GetFakeProxyServer()
+    accepted.circuit_state = ProxyServer.CIRCUIT_HALF_OPEN
+    rejected = GetFakeProxyServer()
+    rejected.circuit_state = ProxyServer.CIRCUIT_HALF_OPEN
+
+    key_distributor.RecordDistributionResult(accepted, OK_RESULT, 7)
+    key_distributor.RecordDistributionResult(rejected, FAILED_RESULT, 7)
+
+    self.assertEqual(accepted.circuit_state, ProxyServer.CIRCUIT_CLOSED)
+    self.assertEqual(rejected.circuit_state, ProxyServer.CIRCUIT_OPEN)
+
+  @patch('key_distributor.ProbeProxyServer')
+  def testAllowPushes(self, mock_probe):
+    """Test open circuits are probed and half opened if they answer."""
+    closed = GetFakeProxyServer()
+    answering = ProxyServer(ip_address='answering',
+                            circuit_state=ProxyServer.CIRCUIT_OPEN)
+    down = ProxyServer(ip_address='down',
+                       circuit_state=ProxyServer.CIRCUIT_OPEN)
+    mock_probe.side_effect = lambda proxy_server: (
+        dict(OK_RESULT, accepts_gzip=True) if proxy_server is answering
+        else FAILED_RESULT)
+
+    allowed = key_distributor.AllowPushes([closed, answering, down])
+
+    self.assertEqual(allowed, [closed, answering])
+    self.assertEqual(answering.circuit_state, ProxyServer.CIRCUIT_HALF_OPEN)
+    self.assertEqual(answering.accepts_gzip, True)
+    self.assertEqual(down.accepts_gzip, None)
+    self.assertEqual(down.circuit_state, ProxyServer.CIRCUIT_OPEN)
+    self.assertEqual(mock_probe.call_count, 2)
+
+  @patch('key_distributor.ProbeProxyServer')
+  @patch('key_distributor.PushKeysToProxyServers')
+  def testDistributeKeysOpenCircuit(self, mock_push, mock_probe):
+    """Test a proxy server whose circuit is open only costs a probe."""
+    version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    down = GetFakeProxyServer()
+    down.circuit_state = ProxyServer.CIRCUIT_OPEN
+    down.consecutive_distribution_failures = 5
+    up = GetFakeProxyServer()
+    mock_probe.return_value = FAILED_RESULT
+    mock_push.return_value = [OK_RESULT]
+
+    updated = key_distributor.DistributeKeys(
+        [down, up], version, MagicMock(return_value=FAKE_KEY_STRING))
+
+    self.assertEqual(updated, [up])
+    mock_probe.assert_called_once_with(down)
+    mock_push.assert_called_once_with([up], ANY)
+    self.assertEqual(down.key.get().consecutive_distribution_failures, 5)
+
+  def testEnqueueDistributionTasks(self):
+    """Test one task is queued per proxy server, even past a single add."""
+    proxy_servers = [GetFakeProxyServer() for _ in range(150)]
+    ndb.put_multi(proxy_servers)
+
+    key_distributor.EnqueueDistributionTasks(proxy_servers)
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=key_distributor.DISTRIBUTION_QUEUE)
+    self.assertEqual(len(tasks), len(proxy_servers))
+    self.assertEqual(
+        sorted(task.payload for task in tasks),
+        sorted('id=%s' % proxy_server.key.id()
+               for proxy_server in proxy_servers))
+    self.assertEqual(set(task.target for task in tasks),
+                     set([key_distributor.DISTRIBUTION_TARGET]))
+
+  def testEnqueueDistributionTasksRevocationsOnly(self):
+    """Test revocation tasks go on their own queue."""
+    proxy_server = GetFakeProxyServer()
+    proxy_server.put()
+
+    key_distributor.EnqueueDistributionTasks([proxy_server],
+                                             revocations_only=True)
+
+    self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(
+        queue_names=key_distributor.DISTRIBUTION_QUEUE)), 0)
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=key_distributor.REVOCATION_QUEUE)
+    self.assertEqual(len(tasks), 1)
+    self.assertTrue('revocations_only=1' in tasks[0].payload)
+    self.assertTrue('id=%s' % proxy_server.key.id() in tasks[0].payload)
+
+  @patch('time.time')
+  def testScheduleDistributionCoalesces(self, mock_time):
+    """Test changes within one window share one distribution at its end."""
+    mock_time.return_value = 1001.0
+    key_distributor.ScheduleDistribution()
+    mock_time.return_value = 1004.0
+    key_distributor.ScheduleDistribution()
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=key_distributor.DISTRIBUTION_QUEUE)
+    self.assertEqual(len(tasks), 1)
+    self.assertEqual(tasks[0].url, PATHS['cron_proxy_server_distribute_key'])
+    self.assertEqual(tasks[0].method, 'GET')
+    self.assertEqual(tasks[0].eta_posix, 1005.0)
+    self.assertEqual(tasks[0].target, key_distributor.DISTRIBUTION_TARGET)
+
+  @patch('time.time')
+  def testScheduleDistributionNextWindow(self, mock_time):
+    """Test a change in a later window gets its own distribution."""
+    mock_time.return_value = 1001.0
+    key_distributor.ScheduleDistribution()
+    mock_time.return_value = 1006.0
+    key_distributor.ScheduleDistribution()
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=key_distributor.DISTRIBUTION_QUEUE)
+    self.assertEqual(len(tasks), 2)
+
+  @patch('time.time')
+  def testScheduleRevocation(self, mock_time):
+    """Test revocations are sent within a second on the revocation queue."""
+    mock_time.return_value = 1001.2
+    key_distributor.ScheduleRevocation()
+    mock_time.return_value = 1001.7
+    key_distributor.ScheduleRevocation()
+    key_distributor.ScheduleDistribution()
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=key_distributor.REVOCATION_QUEUE)
+    self.assertEqual(len(tasks), 1)
+    self.assertEqual(tasks[0].url, PATHS['cron_proxy_server_distribute_key'] +
+                     '?revocations_only=1')
+    self.assertEqual(tasks[0].eta_posix, 1002.0)
+    self.assertEqual(tasks[0].target, key_distributor.DISTRIBUTION_TARGET)
+    self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(
+        queue_names=key_distributor.DISTRIBUTION_QUEUE)), 1)
+
+  def _AckAfter(self, proxy_server, version, seconds,
+                is_revocation_only=False):
+    """Record an acknowledgement the given time after the version's change."""
+    changed = KeySetConvergence.Get(version).changed
+    DistributionAck(proxy_server_id=proxy_server.key.id(), version=version,
+                    is_revocation_only=is_revocation_only,
+                    acked=changed + datetime.timedelta(seconds=seconds)).put()
+
+  def testUpdateConvergence(self):
+    """Test a version converges when the last proxy server reaches it."""
+    first_version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    second_version = KeyChange.Record(['ssh-rsa c c@d.com'], [])
+    fast = GetFakeProxyServer()
+    slow = GetFakeProxyServer()
+    ndb.put_multi([fast, slow])
+    self._AckAfter(fast, second_version, 1)
+    self._AckAfter(slow, first_version, 4)
+
+    converged = key_distributor.UpdateConvergence([fast, slow])
+
+    self.assertEqual([convergence.key.id() for convergence in converged],
+                     [first_version])
+    self.assertEqual(KeySetConvergence.Get(first_version).latency_seconds,
+                     4.0)
+    self.assertEqual(KeySetConvergence.Get(second_version).converged, None)
+    # Only the acknowledgements a pending version may still need are kept.
+    self.assertEqual(
+        [ack.version for ack in DistributionAck.GetSince(0)],
+        [second_version])
+
+  def testUpdateConvergenceRevocations(self):
+    """Test applying just the revocations only converges revocations."""
+    addition = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    revocation = KeyChange.Record([], ['ssh-rsa a a@b.com'])
+    proxy_server = GetFakeProxyServer()
+    proxy_server.put()
+    self._AckAfter(proxy_server, revocation, 2, is_revocation_only=True)
+
+    converged = key_distributor.UpdateConvergence([proxy_server])
+
+    self.assertEqual([convergence.key.id() for convergence in converged],
+                     [revocation])
+    self.assertEqual(KeySetConvergence.Get(addition).converged, None)
+
+  def testDistributeKeysRecordsAcks(self):
+    """Test every proxy server that accepts keys is recorded as acking."""
+    version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    accepted = GetFakeProxyServer()
+    unreachable = GetFakeProxyServer()
+
+    with patch('key_distributor.PushKeysToProxyServers') as mock_push:
+      mock_push.return_value = [OK_RESULT, FAILED_RESULT]
+      key_distributor.DistributeKeys([accepted, unreachable], version,
+                                     MagicMock(return_value=FAKE_KEY_STRING))
+
+    acks = DistributionAck.GetSince(version)
+    self.assertEqual([ack.proxy_server_id for ack in acks],
+                     [accepted.key.id()])
+    self.assertFalse(acks[0].is_revocation_only)
+
+  def testGetPercentile(self):
+    """Test percentiles are taken by the nearest rank."""
+    values = range(1, 101)
+
+    self.assertEqual(key_distributor.GetPercentile(values, 50), 50)
+    self.assertEqual(key_distributor.GetPercentile(values, 99), 99)
+    self.assertEqual(key_distributor.GetPercentile([3.0], 99), 3.0)
+    self.assertEqual(key_distributor.GetPercentile([], 50), None)
+
+  def testGetConvergenceStats(self):
+    """Test revocations are summarized on their own as well."""
+    convergences = [
+        KeySetConvergence(converged=datetime.datetime.utcnow(),
+                          latency_seconds=10.0),
+        KeySetConvergence(converged=datetime.datetime.utcnow(),
+                          latency_seconds=2.0, is_revocation=True),
+        KeySetConvergence(),
+    ]
+
+    stats = key_distributor.GetConvergenceStats(convergences)
+
+    self.assertEqual(stats['converged_count'], 2)
+    self.assertEqual(stats['pending_count'], 1)
+    self.assertEqual(stats['p50_seconds'], 2.0)
+    self.assertEqual(stats['p99_seconds'], 10.0)
+    self.assertEqual(stats['revocation_p99_seconds'], 2.0)
+
+  def testPruneKeyChanges(self):
+    """Test only changes every proxy server has accepted are deleted."""
+    for _ in range(4):
+      version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    behind = GetFakeProxyServer()
+    behind.key_set_version = 2
+    never_updated = GetFakeProxyServer()
+
+    key_distributor.PruneKeyChanges([behind, never_updated], version)
+
+    self.assertEqual(KeyChange.GetCount(), 2)
+    self.assertEqual(KeyChange.GetDelta(2, version),
+                     (['ssh-rsa a a@b.com'], []))
+
+  @patch('time.sleep')
+  def testWaitForNewVersionChanged(self, mock_sleep):
+    """Test waiting returns at once when the version already differs."""
+    version = KeyChange.Record(['ssh-rsa a a@b.com'], [])
+
+    self.assertEqual(key_distributor.WaitForNewVersion(version - 1), version)
+    self.assertEqual(key_distributor.WaitForNewVersion(None), version)
+    mock_sleep.assert_not_called()
+
+  @patch('time.sleep')
+  def testWaitForNewVersionSeesChange(self, mock_sleep):
+    """Test a change recorded while waiting ends the wait."""
+    mock_sleep.side_effect = lambda _: KeyChange.Record(['ssh-rsa a a@b'], [])
+
+    self.assertEqual(key_distributor.WaitForNewVersion(0), 1)
+    self.assertEqual(mock_sleep.call_count, 1)
+
+  @patch('time.sleep')
+  @patch('time.time')
+  def testWaitForNewVersionTimeout(self, mock_time, mock_sleep):
+    """Test waiting gives up after the timeout if nothing changes."""
+    mock_time.side_effect = [1000.0, 1001.0, 1001.5, 1002.5]
+
+    self.assertEqual(key_distributor.WaitForNewVersion(0, 2), None)
+    self.assertEqual(mock_sleep.call_count, 2)
+
+  @patch('httplib2.Http.request')
+  def testProbeProxyServer(self, mock_request):
+    """Test a proxy server is probed with a HEAD request for its keys."""
+    mock_request.return_value = (httplib2.Response({'status': 405}), '')
+
+    result = key_distributor.ProbeProxyServer(GetFakeProxyServer())
+    key_distributor.PROBE_CONNECTION_POOL.CloseAll()
+
+    self.assertEqual(result['status'], 405)
+    self.assertEqual(result['accepts_gzip'], False)
+    self.assertTrue(key_distributor.IsProbeSuccess(result))
+    args, kwargs = mock_request.call_args
+    self.assertEqual(args[0], 'https://%s/key' % FAKE_IP_ADDRESS)
+    self.assertEqual(kwargs['method'], 'HEAD')
+
+  @patch('httplib2.Http.request')
+  def testProbeProxyServerAcceptEncoding(self, mock_request):
+    """Test a probe reads gzip support from the Accept-Encoding header."""
+    for accept_encoding, accepts_gzip in [('gzip', True),
+                                          ('identity, GZIP;q=0.5', True),
+                                          ('gzip;q=0', False),
+                                          ('deflate', False)]:
+      mock_request.return_value = (httplib2.Response(
+          {'status': 200, 'accept-encoding': accept_encoding}), '')
+
+      result = key_distributor.ProbeProxyServer(GetFakeProxyServer())
+
+      self.assertEqual(result['accepts_gzip'], accepts_gzip)
+    key_distributor.PROBE_CONNECTION_POOL.CloseAll()
+
+  def testRecordProbeEncoding(self):
+    """Test only a successful probe changes whether gzip is accepted."""
+    proxy_server = GetFakeProxyServer()
+
+    key_distributor.RecordProbeEncoding(proxy_server, FAILED_RESULT)
+    self.assertEqual(proxy_server.accepts_gzip, None)
+
+    key_distributor.RecordProbeEncoding(
+        proxy_server, {'status': 200, 'latency': 0.1, 'accepts_gzip': True})
+    self.assertEqual(proxy_server.accepts_gzip, True)
+
+    key_distributor.RecordProbeEncoding(proxy_server, None)
+    self.assertEqual(proxy_server.accepts_gzip, True)
+
+  @patch('httplib2.Http.request')
+  def testProbeProxyServerUnreachable(self, mock_request):
+    """Test an unreachable proxy server fails its probe."""
+    mock_request.side_effect = socket.timeout()
+
+    result = key_distributor.ProbeProxyServer(GetFakeProxyServer())
+
+    self.assertEqual(result['status'], None)
+    self.assertFalse(key_distributor.IsProbeSuccess(result))
+    self.assertFalse(key_distributor.IsProbeSuccess({'status': 503,
+                                                    'latency': 0.1}))
+
+  @patch('ssh_distributor.ProbeSshPort')
+  def testProbeProxyServerOverSsh(self, mock_probe_ssh_port):
+    """Test a proxy server taking its keys over ssh has its port probed."""
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.delivery_method = ProxyServer.SSH_DELIVERY
+    mock_probe_ssh_port.return_value = OK_RESULT
+
+    result = key_distributor.ProbeProxyServer(fake_proxy_server)
+
+    self.assertEqual(result, OK_RESULT)
+    mock_probe_ssh_port.assert_called_once_with(
+        fake_proxy_server, key_distributor.PROBE_TIMEOUT_SECONDS)
+
+  def testOrderByHealth(self):
+    """Test distribution reaches healthy, fast proxy servers first."""
+    slow = ProxyServer(name='slow', health_error_rate=0.0, health_rtt=0.5)
+    fast = ProxyServer(name='fast', health_error_rate=0.0, health_rtt=0.01)
+    failing = ProxyServer(name='failing', health_error_rate=0.8)
+    unchecked = ProxyServer(name='unchecked')
+
+    ordered = key_distributor.OrderByHealth([failing, slow, unchecked, fast])
+
+    self.assertEqual([proxy_server.name for proxy_server in ordered],
+                     ['unchecked', 'fast', 'slow', 'failing'])
+
+
+def GetFakeProxyServer():
+  """Return a saved proxy server with mocked values."""
+  proxy_server = ProxyServer(ip_address=FAKE_IP_ADDRESS,
+                             fingerprint=FAKE_FINGERPRINT)
+  proxy_server.put()
+  return proxy_server
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+"""The module for https connections pinned to a certificate fingerprint.
+
+Proxy servers use self-signed certificates, so rather than validating them
+against certificate authorities the certificate a proxy server presents is
+checked against the fingerprint stored for it.
+"""
+
+import hashlib
+import hmac
+import re
+
+import httplib2
+
+
+# The hash used to make a fingerprint, by its length in hex digits.
+HASH_FUNCTIONS_BY_LENGTH = {
+    32: hashlib.md5,
+    40: hashlib.sha1,
+    64: hashlib.sha256,
+}
+
+
+class FingerprintMismatchError(httplib2.HttpLib2Error):
+
+  """The server presented a certificate other than the pinned one."""
+
+
+def NormalizeFingerprint(fingerprint):
+  """Get a fingerprint as bare lowercase hex if it can be pinned.
+
+  Args:
+    fingerprint: A hex certificate fingerprint, optionally separated by colons
+                 or spaces, such as the output of openssl x509 -fingerprint.
+
+  Returns:
+    The lowercase hex digits of the fingerprint, or None if it is not an md5,
+    sha1 or sha256 hex digest.
+  """
+  if not fingerprint:
+    return None
+  hex_digits = re.sub(r'[:\s]', '', fingerprint).lower()
+  if not re.match(r'^[0-9a-f]+$', hex_digits):
+    return None
+  if len(hex_digits) not in HASH_FUNCTIONS_BY_LENGTH:
+    return None
+  # Fingerprints read from the datastore are unicode, which compare_digest
+  # cannot compare with the str of the certificate's fingerprint.
+  return str(hex_digits)
+
+
+def GetCertificateFingerprint(der_certificate, fingerprint_length):
+  """Get the fingerprint of a certificate using the hash of the given length.
+
+  Args:
+    der_certificate: The certificate in binary DER form.
+    fingerprint_length: How many hex digits the fingerprint should have.
+
+  Returns:
+    The lowercase hex fingerprint.
+  """
+  hash_function = HASH_FUNCTIONS_BY_LENGTH[fingerprint_length]
+  return hash_function(der_certificate).hexdigest()
+
+
+class PinnedHTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+
+  """An https connection that only talks to a server with the pinned cert.
+
+  The pin is checked on every connect, including when httplib2 reconnects a
+  kept-alive connection, before any request is sent.  It is passed to
+  httplib2 with functools.partial as the connection_type of a request.
+  """
+
+  def __init__(self, host, fingerprint=None, **kwargs):
+    """Create the connection.
+
+    Args:
+      host: The host (and optional port) to connect to.
+      fingerprint: The certificate fingerprint the server must present.
+      **kwargs: The other arguments httplib2 passes a connection type.
+    """
+    httplib2.HTTPSConnectionWithTimeout.__init__(self, host, **kwargs)
+    self.fingerprint = NormalizeFingerprint(fingerprint)
+
+  def connect(self):
+    """Connect to the host and check it presented the pinned certificate."""
+    httplib2.HTTPSConnectionWithTimeout.connect(self)
+    if self.fingerprint is None:
+      self.close()
+      raise FingerprintMismatchError('No valid fingerprint to pin for %s.' %
+                                     self.host)
+    certificate = self.sock.getpeercert(binary_form=True) or ''
+    actual_fingerprint = GetCertificateFingerprint(certificate,
+                                                   len(self.fingerprint))
+    if not hmac.compare_digest(actual_fingerprint, self.fingerprint):
+      self.close()
+      raise FingerprintMismatchError(
+          'Certificate fingerprint %s of %s does not match the pinned %s.' %
+          (actual_fingerprint, self.host, self.fingerprint))
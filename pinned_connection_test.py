@@ -0,0 +1,100 @@
+"""Test pinned connection module functionality."""
+import hashlib
+import unittest
+
+from mock import MagicMock
+from mock import patch
+
+import httplib2
+import pinned_connection
+
+
+FAKE_HOST = '111.222.333.444'
+FAKE_CERTIFICATE = 'fake der certificate'
+FAKE_SHA256 = hashlib.sha256(FAKE_CERTIFICATE).hexdigest()
+
+
+class PinnedConnectionTest(unittest.TestCase):
+
+  """Test connections are only made to the pinned certificate."""
+
+  def testNormalizeFingerprint(self):
+    """Test fingerprints of each supported hash are accepted."""
+    self.assertEqual(pinned_connection.NormalizeFingerprint('AB:cd' * 8),
+                     'abcd' * 8)
+    self.assertEqual(pinned_connection.NormalizeFingerprint('ab ' * 20),
+                     'ab' * 20)
+    self.assertEqual(pinned_connection.NormalizeFingerprint(FAKE_SHA256),
+                     FAKE_SHA256)
+
+  def testNormalizeFingerprintInvalid(self):
+    """Test fingerprints that can not be pinned are rejected."""
+    self.assertEqual(pinned_connection.NormalizeFingerprint(None), None)
+    self.assertEqual(pinned_connection.NormalizeFingerprint(''), None)
+    self.assertEqual(pinned_connection.NormalizeFingerprint('11:22:33:44'),
+                     None)
+    self.assertEqual(pinned_connection.NormalizeFingerprint('zz' * 32), None)
+
+  def testGetCertificateFingerprint(self):
+    """Test the hash is chosen by the length of the pinned fingerprint."""
+    self.assertEqual(
+        pinned_connection.GetCertificateFingerprint(FAKE_CERTIFICATE, 32),
+        hashlib.md5(FAKE_CERTIFICATE).hexdigest())
+    self.assertEqual(
+        pinned_connection.GetCertificateFingerprint(FAKE_CERTIFICATE, 64),
+        FAKE_SHA256)
+
+  @patch('httplib2.HTTPSConnectionWithTimeout.connect')
+  def testConnectMatchingCertificate(self, mock_connect):
+    """Test a server presenting the pinned certificate is connected to."""
+    connection = pinned_connection.PinnedHTTPSConnection(
+        FAKE_HOST, fingerprint=FAKE_SHA256.upper())
+    connection.sock = MagicMock()
+    connection.sock.getpeercert.return_value = FAKE_CERTIFICATE
+
+    connection.connect()
+
+    mock_connect.assert_called_once_with(connection)
+    connection.sock.getpeercert.assert_called_once_with(binary_form=True)
+    connection.sock.close.assert_not_called()
+
+  @patch('httplib2.HTTPSConnectionWithTimeout.connect')
+  def testConnectUnicodeFingerprint(self, mock_connect):
+    """Test a fingerprint read from the datastore as unicode is pinned."""
+    connection = pinned_connection.PinnedHTTPSConnection(
+        FAKE_HOST, fingerprint=unicode(FAKE_SHA256))
+    connection.sock = MagicMock()
+    connection.sock.getpeercert.return_value = FAKE_CERTIFICATE
+
+    connection.connect()
+
+    mock_connect.assert_called_once_with(connection)
+    connection.sock.close.assert_not_called()
+
+  @patch('httplib2.HTTPSConnectionWithTimeout.connect')
+  def testConnectMismatchedCertificate(self, mock_connect):
+    """Test a server presenting another certificate is disconnected."""
+    connection = pinned_connection.PinnedHTTPSConnection(
+        FAKE_HOST, fingerprint='00' * 32)
+    mock_sock = MagicMock()
+    mock_sock.getpeercert.return_value = FAKE_CERTIFICATE
+    connection.sock = mock_sock
+
+    self.assertRaises(pinned_connection.FingerprintMismatchError,
+                      connection.connect)
+    mock_connect.assert_called_once_with(connection)
+    mock_sock.close.assert_called_once_with()
+    self.assertEqual(connection.sock, None)
+
+  @patch('httplib2.HTTPSConnectionWithTimeout.connect')
+  def testConnectWithoutFingerprint(self, mock_connect):
+    """Test nothing is trusted when there is no valid fingerprint."""
+    connection = pinned_connection.PinnedHTTPSConnection(
+        FAKE_HOST, fingerprint='not a fingerprint')
+    connection.sock = MagicMock()
+
+    self.assertRaises(httplib2.HttpLib2Error, connection.connect)
+    mock_connect.assert_called_once_with(connection)
+
+if __name__ == '__main__':
+  unittest.main()
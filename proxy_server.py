@@ -3,19 +3,34 @@
 import admin
 from appengine_config import JINJA_ENVIRONMENT
 from config import PATHS
+from datastore import KeyBucket
+from datastore import KeySetConvergence
+from datastore import KeySetVersion
+from datastore import ProxyRegistration
 from datastore import ProxyServer
-from datastore import User
-import httplib2
-import logging
+import health_checker
+import json
+import key_distributor
+import pinned_connection
 import webapp2
 import xsrf
 
 
+# How often registered proxy servers are asked to send a heartbeat, so a few
+# can be lost before the heartbeat expires.
+HEARTBEAT_INTERVAL_SECONDS = ProxyServer.HEARTBEAT_TIMEOUT_SECONDS // 3
+
 
 def _RenderProxyServerFormTemplate(proxy_server):
   """Render the form to add or edit a proxy server."""
+  # Only proxy servers pushed to directly over https can relay.
+  relays = [relay for relay in ProxyServer.GetAll()
+            if relay.relay_id is None and
+            relay.delivery_method == ProxyServer.HTTPS_DELIVERY and
+            (proxy_server is None or relay.key != proxy_server.key)]
   template_values = {
       'proxy_server': proxy_server,
+      'relays': relays,
   }
   template = JINJA_ENVIRONMENT.get_template('templates/proxy_server_form.html')
   return template.render(template_values)
@@ -25,33 +40,82 @@ def _RenderListProxyServerTemplate():
   """Render a list of proxy servers."""
   proxy_servers = ProxyServer.GetAll()
   template_values = {
-      'proxy_servers': proxy_servers
+      'proxy_servers': proxy_servers,
+      'proxy_servers_by_id': dict((proxy_server.key.id(), proxy_server)
+                                  for proxy_server in proxy_servers),
+      'relay_convergence': key_distributor.GetRelayConvergence(
+          [proxy_server for proxy_server in proxy_servers
+           if proxy_server.IsAlive()], KeySetVersion.GetCurrent()),
+      'registration_secret': ProxyRegistration.GetOrInsertDefault().secret,
   }
   template = JINJA_ENVIRONMENT.get_template('templates/proxy_server.html')
   return template.render(template_values)
 
 
+def _RenderConvergenceTemplate():
+  """Render how long recent key set versions took to reach every proxy."""
+  convergences = KeySetConvergence.GetRecent()
+  template_values = {
+      'stats': key_distributor.GetConvergenceStats(convergences),
+      'convergences': convergences,
+  }
+  template = JINJA_ENVIRONMENT.get_template('templates/convergence.html')
+  return template.render(template_values)
+
+
 def _MakeKeyString():
   """Generate the key string in open ssh format for pushing to proxy servers.
 
   This key string includes only the public key for each user in order to grant
-  the user access to each proxy server.
+  the user access to each proxy server.  It is read from the key buckets kept
+  up to date as users are written, rather than built from every user.
 
   Returns:
     key_string: A string of users with associated key.
   """
-  users = User.GetAll()
-  key_string = ''
-  ssh_starting_portion = 'ssh-rsa'
-  space = ' '
-  endline = '\n'
-  for user in users:
-    if not user.is_key_revoked:
-      user_string = (ssh_starting_portion + space + user.public_key + space +
-                     user.email + endline)
-      key_string += user_string
+  return KeyBucket.GetKeyString()
+
+
+def _GetRelayId(request):
+  """Get the relay chosen in a proxy server form.
+
+  Args:
+    request: The webapp2 request posting the form.
+
+  Returns:
+    relay_id: The integer id of the relay, or None to push directly.
+  """
+  relay_id = request.get('relay_id')
+  return int(relay_id) if relay_id else None
+
 
-  return key_string
+def _GetRetriable(proxy_servers):
+  """Get the proxy servers a failed distribution task should retry.
+
+  Args:
+    proxy_servers: A list of the proxy servers left out of date by a task.
+
+  Returns:
+    A list of those proxy servers whose circuit is not open.
+  """
+  return [proxy_server for proxy_server in proxy_servers
+          if proxy_server.circuit_state != ProxyServer.CIRCUIT_OPEN]
+
+
+def _GetAuthToken(request):
+  """Get the bearer token a proxy server sent with its request.
+
+  Args:
+    request: The webapp2 request from the proxy server.
+
+  Returns:
+    auth_token: The token from the Authorization header, or None.
+  """
+  scheme, _, auth_token = request.headers.get('Authorization', '').partition(
+      ' ')
+  if scheme.lower() != 'bearer':
+    return None
+  return auth_token.strip()
 
 
 class AddProxyServerHandler(webapp2.RequestHandler):
@@ -73,7 +137,9 @@ class AddProxyServerHandler(webapp2.RequestHandler):
         self.request.get('name'),
         self.request.get('ip_address'),
         self.request.get('ssh_private_key'),
-        self.request.get('fingerprint'))
+        self.request.get('fingerprint'),
+        self.request.get('delivery_method', ProxyServer.HTTPS_DELIVERY),
+        _GetRelayId(self.request))
     self.redirect(PATHS['proxy_server_list'])
 
 
@@ -98,7 +164,9 @@ class EditProxyServerHandler(webapp2.RequestHandler):
         self.request.get('name'),
         self.request.get('ip_address'),
         self.request.get('ssh_private_key'),
-        self.request.get('fingerprint'))
+        self.request.get('fingerprint'),
+        self.request.get('delivery_method', ProxyServer.HTTPS_DELIVERY),
+        _GetRelayId(self.request))
     self.redirect(PATHS['proxy_server_list'])
 
 
@@ -132,6 +200,19 @@ class ListProxyServersHandler(webapp2.RequestHandler):
     self.response.write(_RenderListProxyServerTemplate())
 
 
+class ConvergenceHandler(webapp2.RequestHandler):
+
+  """Handler for reporting how quickly key changes reach the proxy servers."""
+
+  # pylint: disable=too-few-public-methods
+
+  @admin.OAUTH_DECORATOR.oauth_required
+  @admin.RequireAppOrDomainAdmin
+  def get(self):
+    """Display the p50 and p99 convergence latency of recent versions."""
+    self.response.write(_RenderConvergenceTemplate())
+
+
 class DistributeKeyHandler(webapp2.RequestHandler):
 
   """Handler for distributing authorization keys out to each proxy server."""
@@ -140,37 +221,371 @@ class DistributeKeyHandler(webapp2.RequestHandler):
 
   # This handler requires admin login, and is controlled in the app.yaml.
   def get(self):
-    """Send the current users and associated key out to each proxy server.
+    """Queue a task to send the current keys to each out of date proxy server.
+
+    This handler is not intended primarily for a typical user, but for a cron
+    job to periodically trigger.  One task is queued per relay or proxy
+    server pushed to directly, skipping those whose whole subtree is already
+    at the current key set version.  With revocations_only set, only the proxy
+    servers yet to apply the latest revocations get a task, on the
+    revocation queue.  Proxy servers whose heartbeat has expired are skipped,
+    and deleted once it expired long ago.  The healthiest proxy servers are
+    queued first.
+    """
+    proxy_servers = ProxyServer.GetAlive()
+    version = KeySetVersion.GetCurrent()
+    if self.request.get('revocations_only'):
+      key_distributor.EnqueueDistributionTasks(
+          key_distributor.GetUnrevokedProxyServers(proxy_servers, version),
+          revocations_only=True)
+      self.response.write('all done!')
+      return
+    key_distributor.EnqueueDistributionTasks(
+        [proxy_server for proxy_server, peers
+         in key_distributor.GroupByRelay(
+             key_distributor.OrderByHealth(proxy_servers))
+         if key_distributor.GetOutOfDateProxyServers([proxy_server] + peers,
+                                                     version)])
+    key_distributor.PruneKeyChanges(proxy_servers, version)
+    key_distributor.UpdateConvergence(proxy_servers)
+    ProxyServer.DeleteExpired()
+    self.response.write('all done!')
+
+
+class HealthCheckHandler(webapp2.RequestHandler):
+
+  """Handler for checking the health of every proxy server."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler requires admin login, and is controlled in the app.yaml.
+  def get(self):
+    """Probe every live proxy server in parallel and save its health.
 
     This handler is not intended primarily for a typical user, but for a cron
     job to periodically trigger.
     """
-    # TODO(henry): See if we can use threading to parallelize the put requests.
-    key_string = _MakeKeyString()
-    proxy_servers = ProxyServer.GetAll()
-    for proxy_server in proxy_servers:
-      http = httplib2.Http()
-      # TODO(henry): Make the request secure.  The http object
-      # supports add_certificate() method.  http://goo.gl/mjU4Mh
-      # TODO(henry): Increase robustness here, e.g. add exception handling
-      # and retries.
-      response, content = http.request(
-          'http://%s/key' % proxy_server.ip_address,
-          headers={'content-type': 'text/plain'},
-          method='PUT',
-          body=key_string)
-      logging.info('Distributed keys to %s. Response: %s, Content: %s',
-                   proxy_server.ip_address, response.status, content)
+    health_checker.CheckProxyServers(ProxyServer.GetAlive())
     self.response.write('all done!')
 
 
+class DistributeKeyTaskHandler(webapp2.RequestHandler):
+
+  """Handler for distributing authorization keys out to one proxy server."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler requires admin login, and is controlled in the app.yaml.
+  def post(self):
+    """Bring the proxy server with the passed in id up to date.
+
+    This handler is run by the task queue, which retries it with backoff for
+    as long as it responds with an error.  A relay's peers are brought up to
+    date along with it.  With revocations_only set, the proxy server is only
+    sent the keys revoked since its version.  Proxy servers whose circuit is
+    open are not retried, and are probed again by the next cron run.
+    """
+    proxy_server = ProxyServer.Get(int(self.request.get('id')))
+    if proxy_server is None or not proxy_server.IsAlive():
+      # The proxy server was deleted or its heartbeat expired since the task
+      # was queued.
+      return
+    version = KeySetVersion.GetCurrent()
+    if self.request.get('revocations_only'):
+      key_distributor.DistributeRevocations([proxy_server], version,
+                                            _MakeKeyString)
+      if _GetRetriable(key_distributor.GetUnrevokedProxyServers(
+          [proxy_server], version)):
+        self.error(500)
+      return
+    peers = []
+    if proxy_server.relay_id is None:
+      peers = ProxyServer.GetPeers(proxy_server.key.id())
+    key_distributor.DistributeKeysThroughRelay(proxy_server, peers, version,
+                                               _MakeKeyString)
+    if _GetRetriable(key_distributor.GetOutOfDateProxyServers(
+        [proxy_server] + peers, version)):
+      self.error(500)
+
+
+class GetKeysHandler(webapp2.RequestHandler):
+
+  """Handler for proxy servers pulling the current authorized keys."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler is authenticated by each proxy server's token rather than by
+  # login, and is controlled in the app.yaml.
+  def get(self):
+    """Output the current authorized keys to an authenticated proxy server.
+
+    The ETag is the key set version, so a proxy server that is already in
+    sync gets a 304 without the keys being read or sent.  The keys
+    themselves are served from memcache once built for a version, gzip
+    compressed if the proxy server accepts it.
+    """
+    proxy_server = ProxyServer.GetByAuthToken(_GetAuthToken(self.request))
+    if proxy_server is None:
+      self.error(401)
+      return
+
+    version = KeySetVersion.GetCurrent()
+    use_gzip = 'gzip' in self.request.accept_encoding
+    # Each encoding is a different representation, so needs its own ETag.
+    gzip_etag = '%s-gzip' % version
+    self.response.etag = gzip_etag if use_gzip else str(version)
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.headers['Vary'] = 'Accept-Encoding'
+    self.response.headers[key_distributor.KEY_SET_VERSION_HEADER] = str(
+        version)
+    if (str(version) in self.request.if_none_match or
+        gzip_etag in self.request.if_none_match):
+      self.response.status = 304
+      del self.response.headers['Content-Type']
+      return
+
+    self.response.content_type = 'text/plain'
+    if use_gzip:
+      self.response.headers['Content-Encoding'] = 'gzip'
+      self.response.write(
+          key_distributor.GetCachedGzipKeyString(version, _MakeKeyString))
+    else:
+      self.response.write(
+          key_distributor.GetCachedKeyString(version, _MakeKeyString))
+
+
+class GetKeyTreeHandler(webapp2.RequestHandler):
+
+  """Handler for proxy servers comparing their keys against a hash tree."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler is authenticated by each proxy server's token rather than by
+  # login, and is controlled in the app.yaml.
+  def get(self):
+    """Output the digests of one hash tree node and its children.
+
+    A proxy server starts at the root, passing no node, and walks down only
+    into the children whose digests differ from its own, until it reaches
+    the buckets it needs to get again.  See KeyBucket.GetHashTree for how
+    the digests are made.
+    """
+    proxy_server = ProxyServer.GetByAuthToken(_GetAuthToken(self.request))
+    if proxy_server is None:
+      self.error(401)
+      return
+
+    node = self.request.get('node').lower()
+    if len(node) >= KeyBucket.BUCKET_ID_LENGTH:
+      self.error(400)
+      return
+    version = KeySetVersion.GetCurrent()
+    tree = key_distributor.GetCachedHashTree(version, KeyBucket.GetHashTree)
+    if node not in tree:
+      self.error(400)
+      return
+
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.headers[key_distributor.KEY_SET_VERSION_HEADER] = str(
+        version)
+    self.response.content_type = 'application/json'
+    self.response.write(json.dumps({
+        'version': version,
+        'node': node,
+        'digest': tree[node],
+        'children': dict((child, tree[child]) for child
+                         in KeyBucket.GetHashTreeChildren(node)),
+    }))
+
+
+class GetKeyBucketsHandler(webapp2.RequestHandler):
+
+  """Handler for proxy servers getting just the buckets that differ."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler is authenticated by each proxy server's token rather than by
+  # login, and is controlled in the app.yaml.
+  def get(self):
+    """Output the authorized keys in each of the requested buckets.
+
+    The buckets are passed as repeated id parameters.  Each is output as the
+    key string whose sha256 is its digest in the hash tree, which the proxy
+    server replaces its own copy of the bucket with.
+    """
+    proxy_server = ProxyServer.GetByAuthToken(_GetAuthToken(self.request))
+    if proxy_server is None:
+      self.error(401)
+      return
+
+    bucket_ids = sorted(set(bucket_id.lower() for bucket_id
+                            in self.request.get_all('id')))
+    valid_bucket_ids = set(KeyBucket.GetAllBucketIds())
+    if not bucket_ids or not valid_bucket_ids.issuperset(bucket_ids):
+      self.error(400)
+      return
+
+    # The version is read first, so the buckets are never older than it.
+    version = KeySetVersion.GetCurrent()
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.headers[key_distributor.KEY_SET_VERSION_HEADER] = str(
+        version)
+    self.response.content_type = 'application/json'
+    self.response.write(json.dumps({
+        'version': version,
+        'buckets': KeyBucket.GetBucketKeyStrings(bucket_ids),
+    }))
+
+
+class RegisterProxyServerHandler(webapp2.RequestHandler):
+
+  """Handler for proxy servers adding themselves to the fleet."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler is authenticated by the registration secret rather than by
+  # login, and is controlled in the app.yaml.
+  def post(self):
+    """Register the proxy server with the posted address and fingerprint.
+
+    The proxy server presents the registration secret as its bearer token,
+    and is given its own id and token back, along with how often to send a
+    heartbeat.  It is queued to be sent the keys straight away.
+    """
+    if not ProxyRegistration.IsValidSecret(_GetAuthToken(self.request)):
+      self.error(401)
+      return
+
+    ip_address = self.request.get('ip_address')
+    fingerprint = self.request.get('fingerprint')
+    if (not ip_address or
+        pinned_connection.NormalizeFingerprint(fingerprint) is None):
+      self.error(400)
+      return
+    proxy_server = ProxyServer.Register(
+        self.request.get('name', ip_address), ip_address, fingerprint)
+    if proxy_server is None:
+      # The address belongs to a proxy server added by hand.
+      self.error(409)
+      return
+    key_distributor.EnqueueDistributionTasks([proxy_server])
+
+    self.response.content_type = 'application/json'
+    self.response.write(json.dumps({
+        'id': proxy_server.key.id(),
+        'auth_token': proxy_server.auth_token,
+        'heartbeat_interval_seconds': HEARTBEAT_INTERVAL_SECONDS,
+    }))
+
+
+class HeartbeatHandler(webapp2.RequestHandler):
+
+  """Handler for registered proxy servers reporting they are alive."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler is authenticated by each proxy server's token rather than by
+  # login, and is controlled in the app.yaml.
+  def post(self):
+    """Record a heartbeat from the authenticated proxy server.
+
+    A proxy server whose heartbeat expired is alive again from this one.
+    Once it has been deleted its token is no longer valid, and it should
+    register again.  Heartbeats from proxy servers added by hand are
+    ignored, as those are always alive.
+    """
+    proxy_server = ProxyServer.GetByAuthToken(_GetAuthToken(self.request))
+    if proxy_server is None:
+      self.error(401)
+      return
+
+    if proxy_server.last_heartbeat is not None:
+      ProxyServer.RecordHeartbeat(proxy_server)
+    self.response.status = 204
+    del self.response.headers['Content-Type']
+
+
+class DeregisterProxyServerHandler(webapp2.RequestHandler):
+
+  """Handler for registered proxy servers leaving the fleet."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler is authenticated by each proxy server's token rather than by
+  # login, and is controlled in the app.yaml.
+  def post(self):
+    """Delete the authenticated proxy server, such as when scaling in.
+
+    Proxy servers added by hand can only be deleted by an admin.
+    """
+    proxy_server = ProxyServer.GetByAuthToken(_GetAuthToken(self.request))
+    if proxy_server is None:
+      self.error(401)
+      return
+    if proxy_server.last_heartbeat is None:
+      self.error(403)
+      return
+
+    ProxyServer.Delete(proxy_server.key.id())
+    self.response.status = 204
+    del self.response.headers['Content-Type']
+
+
+class WatchKeysHandler(webapp2.RequestHandler):
+
+  """Handler for proxy servers waiting to hear of a new key set version."""
+
+  # pylint: disable=too-few-public-methods
+
+  # This handler is authenticated by each proxy server's token rather than by
+  # login, and is controlled in the app.yaml.
+  def get(self):
+    """Hold the request open until the key set version changes.
+
+    The proxy server passes the version it has.  As soon as the current
+    version differs it is output, and the proxy server should then get the
+    keys.  If nothing changes before the timeout a 204 is returned and the
+    proxy server should simply watch again.
+    """
+    proxy_server = ProxyServer.GetByAuthToken(_GetAuthToken(self.request))
+    if proxy_server is None:
+      self.error(401)
+      return
+
+    try:
+      known_version = int(self.request.get('version'))
+    except ValueError:
+      known_version = None
+    version = key_distributor.WaitForNewVersion(known_version)
+
+    self.response.headers['Cache-Control'] = 'no-cache'
+    if version is None:
+      self.response.status = 204
+      del self.response.headers['Content-Type']
+      return
+    self.response.headers[key_distributor.KEY_SET_VERSION_HEADER] = str(
+        version)
+    self.response.content_type = 'text/plain'
+    self.response.write(str(version))
+
+
 APP = webapp2.WSGIApplication([
     (PATHS['proxy_server_add'], AddProxyServerHandler),
     (PATHS['proxy_server_delete'], DeleteProxyServerHandler),
     (PATHS['proxy_server_edit'], EditProxyServerHandler),
     (PATHS['proxy_server_list'], ListProxyServersHandler),
+    (PATHS['proxy_server_convergence'], ConvergenceHandler),
+    (PATHS['proxy_server_keys'], GetKeysHandler),
+    (PATHS['proxy_server_key_tree'], GetKeyTreeHandler),
+    (PATHS['proxy_server_key_buckets'], GetKeyBucketsHandler),
+    (PATHS['proxy_server_register'], RegisterProxyServerHandler),
+    (PATHS['proxy_server_heartbeat'], HeartbeatHandler),
+    (PATHS['proxy_server_deregister'], DeregisterProxyServerHandler),
 
     (PATHS['cron_proxy_server_distribute_key'], DistributeKeyHandler),
+    (PATHS['task_proxy_server_distribute_key'], DistributeKeyTaskHandler),
+    (PATHS['cron_proxy_server_health_check'], HealthCheckHandler),
+    (PATHS['proxy_server_watch_keys'], WatchKeysHandler),
     (admin.OAUTH_DECORATOR.callback_path,
      admin.OAUTH_DECORATOR.callback_handler()),
 ], debug=True)
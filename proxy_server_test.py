@@ -1,13 +1,23 @@
 """Test proxy server module functionality."""
+import datetime
+import json
+import os
 import sys
 import unittest
 
 from config import PATHS
+from mock import ANY
 from mock import MagicMock
 from mock import patch
+import webob
 import webtest
 
+from datastore import KeyChange
+from datastore import KeySetConvergence
+from datastore import ProxyRegistration
 from datastore import ProxyServer
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
 
 
 # Need to mock the decorator at function definition time, i.e. when the module
@@ -32,7 +42,10 @@ FAKE_ID = 11111
 FAKE_NAME = 'US_WEST1'
 FAKE_IP_ADDRESS = '111.222.333.444'
 FAKE_SSH_PRIVATE_KEY = '4444333222111'
-FAKE_FINGERPRINT = '11:22:33:44'
+FAKE_FINGERPRINT = ':'.join(['11'] * 32)
+FAKE_AUTH_TOKEN = '11111.abcdef'
+FAKE_AUTH_HEADERS = {'Authorization': 'Bearer ' + FAKE_AUTH_TOKEN}
+FAKE_EXPIRED_HEARTBEAT = datetime.datetime(2000, 1, 1)
 
 
 class ProxyServerTest(unittest.TestCase):
@@ -42,6 +55,18 @@ class ProxyServerTest(unittest.TestCase):
   def setUp(self):
     """Setup test app on which to call handlers."""
     self.testapp = webtest.TestApp(proxy_server.APP)
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    ndb.get_context().clear_cache()
+
+  def tearDown(self):
+    """Deactive the testbed."""
+    self.testbed.deactivate()
 
   @patch('proxy_server._RenderListProxyServerTemplate')
   def testListProxyServersHandler(self, mock_render_list_template):
@@ -60,7 +85,7 @@ class ProxyServerTest(unittest.TestCase):
     """Test the add handler adds a new proxy server into the datastore."""
     response = self.testapp.post(PATHS['proxy_server_add'])
 
-    mock_insert.assert_called_once_with('', '', '', '')
+    mock_insert.assert_called_once_with('', '', '', '', 'https', None)
     self.assertEqual(response.status_int, 302)
     self.assertTrue(PATHS['proxy_server_list'] in response.location)
 
@@ -82,11 +107,14 @@ class ProxyServerTest(unittest.TestCase):
               'name': FAKE_NAME,
               'ip_address': FAKE_IP_ADDRESS,
               'ssh_private_key': FAKE_SSH_PRIVATE_KEY,
-              'fingerprint': FAKE_FINGERPRINT}
+              'fingerprint': FAKE_FINGERPRINT,
+              'delivery_method': 'ssh',
+              'relay_id': '22222'}
     response = self.testapp.post(PATHS['proxy_server_edit'], params)
 
     mock_update.assert_called_once_with(FAKE_ID, FAKE_NAME, FAKE_IP_ADDRESS,
-                                        FAKE_SSH_PRIVATE_KEY, FAKE_FINGERPRINT)
+                                        FAKE_SSH_PRIVATE_KEY, FAKE_FINGERPRINT,
+                                        'ssh', 22222)
     self.assertEqual(response.status_int, 302)
     self.assertTrue(PATHS['proxy_server_list'] in response.location)
 
@@ -99,30 +127,507 @@ class ProxyServerTest(unittest.TestCase):
     mock_delete.assert_called_once_with(FAKE_ID)
     mock_render_list_template.assert_called_once_with()
 
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandler(self, mock_get_all):
+    """Test the distribute handler queues a task for each out of date proxy."""
+    up_to_date = GetFakeProxyServer()
+    up_to_date.key_set_version = 0
+    out_of_date = GetFakeProxyServer()
+    mock_get_all.return_value = [up_to_date, out_of_date]
+
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=proxy_server.key_distributor.DISTRIBUTION_QUEUE)
+    self.assertEqual(len(tasks), 1)
+    self.assertEqual(tasks[0].url, PATHS['task_proxy_server_distribute_key'])
+    self.assertEqual(tasks[0].payload, 'id=%s' % FAKE_ID)
+
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandlerSkipsExpired(self, mock_get_all):
+    """Test proxy servers whose heartbeat expired are not queued."""
+    expired = ProxyServer(id=1, last_heartbeat=FAKE_EXPIRED_HEARTBEAT)
+    alive = ProxyServer(id=2, last_heartbeat=datetime.datetime.utcnow())
+    mock_get_all.return_value = [expired, alive]
+
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=proxy_server.key_distributor.DISTRIBUTION_QUEUE)
+    self.assertEqual([task.payload for task in tasks], ['id=2'])
+
+  @patch('health_checker.CheckProxyServers')
+  @patch('datastore.ProxyServer.GetAll')
+  def testHealthCheckHandler(self, mock_get_all, mock_check):
+    """Test the health check handler probes only live proxy servers."""
+    expired = ProxyServer(id=1, last_heartbeat=FAKE_EXPIRED_HEARTBEAT)
+    alive = ProxyServer(id=2)
+    mock_get_all.return_value = [expired, alive]
+
+    self.testapp.get(PATHS['cron_proxy_server_health_check'])
+
+    mock_check.assert_called_once_with([alive])
+
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandlerHealthiestFirst(self, mock_get_all):
+    """Test the healthiest proxy servers are queued first."""
+    failing = ProxyServer(id=1, health_error_rate=1.0)
+    healthy = ProxyServer(id=2, health_error_rate=0.0, health_rtt=0.1)
+    mock_get_all.return_value = [failing, healthy]
+
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=proxy_server.key_distributor.DISTRIBUTION_QUEUE)
+    self.assertEqual([task.payload for task in tasks], ['id=2', 'id=1'])
+
+  @patch('proxy_server._RenderConvergenceTemplate')
+  def testConvergenceHandler(self, mock_render_convergence_template):
+    """Test the convergence handler displays the convergence report."""
+    self.testapp.get(PATHS['proxy_server_convergence'])
+    mock_render_convergence_template.assert_called_once_with()
+
+  def testRenderConvergenceTemplate(self):
+    """Test the convergence latency of recent versions is rendered."""
+    # Disabling the protected access check here intentionally so we can test a
+    # private method.
+    # pylint: disable=protected-access
+    KeyChange.Record(['ssh-rsa a a@b.com'], [])
+    KeyChange.Record([], ['ssh-rsa a a@b.com'])
+    convergence = KeySetConvergence.Get(2)
+    convergence.converged = convergence.changed
+    convergence.latency_seconds = 1.25
+    convergence.put()
+
+    convergence_template = proxy_server._RenderConvergenceTemplate()
+
+    self.assertTrue('Revocation' in convergence_template)
+    self.assertTrue('1.2s' in convergence_template)
+    self.assertTrue('Pending' in convergence_template)
+
+  @patch('datastore.ProxyServer.GetAll')
+  def testDistributeKeyHandlerRelays(self, mock_get_all):
+    """Test a relay's task covers its peers, and runs if any is behind."""
+    relay = ProxyServer(id=1, key_set_version=0)
+    out_of_date_peer = ProxyServer(id=2, relay_id=1)
+    up_to_date_peer = ProxyServer(id=3, relay_id=1, key_set_version=0)
+    mock_get_all.return_value = [relay, out_of_date_peer, up_to_date_peer]
+
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=proxy_server.key_distributor.DISTRIBUTION_QUEUE)
+    self.assertEqual([task.payload for task in tasks], ['id=1'])
+
   @patch('proxy_server._MakeKeyString')
   @patch('httplib2.Http.request')
+  def testDistributeKeyTaskHandlerRelay(self, mock_request,
+                                        mock_make_key_string):
+    """Test a relay's task makes one request covering its peers."""
+    GetFakeProxyServer().put()
+    ProxyServer(id=22222, ip_address='1.1.1.1', relay_id=FAKE_ID,
+                fingerprint=FAKE_FINGERPRINT).put()
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, '{"1.1.1.1": 200}'
+    mock_make_key_string.return_value = 'ssh-rsa public_key email'
+
+    response = self.testapp.post(PATHS['task_proxy_server_distribute_key'],
+                                 {'id': str(FAKE_ID)})
+
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(mock_request.call_count, 1)
+    headers = mock_request.call_args[1]['headers']
+    self.assertEqual(headers['X-Relay-Peers'], '1.1.1.1#' + '11' * 32)
+    self.assertEqual(ProxyServer.Get(22222).key_set_version, 0)
+
   @patch('datastore.ProxyServer.GetAll')
-  def testDistributeKeyHandler(self, mock_get_all, mock_request,
-                               mock_make_key_string):
-    """Test the distribute handler calls to put the keys on each proxy."""
-    fake_proxy_server = GetFakeProxyServer()
-    fake_proxy_servers = [fake_proxy_server]
-    mock_get_all.return_value = fake_proxy_servers
+  def testDistributeKeyHandlerRevocationsOnly(self, mock_get_all):
+    """Test revocation tasks skip proxies that applied the revocations."""
+    revoked = GetFakeProxyServer()
+    revoked.revoked_key_set_version = 0
+    unrevoked = GetFakeProxyServer()
+    mock_get_all.return_value = [revoked, unrevoked]
+
+    self.testapp.get(PATHS['cron_proxy_server_distribute_key'] +
+                     '?revocations_only=1')
+
+    self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(
+        queue_names=proxy_server.key_distributor.DISTRIBUTION_QUEUE)), 0)
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=proxy_server.key_distributor.REVOCATION_QUEUE)
+    self.assertEqual(len(tasks), 1)
+    self.assertTrue('revocations_only=1' in tasks[0].payload)
 
+  @patch('httplib2.Http.request')
+  def testDistributeKeyTaskHandlerRevocationsOnly(self, mock_request):
+    """Test a revocation task sends its proxy server just the revocations."""
+    KeyChange.Record(['ssh-rsa a a@b.com', 'ssh-rsa c c@d.com'], [])
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.key_set_version = 1
+    fake_proxy_server.accepts_gzip = False
+    fake_proxy_server.put()
+    KeyChange.Record(['ssh-rsa e e@f.com'], ['ssh-rsa a a@b.com'])
     mock_response = MagicMock()
     mock_response.status = 200
-    fake_content = ''
-    mock_request.return_value = mock_response, fake_content
+    mock_request.return_value = mock_response, ''
+
+    response = self.testapp.post(PATHS['task_proxy_server_distribute_key'],
+                                 {'id': str(FAKE_ID), 'revocations_only': '1'})
+
+    self.assertEqual(response.status_int, 200)
+    mock_request.assert_called_once_with(
+        'https://%s/key' % FAKE_IP_ADDRESS,
+        headers={'content-type': 'text/plain', 'X-Key-Set-Version': '1',
+                 'X-Base-Key-Set-Version': '1'},
+        method='PATCH',
+        body='-ssh-rsa a a@b.com\n',
+        connection_type=ANY)
+    updated_proxy_server = ProxyServer.Get(FAKE_ID)
+    self.assertEqual(updated_proxy_server.key_set_version, 1)
+    self.assertEqual(updated_proxy_server.revoked_key_set_version, 2)
 
+  @patch('proxy_server._MakeKeyString')
+  @patch('httplib2.Http.request')
+  def testDistributeKeyTaskHandler(self, mock_request, mock_make_key_string):
+    """Test the task handler puts the keys on its proxy server."""
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.accepts_gzip = True
+    fake_proxy_server.put()
+    mock_response = MagicMock()
+    mock_response.status = 200
+    mock_request.return_value = mock_response, ''
     fake_key_string = 'ssh-rsa public_key email'
     mock_make_key_string.return_value = fake_key_string
 
-    self.testapp.get(PATHS['cron_proxy_server_distribute_key'])
+    response = self.testapp.post(PATHS['task_proxy_server_distribute_key'],
+                                 {'id': str(FAKE_ID)})
+
+    self.assertEqual(response.status_int, 200)
     mock_request.assert_called_once_with(
-        'http://%s/key' % fake_proxy_server.ip_address,
-        headers={'content-type': 'text/plain'},
+        'https://%s/key' % FAKE_IP_ADDRESS,
+        headers={'content-type': 'text/plain', 'X-Key-Set-Version': '0',
+                 'content-encoding': 'gzip'},
         method='PUT',
-        body=fake_key_string)
+        body=proxy_server.key_distributor.GzipCompress(fake_key_string),
+        connection_type=ANY)
+    updated_proxy_server = ProxyServer.Get(FAKE_ID)
+    self.assertEqual(updated_proxy_server.key_set_version, 0)
+    self.assertEqual(updated_proxy_server.accepts_gzip, True)
+    self.assertEqual(updated_proxy_server.consecutive_distribution_failures, 0)
+    self.assertNotEqual(updated_proxy_server.last_distribution_success, None)
+
+  @patch('proxy_server._MakeKeyString')
+  @patch('httplib2.Http.request')
+  def testDistributeKeyTaskHandlerFailure(self, mock_request,
+                                          mock_make_key_string):
+    """Test a failed push is recorded and reported so the task is retried."""
+    GetFakeProxyServer().put()
+    mock_response = MagicMock()
+    mock_response.status = 500
+    mock_request.return_value = mock_response, ''
+    mock_make_key_string.return_value = 'ssh-rsa public_key email'
+
+    response = self.testapp.post(PATHS['task_proxy_server_distribute_key'],
+                                 {'id': str(FAKE_ID)}, expect_errors=True)
+
+    self.assertEqual(response.status_int, 500)
+    failed_proxy_server = ProxyServer.Get(FAKE_ID)
+    self.assertEqual(failed_proxy_server.key_set_version, None)
+    self.assertEqual(failed_proxy_server.consecutive_distribution_failures, 1)
+
+  @patch('proxy_server.key_distributor.ProbeProxyServer')
+  @patch('httplib2.Http.request')
+  def testDistributeKeyTaskHandlerOpenCircuit(self, mock_request, mock_probe):
+    """Test a proxy server whose circuit is open is probed, not retried."""
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.circuit_state = ProxyServer.CIRCUIT_OPEN
+    fake_proxy_server.put()
+    mock_probe.return_value = {'status': None, 'latency': 5.0}
+
+    response = self.testapp.post(PATHS['task_proxy_server_distribute_key'],
+                                 {'id': str(FAKE_ID)})
+
+    self.assertEqual(response.status_int, 200)
+    mock_probe.assert_called_once_with(ANY)
+    mock_request.assert_not_called()
+
+  @patch('httplib2.Http.request')
+  def testDistributeKeyTaskHandlerDeletedProxy(self, mock_request):
+    """Test a task for a deleted proxy server finishes without pushing."""
+    response = self.testapp.post(PATHS['task_proxy_server_distribute_key'],
+                                 {'id': str(FAKE_ID)})
+
+    self.assertEqual(response.status_int, 200)
+    mock_request.assert_not_called()
+
+  @patch('httplib2.Http.request')
+  def testDistributeKeyTaskHandlerExpiredProxy(self, mock_request):
+    """Test a task for a proxy server whose heartbeat expired is dropped."""
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.last_heartbeat = FAKE_EXPIRED_HEARTBEAT
+    fake_proxy_server.put()
+
+    response = self.testapp.post(PATHS['task_proxy_server_distribute_key'],
+                                 {'id': str(FAKE_ID)})
+
+    self.assertEqual(response.status_int, 200)
+    mock_request.assert_not_called()
+
+  def testRegisterProxyServerHandler(self):
+    """Test a proxy server registers with the secret and is sent keys."""
+    secret = str(ProxyRegistration.GetOrInsertDefault().secret)
+
+    response = self.testapp.post(
+        PATHS['proxy_server_register'],
+        {'name': FAKE_NAME, 'ip_address': FAKE_IP_ADDRESS,
+         'fingerprint': FAKE_FINGERPRINT},
+        headers={'Authorization': 'Bearer ' + secret})
+
+    registration = json.loads(response.body)
+    registered = ProxyServer.Get(registration['id'])
+    self.assertEqual(registered.ip_address, FAKE_IP_ADDRESS)
+    self.assertEqual(registered.auth_token, registration['auth_token'])
+    self.assertTrue(registered.IsAlive())
+    self.assertEqual(registration['heartbeat_interval_seconds'],
+                     proxy_server.HEARTBEAT_INTERVAL_SECONDS)
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        queue_names=proxy_server.key_distributor.DISTRIBUTION_QUEUE)
+    self.assertEqual([task.payload for task in tasks],
+                     ['id=%s' % registration['id']])
+
+  def testRegisterProxyServerHandlerRefused(self):
+    """Test registering needs the secret, a fingerprint and a free address."""
+    GetFakeProxyServer().put()
+    headers = {'Authorization': 'Bearer ' + str(
+                                ProxyRegistration.GetOrInsertDefault().secret)}
+    params = {'ip_address': FAKE_IP_ADDRESS, 'fingerprint': FAKE_FINGERPRINT}
+
+    unauthorized = self.testapp.post(
+        PATHS['proxy_server_register'], params, headers=FAKE_AUTH_HEADERS,
+        expect_errors=True)
+    no_fingerprint = self.testapp.post(
+        PATHS['proxy_server_register'], {'ip_address': '1.2.3.4'},
+        headers=headers, expect_errors=True)
+    added_by_hand = self.testapp.post(
+        PATHS['proxy_server_register'], params, headers=headers,
+        expect_errors=True)
+
+    self.assertEqual(unauthorized.status_int, 401)
+    self.assertEqual(no_fingerprint.status_int, 400)
+    self.assertEqual(added_by_hand.status_int, 409)
+    self.assertEqual(ProxyServer.GetCount(), 1)
+
+  def testHeartbeatHandler(self):
+    """Test a heartbeat brings an expired proxy server back to life."""
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.last_heartbeat = FAKE_EXPIRED_HEARTBEAT
+    fake_proxy_server.put()
+
+    response = self.testapp.post(PATHS['proxy_server_heartbeat'],
+                                 headers=FAKE_AUTH_HEADERS)
+
+    self.assertEqual(response.status_int, 204)
+    self.assertTrue(ProxyServer.Get(FAKE_ID).IsAlive())
+
+  def testHeartbeatHandlerUnauthorized(self):
+    """Test a heartbeat is not recorded without a valid token."""
+    response = self.testapp.post(PATHS['proxy_server_heartbeat'],
+                                 expect_errors=True)
+
+    self.assertEqual(response.status_int, 401)
+
+  def testDeregisterProxyServerHandler(self):
+    """Test a registered proxy server deletes itself."""
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.last_heartbeat = datetime.datetime.utcnow()
+    fake_proxy_server.put()
+
+    response = self.testapp.post(PATHS['proxy_server_deregister'],
+                                 headers=FAKE_AUTH_HEADERS)
+
+    self.assertEqual(response.status_int, 204)
+    self.assertEqual(ProxyServer.Get(FAKE_ID), None)
+
+  def testDeregisterProxyServerHandlerAddedByHand(self):
+    """Test a proxy server added by hand can not delete itself."""
+    GetFakeProxyServer().put()
+
+    response = self.testapp.post(PATHS['proxy_server_deregister'],
+                                 headers=FAKE_AUTH_HEADERS,
+                                 expect_errors=True)
+
+    self.assertEqual(response.status_int, 403)
+    self.assertNotEqual(ProxyServer.Get(FAKE_ID), None)
+
+  @patch('proxy_server._MakeKeyString')
+  def testGetKeysHandler(self, mock_make_key_string):
+    """Test an authenticated proxy server gets the keys and their version."""
+    GetFakeProxyServer().put()
+    fake_key_string = 'ssh-rsa public_key email\n'
+    mock_make_key_string.return_value = fake_key_string
+    headers = {'Authorization': 'Bearer ' + FAKE_AUTH_TOKEN}
+
+    response = self.testapp.get(PATHS['proxy_server_keys'], headers=headers)
+    cached_response = self.testapp.get(PATHS['proxy_server_keys'],
+                                       headers=headers)
+
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(response.body, fake_key_string)
+    self.assertEqual(response.headers['ETag'], '"0"')
+    self.assertEqual(response.headers['X-Key-Set-Version'], '0')
+    self.assertEqual(cached_response.body, fake_key_string)
+    mock_make_key_string.assert_called_once_with()
+
+  @patch('proxy_server._MakeKeyString')
+  def testGetKeysHandlerGzip(self, mock_make_key_string):
+    """Test a proxy server accepting gzip gets the keys compressed."""
+    GetFakeProxyServer().put()
+    fake_key_string = 'ssh-rsa public_key email\n'
+    mock_make_key_string.return_value = fake_key_string
+
+    # Webtest decodes gzip responses, so the app is called directly to see
+    # the compressed body.
+    response = webob.Request.blank(
+        PATHS['proxy_server_keys'],
+        headers={'Authorization': 'Bearer ' + FAKE_AUTH_TOKEN,
+                 'Accept-Encoding': 'gzip'}).get_response(proxy_server.APP)
+    not_modified_response = self.testapp.get(
+        PATHS['proxy_server_keys'],
+        headers={'Authorization': 'Bearer ' + FAKE_AUTH_TOKEN,
+                 'Accept-Encoding': 'gzip',
+                 'If-None-Match': response.headers['ETag']})
+
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+    self.assertEqual(response.headers['ETag'], '"0-gzip"')
+    self.assertEqual(response.body,
+                     proxy_server.key_distributor.GzipCompress(
+                         fake_key_string))
+    self.assertEqual(not_modified_response.status_int, 304)
+
+  @patch('proxy_server._MakeKeyString')
+  def testGetKeysHandlerNotModified(self, mock_make_key_string):
+    """Test a proxy server already at the current version gets a 304."""
+    GetFakeProxyServer().put()
+    headers = {'Authorization': 'Bearer ' + FAKE_AUTH_TOKEN,
+               'If-None-Match': '"0"'}
+
+    response = self.testapp.get(PATHS['proxy_server_keys'], headers=headers)
+
+    self.assertEqual(response.status_int, 304)
+    self.assertEqual(response.body, '')
+    mock_make_key_string.assert_not_called()
+
+  def testGetKeysHandlerUnauthorized(self):
+    """Test a request without a valid token is refused."""
+    GetFakeProxyServer().put()
+
+    response = self.testapp.get(PATHS['proxy_server_keys'], expect_errors=True)
+    bad_response = self.testapp.get(
+        PATHS['proxy_server_keys'],
+        headers={'Authorization': 'Bearer %s.wrong' % FAKE_ID},
+        expect_errors=True)
+
+    self.assertEqual(response.status_int, 401)
+    self.assertEqual(bad_response.status_int, 401)
+
+  def testWatchKeysHandlerNewVersion(self):
+    """Test a proxy server behind the current version is told at once."""
+    GetFakeProxyServer().put()
+    KeyChange.Record(['ssh-rsa public_key email'], [])
+
+    response = self.testapp.get(
+        PATHS['proxy_server_watch_keys'] + '?version=0',
+        headers={'Authorization': 'Bearer ' + FAKE_AUTH_TOKEN})
+
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(response.body, '1')
+    self.assertEqual(response.headers['X-Key-Set-Version'], '1')
+
+  @patch('key_distributor.WaitForNewVersion')
+  def testWatchKeysHandlerTimeout(self, mock_wait):
+    """Test a proxy server already at the current version gets a 204."""
+    GetFakeProxyServer().put()
+    mock_wait.return_value = None
+
+    response = self.testapp.get(
+        PATHS['proxy_server_watch_keys'] + '?version=0',
+        headers={'Authorization': 'Bearer ' + FAKE_AUTH_TOKEN})
+
+    mock_wait.assert_called_once_with(0)
+    self.assertEqual(response.status_int, 204)
+
+  def testWatchKeysHandlerUnauthorized(self):
+    """Test a watch without a valid token is refused."""
+    response = self.testapp.get(PATHS['proxy_server_watch_keys'],
+                                expect_errors=True)
+
+    self.assertEqual(response.status_int, 401)
+
+  @patch('datastore.KeyBucket.GetHashTree')
+  def testGetKeyTreeHandler(self, mock_get_hash_tree):
+    """Test a node's digest and its children's digests are output."""
+    GetFakeProxyServer().put()
+    tree = dict(('%x' % index, 'digest_%x' % index) for index in range(16))
+    tree[''] = 'root_digest'
+    mock_get_hash_tree.return_value = tree
+
+    response = self.testapp.get(PATHS['proxy_server_key_tree'],
+                                headers=FAKE_AUTH_HEADERS)
+    self.testapp.get(PATHS['proxy_server_key_tree'],
+                     headers=FAKE_AUTH_HEADERS)
+
+    self.assertEqual(response.status_int, 200)
+    self.assertEqual(response.content_type, 'application/json')
+    self.assertEqual(response.json['version'], 0)
+    self.assertEqual(response.json['digest'], 'root_digest')
+    self.assertEqual(response.json['children']['a'], 'digest_a')
+    self.assertEqual(len(response.json['children']), 16)
+    # The tree is built once per key set version.
+    mock_get_hash_tree.assert_called_once_with()
+
+  def testGetKeyTreeHandlerInvalidNode(self):
+    """Test a request below the nodes above the buckets is refused."""
+    GetFakeProxyServer().put()
+
+    response = self.testapp.get(PATHS['proxy_server_key_tree'] + '?node=ab',
+                                headers=FAKE_AUTH_HEADERS, expect_errors=True)
+
+    self.assertEqual(response.status_int, 400)
+
+  @patch('datastore.KeyBucket.GetBucketKeyStrings')
+  def testGetKeyBucketsHandler(self, mock_get_bucket_key_strings):
+    """Test only the requested buckets are output."""
+    GetFakeProxyServer().put()
+    mock_get_bucket_key_strings.return_value = {
+        '0a': 'ssh-rsa a a@b.com\n', 'ff': ''}
+
+    response = self.testapp.get(
+        PATHS['proxy_server_key_buckets'] + '?id=ff&id=0A',
+        headers=FAKE_AUTH_HEADERS)
+
+    mock_get_bucket_key_strings.assert_called_once_with(['0a', 'ff'])
+    self.assertEqual(response.json, {
+        'version': 0,
+        'buckets': {'0a': 'ssh-rsa a a@b.com\n', 'ff': ''},
+    })
+
+  def testGetKeyBucketsHandlerInvalidBucket(self):
+    """Test a request for a bucket that does not exist is refused."""
+    GetFakeProxyServer().put()
+
+    response = self.testapp.get(PATHS['proxy_server_key_buckets'] + '?id=zz',
+                                headers=FAKE_AUTH_HEADERS, expect_errors=True)
+
+    self.assertEqual(response.status_int, 400)
+
+  def testGetKeyBucketsHandlerUnauthorized(self):
+    """Test buckets are not output without a valid token."""
+    response = self.testapp.get(PATHS['proxy_server_key_buckets'] + '?id=00',
+                                expect_errors=True)
+
+    self.assertEqual(response.status_int, 401)
 
   def testRenderAddProxyServerTemplate(self):
     """Test the proxy server add form is rendered as in the html."""
@@ -167,39 +672,92 @@ class ProxyServerTest(unittest.TestCase):
     self.assertTrue(FAKE_IP_ADDRESS in list_proxy_server_template)
     self.assertTrue(FAKE_SSH_PRIVATE_KEY in list_proxy_server_template)
     self.assertTrue(FAKE_FINGERPRINT in list_proxy_server_template)
+    self.assertTrue(ProxyRegistration.GetOrInsertDefault().secret in
+                    list_proxy_server_template)
 
-  @patch('datastore.User.GetAll')
-  def testMakeKeyString(self, mock_get_all):
-    """Test that the key string is generated with all non-revoked users."""
+  @patch('datastore.ProxyServer.GetAll')
+  def testRenderListProxyServerTemplateHeartbeat(self, mock_get_all):
+    """Test registered proxy servers show whether they are alive."""
     # Disabling the protected access check here intentionally so we can test a
     # private method.
     # pylint: disable=protected-access
-    fake_emails = ['foo@bar.com', 'bar@baz.com', 'baz@foo.com']
-    fake_public_keys = ['123abc', 'def456', '789ghi']
-    fake_user_1 = MagicMock(email=fake_emails[0],
-                            public_key=fake_public_keys[0],
-                            is_key_revoked=False)
-    fake_result_1 = ('ssh-rsa ' + fake_public_keys[0] + ' ' +
-                     fake_emails[0] + '\n')
-    fake_user_2 = MagicMock(email=fake_emails[1],
-                            public_key=fake_public_keys[1],
-                            is_key_revoked=False)
-    fake_result_2 = ('ssh-rsa ' + fake_public_keys[1] + ' ' +
-                     fake_emails[1] + '\n')
-    user_with_revoked_key = MagicMock(email=fake_emails[2],
-                                      public_key=fake_public_keys[2],
-                                      is_key_revoked=True)
-    fake_result_3 = ('ssh-rsa ' + fake_public_keys[2] + ' ' +
-                     fake_emails[2] + '\n')
-    fake_users = [fake_user_1, fake_user_2, user_with_revoked_key]
-    mock_get_all.return_value = fake_users
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.last_heartbeat = FAKE_EXPIRED_HEARTBEAT
+    mock_get_all.return_value = [fake_proxy_server]
 
-    key_string = proxy_server._MakeKeyString()
+    list_proxy_server_template = proxy_server._RenderListProxyServerTemplate()
+
+    self.assertTrue('Last heartbeat: 2000-01-01 00:00:00 UTC' in
+                    list_proxy_server_template)
+    self.assertTrue('(expired)' in list_proxy_server_template)
+
+  @patch('datastore.ProxyServer.GetAll')
+  def testRenderListProxyServerTemplateHealth(self, mock_get_all):
+    """Test the saved health of each proxy server is shown."""
+    # Disabling the protected access check here intentionally so we can test a
+    # private method.
+    # pylint: disable=protected-access
+    fake_proxy_server = GetFakeProxyServer()
+    fake_proxy_server.health_error_rate = 0.25
+    fake_proxy_server.health_rtt = 0.042
+    fake_proxy_server.last_health_check = FAKE_EXPIRED_HEARTBEAT
+    mock_get_all.return_value = [fake_proxy_server]
+
+    list_proxy_server_template = proxy_server._RenderListProxyServerTemplate()
+
+    self.assertTrue('25% of checks failing' in list_proxy_server_template)
+    self.assertTrue('42 ms round trip' in list_proxy_server_template)
+
+  @patch('datastore.ProxyServer.GetAll')
+  def testRenderListProxyServerTemplateCircuit(self, mock_get_all):
+    """Test a proxy server's circuit is shown only while not closed."""
+    # Disabling the protected access check here intentionally so we can test a
+    # private method.
+    # pylint: disable=protected-access
+    closed = GetFakeProxyServer()
+    mock_get_all.return_value = [closed]
+    closed_template = proxy_server._RenderListProxyServerTemplate()
+    tripped = GetFakeProxyServer()
+    tripped.circuit_state = ProxyServer.CIRCUIT_OPEN
+    tripped.circuit_opened = FAKE_EXPIRED_HEARTBEAT
+    tripped.consecutive_distribution_failures = 3
+    mock_get_all.return_value = [tripped]
 
-    mock_get_all.assert_called_once_with()
+    tripped_template = proxy_server._RenderListProxyServerTemplate()
+
+    self.assertFalse('Circuit' in closed_template)
+    self.assertTrue('Circuit open since 2000-01-01 00:00:00 UTC' in
+                    tripped_template)
+
+  @patch('datastore.ProxyServer.GetAll')
+  def testRenderListProxyServerTemplateRelays(self, mock_get_all):
+    """Test each relay's subtree convergence is shown."""
+    # Disabling the protected access check here intentionally so we can test a
+    # private method.
+    # pylint: disable=protected-access
+    relay = ProxyServer(id=1, name='relay', key_set_version=0)
+    peers = [ProxyServer(id=2, name='peer', relay_id=1, key_set_version=0),
+             ProxyServer(id=3, name='peer', relay_id=1)]
+    mock_get_all.return_value = [relay] + peers
+
+    list_proxy_server_template = proxy_server._RenderListProxyServerTemplate()
+
+    self.assertTrue('Relayed through: relay' in list_proxy_server_template)
+    self.assertTrue('Relay subtree: 2 of 3' in list_proxy_server_template)
+
+  @patch('datastore.KeyBucket.GetKeyString')
+  def testMakeKeyString(self, mock_get_key_string):
+    """Test that the key string is read from the key buckets."""
+    # Disabling the protected access check here intentionally so we can test a
+    # private method.
+    # pylint: disable=protected-access
+    fake_key_string = 'ssh-rsa 123abc foo@bar.com\n'
+    mock_get_key_string.return_value = fake_key_string
+
+    key_string = proxy_server._MakeKeyString()
 
-    self.assertEqual(fake_result_1 + fake_result_2, key_string)
-    self.assertTrue(fake_result_3 not in key_string)
+    mock_get_key_string.assert_called_once_with()
+    self.assertEqual(fake_key_string, key_string)
 
 
 def GetFakeProxyServer():
@@ -208,7 +766,8 @@ def GetFakeProxyServer():
                      name=FAKE_NAME,
                      ip_address=FAKE_IP_ADDRESS,
                      ssh_private_key=FAKE_SSH_PRIVATE_KEY,
-                     fingerprint=FAKE_FINGERPRINT)
+                     fingerprint=FAKE_FINGERPRINT,
+                     auth_token=FAKE_AUTH_TOKEN)
 
 if __name__ == '__main__':
   unittest.main()
@@ -279,7 +279,7 @@ function deploy ()
   fi
 
   if [ ! -z  "$AE_FILE" ]; then
-    runAndAssertCmd "$AE_FILE -A $DEPLOYMENT_SERVER update $UFO_DIR"
+    runAndAssertCmd "$AE_FILE -A $DEPLOYMENT_SERVER update $UFO_DIR/app.yaml $UFO_DIR/keygen.yaml"
   fi
 }
 
@@ -0,0 +1,312 @@
+"""The module for delivering authorized keys to proxy servers over ssh.
+
+This is the delivery backend for proxy servers that take their keys as an
+ordinary authorized_keys file rather than from an https push.  The file is
+written over sftp, logging in with the proxy server's stored ssh private key
+and checking its host key against the stored fingerprint.  The account the
+management server logs in as is the one whose authorized_keys file is
+written, so the file always keeps the management server's own key too.
+Clients log in as the same account, so their keys are converted from the PEM
+the key set holds to the open ssh format sshd reads, and restricted to the
+port forwarding a proxy needs.  One ssh session per proxy server is kept open
+by the instance and each push runs as a new channel on it, so only the first
+push pays for the ssh handshake.
+
+paramiko is optional.  Without it, proxy servers set to ssh delivery are
+never pushed to.
+"""
+
+import base64
+import binascii
+import hmac
+import httplib
+import logging
+import os
+import socket
+import StringIO
+import threading
+import time
+
+import pinned_connection
+
+try:
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  import paramiko
+except ImportError:
+  paramiko = None
+
+
+SSH_PORT = 22
+# The account on each proxy server that the management server and clients log
+# in as.
+SSH_USERNAME = 'ufo'
+# Where the keys are written, relative to that account's home directory.
+AUTHORIZED_KEYS_PATH = '.ssh/authorized_keys'
+# The comment on the management server's own line in the keys it writes.
+MANAGEMENT_KEY_COMMENT = 'ufo-management-server'
+# The options on each user's line, so clients can only forward ports and not
+# run commands such as rewriting the authorized_keys file.
+USER_KEY_OPTIONS = 'restrict,port-forwarding'
+SSH_TIMEOUT_SECONDS = 10
+
+# A dictionary of (address, fingerprint) to the open ssh transport to it.
+_TRANSPORTS = {}
+_TRANSPORTS_LOCK = threading.Lock()
+
+
+def _ParseAddress(address):
+  """Split an address into its host and port, defaulting to the ssh port.
+
+  Args:
+    address: A host, optionally followed by a colon and port.
+
+  Returns:
+    A tuple of the host and the integer port.
+  """
+  if address.count(':') == 1:
+    host, port = address.split(':')
+    return host, int(port)
+  return address, SSH_PORT
+
+
+def _LoadPrivateKey(private_key):
+  """Load a PEM encoded RSA or ECDSA private key.
+
+  Args:
+    private_key: The private key in PEM format.
+
+  Returns:
+    A paramiko private key.
+
+  Raises:
+    paramiko.SSHException: If the key is not a supported private key.
+  """
+  for key_class in (paramiko.RSAKey, paramiko.ECDSAKey):
+    try:
+      return key_class.from_private_key(StringIO.StringIO(private_key))
+    except paramiko.SSHException:
+      continue
+  raise paramiko.SSHException('Unsupported ssh private key.')
+
+
+def _MakeManagementKeyLine(private_key):
+  """Make the authorized keys line that lets the management server log in.
+
+  Args:
+    private_key: The management server's private key for the proxy server
+                 in PEM format.
+
+  Returns:
+    A string of the key type, public key and comment without a newline.
+
+  Raises:
+    paramiko.SSHException: If the key is not a supported private key.
+  """
+  key = _LoadPrivateKey(private_key)
+  return '%s %s %s' % (key.get_name(), key.get_base64(),
+                       MANAGEMENT_KEY_COMMENT)
+
+
+def _MakeUserKeyString(key_string):
+  """Convert the key set's authorized keys lines to ones sshd can read.
+
+  The key set holds each user's public key as the url safe base64 of its
+  PEM encoding, which only the proxy servers taking https pushes decode.
+
+  Args:
+    key_string: The authorized keys for all users, as the key set holds
+                them.
+
+  Returns:
+    A string of the users' authorized keys lines in the open ssh format,
+    each restricted by USER_KEY_OPTIONS and ending in a newline.  Lines
+    whose key can not be read are left out.
+  """
+  lines = []
+  for line in key_string.splitlines():
+    fields = line.split(None, 2)
+    if not fields:
+      continue
+    try:
+      public_key = serialization.load_pem_public_key(
+          base64.urlsafe_b64decode(fields[1]), default_backend())
+    except (IndexError, TypeError, ValueError, binascii.Error):
+      logging.warning('Not distributing an unreadable key over ssh: %s',
+                      line)
+      continue
+    openssh_key = public_key.public_bytes(serialization.Encoding.OpenSSH,
+                                          serialization.PublicFormat.OpenSSH)
+    lines.append(' '.join([USER_KEY_OPTIONS, openssh_key] + fields[2:]) +
+                 '\n')
+  return ''.join(lines)
+
+
+def _OpenTransport(proxy_server, fingerprint):
+  """Open and authenticate an ssh session to a proxy server.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+    fingerprint: The normalized fingerprint the host key must match.
+
+  Returns:
+    transport: An authenticated paramiko transport.
+
+  Raises:
+    paramiko.SSHException: If the host key does not match or the login fails.
+    socket.error: If the proxy server can not be reached.
+  """
+  sock = socket.create_connection(_ParseAddress(proxy_server.ip_address),
+                                  SSH_TIMEOUT_SECONDS)
+  transport = paramiko.Transport(sock)
+  try:
+    transport.start_client(timeout=SSH_TIMEOUT_SECONDS)
+    host_key = transport.get_remote_server_key().asbytes()
+    hash_function = pinned_connection.HASH_FUNCTIONS_BY_LENGTH[
+        len(fingerprint)]
+    actual_fingerprint = hash_function(host_key).hexdigest()
+    if not hmac.compare_digest(actual_fingerprint, fingerprint):
+      raise paramiko.SSHException(
+          'Host key fingerprint %s does not match the pinned %s.' %
+          (actual_fingerprint, fingerprint))
+    transport.auth_publickey(SSH_USERNAME,
+                             _LoadPrivateKey(proxy_server.ssh_private_key))
+  except Exception:
+    transport.close()
+    raise
+  return transport
+
+
+def _GetTransport(proxy_server, fingerprint):
+  """Get the open ssh session to a proxy server, opening one if needed.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+    fingerprint: The normalized fingerprint the host key must match.
+
+  Returns:
+    transport: An authenticated paramiko transport shared by every push to
+               the proxy server.
+  """
+  transport_key = (proxy_server.ip_address, fingerprint)
+  with _TRANSPORTS_LOCK:
+    transport = _TRANSPORTS.get(transport_key)
+    if transport and transport.is_active():
+      return transport
+
+  transport = _OpenTransport(proxy_server, fingerprint)
+  with _TRANSPORTS_LOCK:
+    existing = _TRANSPORTS.get(transport_key)
+    if existing and existing.is_active():
+      # Another thread opened one first, so share that one instead.
+      transport.close()
+      return existing
+    _TRANSPORTS[transport_key] = transport
+  return transport
+
+
+def _DiscardTransport(proxy_server, fingerprint):
+  """Close and forget the ssh session to a proxy server after an error.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+    fingerprint: The normalized fingerprint the session was opened with.
+  """
+  with _TRANSPORTS_LOCK:
+    transport = _TRANSPORTS.pop((proxy_server.ip_address, fingerprint), None)
+  if transport:
+    transport.close()
+
+
+def CloseAll():
+  """Close every ssh session this instance holds open."""
+  with _TRANSPORTS_LOCK:
+    transports = _TRANSPORTS.values()
+    _TRANSPORTS.clear()
+  for transport in transports:
+    transport.close()
+
+
+def ProbeSshPort(proxy_server, timeout):
+  """Check a proxy server's ssh port accepts connections.
+
+  Only a TCP connection is made, so no ssh session is opened and paramiko is
+  not needed.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+    timeout: How long to wait for the connection in seconds.
+
+  Returns:
+    result: A dictionary with the http status code equivalent of the outcome
+            (200 if the port accepted the connection, None if not) and the
+            round trip time in seconds of the connection.
+  """
+  start_time = time.time()
+  try:
+    sock = socket.create_connection(_ParseAddress(proxy_server.ip_address),
+                                    timeout)
+  except socket.error as error:
+    logging.info('Health check of %s over ssh failed: %s',
+                 proxy_server.ip_address, error)
+    return {'status': None, 'latency': time.time() - start_time}
+  latency = time.time() - start_time
+  sock.close()
+  return {'status': httplib.OK, 'latency': latency}
+
+
+def PushKeyString(proxy_server, key_string):
+  """Replace a proxy server's authorized_keys file with the key string.
+
+  The keys are written to a temporary file that is then renamed over the
+  authorized_keys file, so sshd never reads a partly written file.  The
+  management server's own key line is written first, so it can still log
+  in once its ssh session closes, followed by the users' lines in the open
+  ssh format.
+
+  Args:
+    proxy_server: A proxy server entity from the datastore.
+    key_string: The authorized keys for all users.
+
+  Returns:
+    result: A dictionary with the http status code equivalent of the outcome
+            (200 if the keys were written, None if not) and the latency in
+            seconds of the push, like key_distributor.PushKeysToProxyServer.
+  """
+  if paramiko is None:
+    logging.error('Not distributing keys to %s over ssh without paramiko.',
+                  proxy_server.ip_address)
+    return {'status': None, 'latency': 0.0}
+  fingerprint = pinned_connection.NormalizeFingerprint(
+      proxy_server.fingerprint)
+  if fingerprint is None:
+    logging.error('Not distributing keys to %s without a valid host key '
+                  'fingerprint to pin.', proxy_server.ip_address)
+    return {'status': None, 'latency': 0.0}
+  if isinstance(key_string, unicode):
+    key_string = key_string.encode('utf-8')
+
+  start_time = time.time()
+  temporary_path = '%s.%s' % (AUTHORIZED_KEYS_PATH,
+                              os.urandom(8).encode('hex'))
+  try:
+    management_key_line = _MakeManagementKeyLine(proxy_server.ssh_private_key)
+    user_key_string = _MakeUserKeyString(key_string)
+    transport = _GetTransport(proxy_server, fingerprint)
+    sftp = paramiko.SFTPClient.from_transport(transport)
+    try:
+      with sftp.open(temporary_path, 'w') as temporary_file:
+        temporary_file.write(management_key_line + '\n')
+        temporary_file.write(user_key_string)
+      sftp.chmod(temporary_path, 0600)
+      sftp.posix_rename(temporary_path, AUTHORIZED_KEYS_PATH)
+    finally:
+      sftp.close()
+  except (paramiko.SSHException, socket.error, IOError, EOFError) as error:
+    _DiscardTransport(proxy_server, fingerprint)
+    logging.warning('Failed to distribute keys to %s over ssh: %s',
+                    proxy_server.ip_address, error)
+    return {'status': None, 'latency': time.time() - start_time}
+
+  logging.info('Distributed keys to %s over ssh.', proxy_server.ip_address)
+  return {'status': httplib.OK, 'latency': time.time() - start_time}
@@ -0,0 +1,339 @@
+"""Test ssh distributor module functionality."""
+import base64
+import hashlib
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import threading
+import unittest
+
+from datastore import ProxyServer
+from datastore import User
+import key_distributor
+import ssh_distributor
+
+try:
+  import paramiko
+except ImportError:
+  paramiko = None
+
+
+FAKE_EMAILS = ['a@b.com', 'c@d.com']
+FAKE_KEY_TYPES = ['rsa-2048', 'ecdsa-p256']
+
+
+if paramiko is not None:
+
+  class _StubServer(paramiko.ServerInterface):
+
+    """Let the keys in the authorized_keys file log in, as sshd.
+
+    Lines may start with options, as sshd allows.
+    """
+
+    def __init__(self, authorized_keys_path):
+      paramiko.ServerInterface.__init__(self)
+      self.authorized_keys_path = authorized_keys_path
+
+    def get_allowed_auths(self, username):
+      return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+      if username != ssh_distributor.SSH_USERNAME:
+        return paramiko.AUTH_FAILED
+      for line in open(self.authorized_keys_path).read().splitlines():
+        fields = line.split()
+        if [key.get_name(), key.get_base64()] in (fields[:2], fields[1:3]):
+          return paramiko.AUTH_SUCCESSFUL
+      return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+      return paramiko.OPEN_SUCCEEDED
+
+  class _StubSftpServer(paramiko.SFTPServerInterface):
+
+    """Serve sftp out of the stand-in proxy server's home directory."""
+
+    # pylint: disable=arguments-differ
+
+    def __init__(self, server, home_directory, *args, **kwargs):
+      paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+      self.home_directory = home_directory
+
+    def _GetPath(self, path):
+      return os.path.join(self.home_directory, path)
+
+    def open(self, path, flags, attr):
+      handle = paramiko.SFTPHandle(flags)
+      handle.writefile = open(self._GetPath(path), 'wb')
+      return handle
+
+    def chattr(self, path, attr):
+      if attr.st_mode is not None:
+        os.chmod(self._GetPath(path), attr.st_mode)
+      return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+      os.rename(self._GetPath(oldpath), self._GetPath(newpath))
+      return paramiko.SFTP_OK
+
+
+class _StandInProxyServer(object):
+
+  """An in-process ssh server standing in for a proxy server."""
+
+  def __init__(self, host_key, authorized_key):
+    self.host_key = host_key
+    self.home_directory = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.home_directory, '.ssh'))
+    # The management server's key is authorized when the proxy server is set
+    # up, before any keys are pushed.
+    self.provisioned_keys = _MakeKeyLine(authorized_key, 'provisioned')
+    with open(self._GetAuthorizedKeysPath(), 'w') as authorized_keys:
+      authorized_keys.write(self.provisioned_keys)
+    self.connection_count = 0
+    self.transports = []
+    self.listener = socket.socket()
+    self.listener.bind(('127.0.0.1', 0))
+    self.listener.listen(10)
+    self.address = '127.0.0.1:%d' % self.listener.getsockname()[1]
+    thread = threading.Thread(target=self._Serve)
+    thread.daemon = True
+    thread.start()
+
+  def _Serve(self):
+    """Accept ssh connections until the listener is closed."""
+    while True:
+      try:
+        connection, _ = self.listener.accept()
+      except socket.error:
+        return
+      self.connection_count += 1
+      transport = paramiko.Transport(connection)
+      transport.add_server_key(self.host_key)
+      transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                      _StubSftpServer, self.home_directory)
+      self.transports.append(transport)
+      try:
+        transport.start_server(
+            server=_StubServer(self._GetAuthorizedKeysPath()))
+      except paramiko.SSHException:
+        # Such as a port probe hanging up without starting an ssh session.
+        continue
+
+  def _GetAuthorizedKeysPath(self):
+    """Get the path of the authorized_keys file on the server."""
+    return os.path.join(self.home_directory,
+                        ssh_distributor.AUTHORIZED_KEYS_PATH)
+
+  def ReadAuthorizedKeys(self):
+    """Get the contents of the authorized_keys file written to the server."""
+    return open(self._GetAuthorizedKeysPath()).read()
+
+  def StopListening(self):
+    """Refuse new connections, waking the thread blocked in accept."""
+    try:
+      self.listener.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self.listener.close()
+
+  def Close(self):
+    """Stop the server and remove its files."""
+    self.StopListening()
+    for transport in self.transports:
+      transport.close()
+    shutil.rmtree(self.home_directory)
+
+
+def _MakeKeyLine(key, comment):
+  """Make the authorized keys line for a paramiko key, with a newline."""
+  return '%s %s %s\n' % (key.get_name(), key.get_base64(), comment)
+
+
+def _GetPrivateKeyPem(key):
+  """Get the PEM encoding of a paramiko private key."""
+  pem = StringIO.StringIO()
+  key.write_private_key(pem)
+  return pem.getvalue()
+
+
+@unittest.skipIf(paramiko is None, 'paramiko is not installed')
+class SshDistributorTest(unittest.TestCase):
+
+  """Test delivering keys over ssh to in-process stand-in proxy servers."""
+
+  @classmethod
+  def setUpClass(cls):
+    """Make the keys once, as generating them is slow."""
+    cls.host_key = paramiko.RSAKey.generate(1024)
+    cls.client_key = paramiko.RSAKey.generate(1024)
+    # Users with each kind of key, as the key set holds them.
+    # pylint: disable=protected-access
+    cls.user_key_pairs = [User._GenerateKeyPair(key_type)
+                          for key_type in FAKE_KEY_TYPES]
+    cls.key_string = ''.join(
+        User.MakeKeyLine(key_pair['public_key'], email, key_pair['key_type']) +
+        '\n' for key_pair, email in zip(cls.user_key_pairs, FAKE_EMAILS))
+
+  def setUp(self):
+    """Start a stand-in proxy server for each test."""
+    self.servers = [self._StartServer()]
+
+  def tearDown(self):
+    """Close the ssh sessions and stand-in proxy servers."""
+    ssh_distributor.CloseAll()
+    for server in self.servers:
+      server.Close()
+
+  def _StartServer(self):
+    """Start another stand-in proxy server."""
+    return _StandInProxyServer(self.host_key, self.client_key)
+
+  def _GetProxyServer(self, server, fingerprint=None):
+    """Get a proxy server entity pointing at a stand-in proxy server."""
+    if fingerprint is None:
+      fingerprint = hashlib.sha256(self.host_key.asbytes()).hexdigest()
+    return ProxyServer(ip_address=server.address,
+                       ssh_private_key=_GetPrivateKeyPem(self.client_key),
+                       fingerprint=fingerprint,
+                       delivery_method=ProxyServer.SSH_DELIVERY)
+
+  def _GetUserKey(self, index):
+    """Get a user's private key as a client loads it from an invite code."""
+    # pylint: disable=protected-access
+    return ssh_distributor._LoadPrivateKey(base64.urlsafe_b64decode(
+        self.user_key_pairs[index]['private_key']))
+
+  def _GetExpectedKeys(self):
+    """Get the authorized_keys file expected after pushing the key string."""
+    return _MakeKeyLine(self.client_key,
+                        ssh_distributor.MANAGEMENT_KEY_COMMENT) + ''.join(
+                            '%s %s' % (ssh_distributor.USER_KEY_OPTIONS,
+                                       _MakeKeyLine(self._GetUserKey(index),
+                                                    email))
+                            for index, email in enumerate(FAKE_EMAILS))
+
+  def _CanLogIn(self, server, key):
+    """Check whether a key can log in to a stand-in proxy server."""
+    host, port = server.address.split(':')
+    transport = paramiko.Transport((host, int(port)))
+    try:
+      transport.start_client()
+      transport.auth_publickey(ssh_distributor.SSH_USERNAME, key)
+      return transport.is_authenticated()
+    except paramiko.AuthenticationException:
+      return False
+    finally:
+      transport.close()
+
+  def testPushKeyString(self):
+    """Test the authorized_keys file is replaced with the keys."""
+    result = ssh_distributor.PushKeyString(
+        self._GetProxyServer(self.servers[0]), self.key_string)
+
+    self.assertEqual(result['status'], 200)
+    self.assertEqual(self.servers[0].ReadAuthorizedKeys(),
+                     self._GetExpectedKeys())
+    self.assertEqual(os.listdir(os.path.join(self.servers[0].home_directory,
+                                             '.ssh')), ['authorized_keys'])
+
+  def testPushKeyStringUserCanLogIn(self):
+    """Test a distributed user can log in with the key in their invite code.
+    """
+    other_key = paramiko.RSAKey.generate(1024)
+    self.assertFalse(self._CanLogIn(self.servers[0], self._GetUserKey(0)))
+
+    ssh_distributor.PushKeyString(self._GetProxyServer(self.servers[0]),
+                                  self.key_string)
+
+    self.assertTrue(self._CanLogIn(self.servers[0], self._GetUserKey(0)))
+    self.assertTrue(self._CanLogIn(self.servers[0], self._GetUserKey(1)))
+    self.assertFalse(self._CanLogIn(self.servers[0], other_key))
+
+  def testPushKeyStringSkipsUnreadableKey(self):
+    """Test a key that can not be converted is left out, not pushed as is."""
+    result = ssh_distributor.PushKeyString(
+        self._GetProxyServer(self.servers[0]),
+        'ssh-rsa not_a_key e@f.com\n' + self.key_string)
+
+    self.assertEqual(result['status'], 200)
+    self.assertEqual(self.servers[0].ReadAuthorizedKeys(),
+                     self._GetExpectedKeys())
+
+  def testPushKeyStringReusesSession(self):
+    """Test later pushes run over the ssh session the first one opened."""
+    proxy_server = self._GetProxyServer(self.servers[0])
+
+    ssh_distributor.PushKeyString(proxy_server, 'ssh-rsa old a@b.com\n')
+    result = ssh_distributor.PushKeyString(proxy_server, self.key_string)
+
+    self.assertEqual(result['status'], 200)
+    self.assertEqual(self.servers[0].ReadAuthorizedKeys(),
+                     self._GetExpectedKeys())
+    self.assertEqual(self.servers[0].connection_count, 1)
+
+  def testPushKeyStringAfterReconnect(self):
+    """Test the management server can still log in once its session drops.
+    """
+    proxy_server = self._GetProxyServer(self.servers[0])
+
+    ssh_distributor.PushKeyString(proxy_server, 'ssh-rsa old a@b.com\n')
+    ssh_distributor.CloseAll()
+    result = ssh_distributor.PushKeyString(proxy_server, self.key_string)
+
+    self.assertEqual(result['status'], 200)
+    self.assertEqual(self.servers[0].ReadAuthorizedKeys(),
+                     self._GetExpectedKeys())
+    self.assertEqual(self.servers[0].connection_count, 2)
+
+  def testPushKeyStringHostKeyMismatch(self):
+    """Test keys are not written to a server with an unexpected host key."""
+    proxy_server = self._GetProxyServer(self.servers[0],
+                                        fingerprint='00' * 32)
+
+    result = ssh_distributor.PushKeyString(proxy_server, self.key_string)
+
+    self.assertEqual(result['status'], None)
+    self.assertEqual(self.servers[0].ReadAuthorizedKeys(),
+                     self.servers[0].provisioned_keys)
+
+  def testPushKeyStringUnreachable(self):
+    """Test an unreachable proxy server is reported rather than raised."""
+    proxy_server = self._GetProxyServer(self.servers[0])
+    self.servers[0].StopListening()
+
+    result = ssh_distributor.PushKeyString(proxy_server, self.key_string)
+
+    self.assertEqual(result['status'], None)
+
+  def testProbeSshPort(self):
+    """Test the ssh port is probed without opening an ssh session."""
+    proxy_server = self._GetProxyServer(self.servers[0])
+
+    result = ssh_distributor.ProbeSshPort(proxy_server, 1)
+    self.servers[0].StopListening()
+    unreachable_result = ssh_distributor.ProbeSshPort(proxy_server, 1)
+
+    self.assertEqual(result['status'], 200)
+    self.assertEqual(unreachable_result['status'], None)
+
+  def testPushKeysToProxyServersOverSsh(self):
+    """Test the distributor pushes to many ssh proxy servers concurrently."""
+    self.servers.extend(self._StartServer() for _ in range(4))
+    proxy_servers = [self._GetProxyServer(server) for server in self.servers]
+    payload = key_distributor.MakeSnapshotPayload(self.key_string, 1)
+
+    results = key_distributor.PushKeysToProxyServers(
+        proxy_servers, [payload] * len(proxy_servers))
+
+    self.assertEqual([result['status'] for result in results],
+                     [200] * len(proxy_servers))
+    for server in self.servers:
+      self.assertEqual(server.ReadAuthorizedKeys(),
+                       self._GetExpectedKeys())
+
+if __name__ == '__main__':
+  unittest.main()
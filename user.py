@@ -5,18 +5,38 @@ from appengine_config import JINJA_ENVIRONMENT
 from ast import literal_eval
 import base64
 from config import PATHS
+import datetime
+from datastore import DEFAULT_KEY_TYPE
 from datastore import DomainVerification
+from datastore import KeyBucket
+from datastore import KeyRotationJob
+from datastore import PooledKeyPair
 from datastore import ProxyServer
+from datastore import SSH_KEY_TYPES
 from datastore import User
 from error_handlers import Handle500
+from google.appengine.api import taskqueue
 from googleapiclient import errors
 from google_directory_service import GoogleDirectoryService
+import health_checker
 import json
+import key_distributor
 import random
+import ssh_distributor
+import time
 import webapp2
 import xsrf
 
 
+# The push queue whose tasks generate key pairs.  It targets the keygen
+# module, whose instances each take one task at a time, so bulk generation
+# scales with the instances it is allowed rather than one request's core.
+KEY_GENERATION_QUEUE = 'key-generation'
+# How many key pairs one key generation task makes, so it finishes well
+# within a task's deadline and records few enough key changes.
+KEY_PAIRS_PER_TASK = 20
+# A low key pair pool is only refilled once in each window of this long.
+KEY_PAIR_REFILL_WINDOW_SECONDS = 60
 
 
 def _GenerateUserPayload(users):
@@ -59,6 +79,11 @@ def _MakeInviteCode(user):
   It includes the host ip (of the proxy server or load balancer) to connect
   the user to, the user username (user's email) to connect with, and
   the credential (private key) necessary to authenticate with the host.
+  Proxy servers taking their keys over ssh run a stock sshd, which only
+  knows the account the keys are written for, so users log in to them as
+  that account instead of their email.
+  Users with a key other than rsa also get the keyType of their private key,
+  as clients from before there was a choice assume rsa.
 
   TODO: Guard against any future breakage when the invite code format
   is changed again.  Possibly adding a test on the uproxy-lib side
@@ -76,28 +101,36 @@ def _MakeInviteCode(user):
       'networkName': 'Cloud',
       'networkData': {}
   }
-  invite_code_data['networkData']['host'] = _GetInviteCodeIp()
-  invite_code_data['networkData']['user'] = user.email
+  proxy_server = _GetInviteCodeProxyServer()
+  invite_code_data['networkData']['host'] = proxy_server.ip_address
+  if proxy_server.delivery_method == ProxyServer.SSH_DELIVERY:
+    invite_code_data['networkData']['user'] = ssh_distributor.SSH_USERNAME
+  else:
+    invite_code_data['networkData']['user'] = user.email
   invite_code_data['networkData']['pass'] = user.private_key
+  ssh_key_type = SSH_KEY_TYPES[user.key_type or DEFAULT_KEY_TYPE]
+  if ssh_key_type != SSH_KEY_TYPES[DEFAULT_KEY_TYPE]:
+    invite_code_data['networkData']['keyType'] = ssh_key_type
   json_data = json.dumps(invite_code_data)
   invite_code = base64.urlsafe_b64encode(json_data)
 
   return invite_code
 
 
-def _GetInviteCodeIp():
-  """Get the ip address for placing in the invite code.
+def _GetInviteCodeProxyServer():
+  """Get the proxy server whose ip address goes in the invite code.
 
   Eventually this method will actually get the load balancer's ip as we will
   want in the final version. For now, it is used as a simple stub to just pick
-  a random proxy server's ip.
+  a random live proxy server, avoiding those failing their health checks.
 
     Returns:
-      ip_address: An ip address for an invite code.
+      proxy_server: A proxy server entity for an invite code.
   """
-  proxy_servers = ProxyServer.GetAll()
+  proxy_servers = health_checker.GetHealthyProxyServers(
+      ProxyServer.GetAlive())
   index = random.randint(0, len(proxy_servers) - 1)
-  return proxy_servers[index].ip_address
+  return proxy_servers[index]
 
 
 def _RenderUserListTemplate():
@@ -105,7 +138,8 @@ def _RenderUserListTemplate():
   users = User.GetAll()
   user_payloads = _GenerateUserPayload(users)
   template_values = {
-      'user_payloads': user_payloads
+      'user_payloads': user_payloads,
+      'key_rotation_job': KeyRotationJob.GetLatest(),
   }
   template = JINJA_ENVIRONMENT.get_template('templates/user.html')
   return template.render(template_values)
@@ -143,6 +177,87 @@ def _RenderUserDetailsTemplate(user, invite_code=None):
   return template.render(template_values)
 
 
+def _ScheduleKeyPairRefill():
+  """Queue a refill of the key pair pool if it has run low.
+
+  The task is named after the current window, so taking many key pairs at
+  once only queues a single refill.
+  """
+  if not PooledKeyPair.IsLow():
+    return
+  window = int(time.time()) // KEY_PAIR_REFILL_WINDOW_SECONDS
+  task = taskqueue.Task(url=PATHS['cron_user_refill_key_pairs'],
+                        method='GET',
+                        name='refill-key-pairs-%d' % window)
+  try:
+    task.add()
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # A refill is already queued.
+    pass
+
+
+def _EnqueueKeyGeneration(url, params_list):
+  """Queue key generation tasks to run in parallel on the keygen module.
+
+  Args:
+    url: The path of the key generation task handler.
+    params_list: A list of the params for each task.
+  """
+  tasks = [taskqueue.Task(url=url, params=params) for params in params_list]
+  queue = taskqueue.Queue(KEY_GENERATION_QUEUE)
+  for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+
+
+def _EnqueueMissingKeyPairs(user_ids):
+  """Queue tasks giving key pairs to the users added without one.
+
+  Args:
+    user_ids: A list of the ids of users waiting for a key pair.
+  """
+  _EnqueueKeyGeneration(
+      PATHS['task_user_generate_key_pairs'],
+      [{'id': user_ids[start:start + KEY_PAIRS_PER_TASK]}
+       for start in range(0, len(user_ids), KEY_PAIRS_PER_TASK)])
+
+
+def _EnqueueKeyRotation(job):
+  """Queue the task rotating the next batch of a key rotation job.
+
+  The task is named after the job and batch, so a retried task never starts
+  a second chain of tasks for the same job.
+
+  Args:
+    job: The key rotation job entity.
+  """
+  task = taskqueue.Task(url=PATHS['task_user_rotate_keys'],
+                        params={'id': job.key.id()},
+                        name='rotate-keys-%d-%d' % (job.key.id(), job.batches))
+  try:
+    task.add()
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # The next batch is already queued.
+    pass
+
+
+def _EnqueueKeyBucketBuild(start):
+  """Queue the task building the next batch of key buckets.
+
+  The task is named after its batch, so the build is only ever run once.
+
+  Args:
+    start: The index of the first bucket of the batch.
+  """
+  task = taskqueue.Task(url=PATHS['task_user_build_key_buckets'],
+                        params={'start': start},
+                        name='build-key-buckets-%d' % start)
+  try:
+    task.add()
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # The batch is already queued or built.
+    pass
+
+
 class LandingPageHandler(webapp2.RequestHandler):
 
   """Display the landing page which doesn't require oauth."""
@@ -182,6 +297,8 @@ class DeleteUserHandler(webapp2.RequestHandler):
     """
     urlsafe_key = self.request.get('key')
     User.DeleteByKey(urlsafe_key)
+    key_distributor.ScheduleRevocation()
+    key_distributor.ScheduleDistribution()
     self.response.write(_RenderUserListTemplate())
 
 
@@ -194,8 +311,14 @@ class GetInviteCodeHandler(webapp2.RequestHandler):
   @admin.OAUTH_DECORATOR.oauth_required
   @admin.RequireAppOrDomainAdmin
   def get(self):
-    """Output a list of all current users along with the requested token."""
+    """Output a list of all current users along with the requested token.
+
+    A user added without a key pair is given one first.
+    """
     urlsafe_key = self.request.get('key')
+    if User.AddMissingKeyPair(urlsafe_key):
+      key_distributor.ScheduleDistribution()
+      _ScheduleKeyPairRefill()
     user = User.GetByKey(urlsafe_key)
     invite_code = _MakeInviteCode(user)
 
@@ -214,6 +337,8 @@ class GetNewKeyPairHandler(webapp2.RequestHandler):
     """Find the user matching the specified key and generate a new key pair."""
     urlsafe_key = self.request.get('key')
     User.UpdateKeyPair(urlsafe_key)
+    key_distributor.ScheduleDistribution()
+    _ScheduleKeyPairRefill()
     user = User.GetByKey(urlsafe_key)
     self.response.write(_RenderUserDetailsTemplate(user))
 
@@ -276,10 +401,52 @@ class AddUsersHandler(webapp2.RequestHandler):
       for user in users:
         decoded_user = literal_eval(user)
         users_to_add.append(decoded_user)
-    User.InsertUsers(users_to_add)
+    _EnqueueMissingKeyPairs(User.InsertUsers(users_to_add))
+    key_distributor.ScheduleDistribution()
+    _ScheduleKeyPairRefill()
+    self.redirect(PATHS['user_page_path'])
+
+
+class RotateKeysHandler(webapp2.RequestHandler):
+
+  """Start a background job giving every user with an old key a new one."""
+
+  # pylint: disable=too-few-public-methods
+
+  @admin.OAUTH_DECORATOR.oauth_required
+  @admin.RequireAppOrDomainAdmin
+  @xsrf.XSRFProtect
+  def post(self):
+    """Start rotating the keys older than max_key_age_days, or all keys."""
+    max_key_age_days = self.request.get('max_key_age_days')
+    max_key_age = None
+    if max_key_age_days:
+      try:
+        max_key_age = datetime.timedelta(days=int(max_key_age_days))
+      except ValueError:
+        self.error(400)
+        return
+    _EnqueueKeyRotation(KeyRotationJob.Start(max_key_age))
     self.redirect(PATHS['user_page_path'])
 
 
+class RotateKeysTaskHandler(webapp2.RequestHandler):
+
+  """Rotate the keys in one batch of users, then queue the next batch."""
+
+  # pylint: disable=too-few-public-methods
+
+  def post(self):
+    """Rotate the job's next batch and distribute the new keys."""
+    job = KeyRotationJob.RotateBatch(int(self.request.get('id')))
+    if job is None:
+      return
+    key_distributor.ScheduleDistribution()
+    _ScheduleKeyPairRefill()
+    if job.finished is None:
+      _EnqueueKeyRotation(job)
+
+
 class ToggleKeyRevokedHandler(webapp2.RequestHandler):
 
   """Toggle the revoked status on a user's keys in the datastore."""
@@ -293,6 +460,9 @@ class ToggleKeyRevokedHandler(webapp2.RequestHandler):
     urlsafe_key = self.request.get('key')
     User.ToggleKeyRevoked(urlsafe_key)
     user = User.GetByKey(urlsafe_key)
+    if user.is_key_revoked:
+      key_distributor.ScheduleRevocation()
+    key_distributor.ScheduleDistribution()
     self.response.write(_RenderUserDetailsTemplate(user))
 
 
@@ -311,15 +481,85 @@ class GetUserDetailsHandler(webapp2.RequestHandler):
     self.response.write(_RenderUserDetailsTemplate(user))
 
 
+class RefillKeyPairPoolHandler(webapp2.RequestHandler):
+
+  """Generate key pairs into the pool ahead of the users that will need them.
+  """
+
+  # pylint: disable=too-few-public-methods
+
+  def get(self):
+    """Split the pool's shortfall across key generation tasks."""
+    shortfall = PooledKeyPair.GetShortfall()
+    _EnqueueKeyGeneration(
+        PATHS['task_user_fill_key_pairs'],
+        [{} for _ in range(0, shortfall, KEY_PAIRS_PER_TASK)])
+
+
+class FillKeyPairPoolTaskHandler(webapp2.RequestHandler):
+
+  """Generate one task's share of a refill into the key pair pool."""
+
+  # pylint: disable=too-few-public-methods
+
+  def post(self):
+    """Add up to KEY_PAIRS_PER_TASK key pairs to the pool."""
+    PooledKeyPair.Fill(KEY_PAIRS_PER_TASK)
+
+
+class GenerateKeyPairsTaskHandler(webapp2.RequestHandler):
+
+  """Give a chunk of users added without a key pair their key pairs."""
+
+  # pylint: disable=too-few-public-methods
+
+  def post(self):
+    """Generate the users' key pairs and distribute them."""
+    if User.AddMissingKeyPairs(self.request.get_all('id')):
+      key_distributor.ScheduleDistribution()
+
+
+class BuildKeyBucketsHandler(webapp2.RequestHandler):
+
+  """Start the one-time build of the key buckets if it has not finished."""
+
+  # pylint: disable=too-few-public-methods
+
+  def get(self):
+    """Queue the first batch of the build unless the buckets are built."""
+    if not KeyBucket.AreBuilt():
+      _EnqueueKeyBucketBuild(0)
+
+
+class BuildKeyBucketsTaskHandler(webapp2.RequestHandler):
+
+  """Build one batch of key buckets, then queue the next batch."""
+
+  # pylint: disable=too-few-public-methods
+
+  def post(self):
+    """Build the batch of buckets starting at the given index."""
+    start = KeyBucket.BuildBatch(int(self.request.get('start')))
+    if start is not None:
+      _EnqueueKeyBucketBuild(start)
+
+
 APP = webapp2.WSGIApplication([
     (PATHS['landing_page_path'], LandingPageHandler),
     (PATHS['user_page_path'], ListUsersHandler),
     (PATHS['user_delete_path'], DeleteUserHandler),
     (PATHS['user_get_invite_code_path'], GetInviteCodeHandler),
     (PATHS['user_get_new_key_pair_path'], GetNewKeyPairHandler),
+    (PATHS['user_rotate_keys_path'], RotateKeysHandler),
     (PATHS['user_add_path'], AddUsersHandler),
     (PATHS['user_toggle_revoked_path'], ToggleKeyRevokedHandler),
     (PATHS['user_details_path'], GetUserDetailsHandler),
+    (PATHS['cron_user_refill_key_pairs'], RefillKeyPairPoolHandler),
+    (PATHS['task_user_fill_key_pairs'], FillKeyPairPoolTaskHandler),
+    (PATHS['task_user_generate_key_pairs'], GenerateKeyPairsTaskHandler),
+    (PATHS['task_user_rotate_keys'], RotateKeysTaskHandler),
+    (PATHS['cron_user_build_key_buckets'], BuildKeyBucketsHandler),
+    (PATHS['task_user_build_key_buckets'], BuildKeyBucketsTaskHandler),
     (admin.OAUTH_DECORATOR.callback_path,
      admin.OAUTH_DECORATOR.callback_handler()),
 ], debug=True)
@@ -5,11 +5,15 @@ import sys
 
 import base64
 from config import PATHS
+import datetime
+from datastore import KeyRotationJob
+from datastore import ProxyServer
 from datastore import User
 from googleapiclient import errors
 from google.appengine.ext import ndb
 import hashlib
 import json
+import ssh_distributor
 
 import unittest
 import webtest
@@ -78,33 +82,64 @@ class UserTest(unittest.TestCase):
 
   @patch('user.User.DeleteByKey')
   @patch('user._RenderUserListTemplate')
-  def testDeleteUserHandler(self, mock_user_template, mock_delete_user):
+  @patch('user.key_distributor.ScheduleRevocation')
+  @patch('user.key_distributor.ScheduleDistribution')
+  def testDeleteUserHandler(self, mock_schedule, mock_schedule_revocation,
+                            mock_user_template, mock_delete_user):
     """Test the delete handler calls to delete the user from the datastore."""
     self.testapp.get(PATHS['user_delete_path'] + '?key=' + FAKE_DS_KEY)
     mock_delete_user.assert_called_once_with(FAKE_DS_KEY)
+    mock_schedule_revocation.assert_called_once_with()
+    mock_schedule.assert_called_once_with()
     mock_user_template.assert_called_once_with()
 
+  @patch('user.User.AddMissingKeyPair')
   @patch('user.User.GetByKey')
   @patch('user._MakeInviteCode')
   @patch('user._RenderUserDetailsTemplate')
   def testGetInviteCodeHandler(self, mock_user_template, mock_make_invite_code,
-                               mock_get_user):
+                               mock_get_user, mock_add_key_pair):
     """Test the invite code handler generates an invite code for the user."""
+    mock_add_key_pair.return_value = False
     mock_get_user.return_value = FAKE_USER
     fake_invite_code = 'base64EncodedBlob'
     mock_make_invite_code.return_value = fake_invite_code
 
     self.testapp.get(PATHS['user_get_invite_code_path'] + '?key=' + FAKE_DS_KEY)
 
+    mock_add_key_pair.assert_called_once_with(FAKE_DS_KEY)
     mock_get_user.assert_called_once_with(FAKE_DS_KEY)
     mock_make_invite_code.assert_called_once_with(FAKE_USER)
     mock_user_template.assert_called_once_with(FAKE_USER, fake_invite_code)
 
+  @patch('user._ScheduleKeyPairRefill')
+  @patch('user.key_distributor.ScheduleDistribution')
+  @patch('user.User.AddMissingKeyPair')
+  @patch('user.User.GetByKey')
+  @patch('user._MakeInviteCode')
+  @patch('user._RenderUserDetailsTemplate')
+  def testGetInviteCodeHandlerAddsKeyPair(self, mock_user_template,
+                                          mock_make_invite_code, mock_get_user,
+                                          mock_add_key_pair, mock_schedule,
+                                          mock_refill):
+    """Test a user's first key pair is distributed with their invite code."""
+    mock_add_key_pair.return_value = True
+    mock_get_user.return_value = FAKE_USER
+    mock_make_invite_code.return_value = 'base64EncodedBlob'
+
+    self.testapp.get(PATHS['user_get_invite_code_path'] + '?key=' + FAKE_DS_KEY)
+
+    mock_schedule.assert_called_once_with()
+    mock_refill.assert_called_once_with()
+    mock_make_invite_code.assert_called_once_with(FAKE_USER)
+
   @patch('user._RenderUserDetailsTemplate')
   @patch('user.User.GetByKey')
   @patch('user.User.UpdateKeyPair')
-  def testGetNewKeyPairHandler(self, mock_update, mock_get_by_key,
-                               mock_render_details):
+  @patch('user.key_distributor.ScheduleDistribution')
+  @patch('user._ScheduleKeyPairRefill')
+  def testGetNewKeyPairHandler(self, mock_refill, mock_schedule, mock_update,
+                               mock_get_by_key, mock_render_details):
     """Test the key pair handler calls to set a new key pair for the user."""
     mock_get_by_key.return_value = FAKE_USER
 
@@ -112,6 +147,8 @@ class UserTest(unittest.TestCase):
         PATHS['user_get_new_key_pair_path'] + '?key=' + FAKE_DS_KEY)
 
     mock_update.assert_called_once_with(FAKE_DS_KEY)
+    mock_schedule.assert_called_once_with()
+    mock_refill.assert_called_once_with()
     mock_get_by_key.assert_called_once_with(FAKE_DS_KEY)
     mock_render_details.assert_called_once_with(FAKE_USER)
 
@@ -241,8 +278,12 @@ class UserTest(unittest.TestCase):
     mock_watch_users.assert_not_called()
     mock_render.assert_called_once_with([], fake_error)
 
+  @patch('user._EnqueueMissingKeyPairs')
   @patch('user.User.InsertUsers')
-  def testAddUsersPostHandler(self, mock_insert):
+  @patch('user.key_distributor.ScheduleDistribution')
+  @patch('user._ScheduleKeyPairRefill')
+  def testAddUsersPostHandler(self, mock_refill, mock_schedule,
+                               mock_insert, mock_enqueue):
     """Test the add users post handler calls to insert the specified users."""
     user_1 = {}
     user_1['primaryEmail'] = FAKE_EMAIL_1
@@ -255,15 +296,22 @@ class UserTest(unittest.TestCase):
     user_array = []
     user_array.append(user_1)
     user_array.append(user_2)
+    mock_insert.return_value = ['missing_id']
     data = '?selected_user={0}&selected_user={1}'.format(user_1, user_2)
     response = self.testapp.post(PATHS['user_add_path'] + data)
 
     mock_insert.assert_called_once_with(user_array)
+    mock_enqueue.assert_called_once_with(['missing_id'])
+    mock_schedule.assert_called_once_with()
+    mock_refill.assert_called_once_with()
     self.assertEqual(response.status_int, 302)
     self.assertTrue(PATHS['user_page_path'] in response.location)
 
   @patch('user.User.InsertUsers')
-  def testAddUsersPostManualHandler(self, mock_insert):
+  @patch('user.key_distributor.ScheduleDistribution')
+  @patch('user._ScheduleKeyPairRefill')
+  def testAddUsersPostManualHandler(self, mock_refill, mock_schedule,
+                                     mock_insert):
     """Test add users manually calls to insert the specified user."""
     user_1 = {}
     user_1['primaryEmail'] = FAKE_EMAIL
@@ -276,13 +324,19 @@ class UserTest(unittest.TestCase):
     response = self.testapp.post(PATHS['user_add_path'] + data)
 
     mock_insert.assert_called_once_with(user_array)
+    mock_schedule.assert_called_once_with()
+    mock_refill.assert_called_once_with()
     self.assertEqual(response.status_int, 302)
     self.assertTrue(PATHS['user_page_path'] in response.location)
 
   @patch('user._RenderUserDetailsTemplate')
   @patch('user.User.GetByKey')
   @patch('user.User.ToggleKeyRevoked')
-  def testToggleKeyRevokedHandler(self, mock_toggle_key_revoked,
+  @patch('user.key_distributor.ScheduleRevocation')
+  @patch('user.key_distributor.ScheduleDistribution')
+  def testToggleKeyRevokedHandler(self, mock_schedule,
+                                  mock_schedule_revocation,
+                                  mock_toggle_key_revoked,
                                   mock_get_by_key, mock_render_details):
     """Test the toggle revoked handler toggles a user's status in datastore."""
     mock_get_by_key.return_value = FAKE_USER
@@ -290,9 +344,33 @@ class UserTest(unittest.TestCase):
     self.testapp.get(PATHS['user_toggle_revoked_path'] + '?key=' + FAKE_DS_KEY)
 
     mock_toggle_key_revoked.assert_called_once_with(FAKE_DS_KEY)
+    mock_schedule_revocation.assert_not_called()
+    mock_schedule.assert_called_once_with()
     mock_get_by_key.assert_called_once_with(FAKE_DS_KEY)
     mock_render_details.assert_called_once_with(FAKE_USER)
 
+  @patch('user._RenderUserDetailsTemplate')
+  @patch('user.User.GetByKey')
+  @patch('user.User.ToggleKeyRevoked')
+  @patch('user.key_distributor.ScheduleRevocation')
+  @patch('user.key_distributor.ScheduleDistribution')
+  def testToggleKeyRevokedHandlerRevokes(self, mock_schedule,
+                                         mock_schedule_revocation,
+                                         mock_toggle_key_revoked,
+                                         mock_get_by_key, mock_render_details):
+    """Test revoking a user's key sends out the revocation first."""
+    revoked_user = User(key=FAKE_USER_KEY, email=FAKE_EMAIL,
+                        public_key=FAKE_PUBLIC_KEY,
+                        private_key=FAKE_PRIVATE_KEY, is_key_revoked=True)
+    mock_get_by_key.return_value = revoked_user
+
+    self.testapp.get(PATHS['user_toggle_revoked_path'] + '?key=' + FAKE_DS_KEY)
+
+    mock_toggle_key_revoked.assert_called_once_with(FAKE_DS_KEY)
+    mock_schedule_revocation.assert_called_once_with()
+    mock_schedule.assert_called_once_with()
+    mock_render_details.assert_called_once_with(revoked_user)
+
   @patch('user._RenderUserDetailsTemplate')
   @patch('user.User.GetByKey')
   def testGetUserDetailsHandler(self, mock_get_by_key, mock_render_details):
@@ -304,13 +382,16 @@ class UserTest(unittest.TestCase):
     mock_get_by_key.assert_called_once_with(FAKE_DS_KEY)
     mock_render_details.assert_called_once_with(FAKE_USER)
 
+  @patch('user.KeyRotationJob.GetLatest')
   @patch('user._GenerateUserPayload')
   @patch('user.User.GetAll')
-  def testRenderUserListTemplate(self, mock_get_all, mock_generate):
+  def testRenderUserListTemplate(self, mock_get_all, mock_generate,
+                                 mock_get_latest):
     """Test the user list is rendered as in the html."""
     # Disabling the protected access check here intentionally so we can test a
     # private method.
     # pylint: disable=protected-access
+    mock_get_latest.return_value = None
     fake_users = [FAKE_USER]
     mock_get_all.return_value = fake_users
     fake_dictionary = {}
@@ -327,6 +408,24 @@ class UserTest(unittest.TestCase):
     self.assertEquals(FAKE_USER.email in user_list_template, True)
     details_link = ('user/details?key=' + FAKE_DS_KEY)
     self.assertEquals(details_link in user_list_template, True)
+    self.assertEquals(PATHS['user_rotate_keys_path'] in user_list_template,
+                      True)
+    self.assertEquals('Last rotation' in user_list_template, False)
+
+  @patch('user.KeyRotationJob.GetLatest')
+  @patch('user.User.GetAll')
+  def testRenderUserListTemplateKeyRotation(self, mock_get_all,
+                                            mock_get_latest):
+    """Test the progress of the last key rotation is shown."""
+    # pylint: disable=protected-access
+    mock_get_all.return_value = []
+    mock_get_latest.return_value = KeyRotationJob(
+        started=datetime.datetime(2016, 1, 1), rotated=42)
+
+    user_list_template = user._RenderUserListTemplate()
+
+    self.assertTrue('42 keys rotated' in user_list_template)
+    self.assertTrue('in progress' in user_list_template)
 
   @patch('datastore.DomainVerification.GetOrInsertDefault')
   def testRenderLandingTemplate(self, mock_domain_verif):
@@ -431,20 +530,20 @@ class UserTest(unittest.TestCase):
     self.assertTrue(FAKE_USER.private_key not in user_payloads)
     self.assertTrue(FAKE_USER.private_key not in user_payloads[FAKE_DS_KEY])
 
-  @patch('user._GetInviteCodeIp')
-  def testMakeInviteCode(self, mock_get_ip):
+  @patch('user._GetInviteCodeProxyServer')
+  def testMakeInviteCode(self, mock_get_proxy_server):
     """Test that making an invite code follows the proper format."""
     # Disabling the protected access check here intentionally so we can test a
     # private method.
     # pylint: disable=protected-access
     fake_ip = '0.0.0.0'
-    mock_get_ip.return_value = fake_ip
+    mock_get_proxy_server.return_value = ProxyServer(ip_address=fake_ip)
 
     invite_code = user._MakeInviteCode(FAKE_USER)
     json_string = base64.urlsafe_b64decode(invite_code)
     invite_code_data = json.loads(json_string)
 
-    mock_get_ip.assert_called_once_with()
+    mock_get_proxy_server.assert_called_once_with()
     self.assertEqual('Cloud',
                      invite_code_data['networkName'])
     self.assertEqual(FAKE_USER.email,
@@ -453,10 +552,39 @@ class UserTest(unittest.TestCase):
                      invite_code_data['networkData']['pass'])
     self.assertEqual(fake_ip,
                      invite_code_data['networkData']['host'])
+    self.assertFalse('keyType' in invite_code_data['networkData'])
+
+  @patch('user._GetInviteCodeProxyServer')
+  def testMakeInviteCodeSshDelivery(self, mock_get_proxy_server):
+    """Test a proxy server taking keys over ssh is logged in to as its account.
+    """
+    # pylint: disable=protected-access
+    mock_get_proxy_server.return_value = ProxyServer(
+        ip_address='0.0.0.0', delivery_method=ProxyServer.SSH_DELIVERY)
+
+    invite_code = user._MakeInviteCode(FAKE_USER)
+
+    invite_code_data = json.loads(base64.urlsafe_b64decode(invite_code))
+    self.assertEqual(invite_code_data['networkData']['user'],
+                     ssh_distributor.SSH_USERNAME)
 
-  @patch('user.ProxyServer.GetAll')
-  def testGetInviteCodeIp(self, mock_get_all_proxies):
-    """Test that an invite code IP belongs to some proxy server."""
+  @patch('user._GetInviteCodeProxyServer')
+  def testMakeInviteCodeKeyType(self, mock_get_proxy_server):
+    """Test an invite code says which type of key it carries if not rsa."""
+    # pylint: disable=protected-access
+    mock_get_proxy_server.return_value = ProxyServer(ip_address='0.0.0.0')
+    ed25519_user = User(email=FAKE_EMAIL, private_key=FAKE_PRIVATE_KEY,
+                        key_type='ed25519')
+
+    invite_code = user._MakeInviteCode(ed25519_user)
+
+    invite_code_data = json.loads(base64.urlsafe_b64decode(invite_code))
+    self.assertEqual(invite_code_data['networkData']['keyType'],
+                     'ssh-ed25519')
+
+  @patch('user.ProxyServer.GetAlive')
+  def testGetInviteCodeProxyServer(self, mock_get_all_proxies):
+    """Test that an invite code IP belongs to some live proxy server."""
     # Disabling the protected access check here intentionally so we can test a
     # private method.
     # pylint: disable=protected-access
@@ -467,9 +595,188 @@ class UserTest(unittest.TestCase):
     mock_get_all_proxies.return_value = [fake_proxy_1, fake_proxy_2]
     fake_ip_list = [fake_ip_1, fake_ip_2]
 
-    invite_code_ip = user._GetInviteCodeIp()
+    invite_code_ip = user._GetInviteCodeProxyServer().ip_address
 
     self.assertTrue(invite_code_ip in fake_ip_list)
 
+  @patch('user.ProxyServer.GetAlive')
+  def testGetInviteCodeProxyServerAvoidsUnhealthy(self, mock_get_alive):
+    """Test an invite code never points at a failing proxy server."""
+    # Disabling the protected access check here intentionally so we can test a
+    # private method.
+    # pylint: disable=protected-access
+    healthy = ProxyServer(ip_address='1.2.3.4', health_error_rate=0.0)
+    failing = ProxyServer(ip_address='0.0.0.0', health_error_rate=1.0)
+    mock_get_alive.return_value = [healthy, failing]
+
+    for _ in range(10):
+      self.assertEqual(user._GetInviteCodeProxyServer(), healthy)
+
+  @patch('user.taskqueue.Task')
+  @patch('user.PooledKeyPair.IsLow')
+  def testScheduleKeyPairRefill(self, mock_is_low, mock_task):
+    """Test a refill is only queued once the pool runs low."""
+    # pylint: disable=protected-access
+    mock_is_low.return_value = False
+
+    user._ScheduleKeyPairRefill()
+
+    mock_task.assert_not_called()
+
+    mock_is_low.return_value = True
+    mock_task.return_value.add.side_effect = (
+        user.taskqueue.TaskAlreadyExistsError)
+
+    user._ScheduleKeyPairRefill()
+
+    self.assertEqual(mock_task.call_args[1]['url'],
+                     PATHS['cron_user_refill_key_pairs'])
+    mock_task.return_value.add.assert_called_once_with()
+
+  @patch('user._EnqueueKeyGeneration')
+  @patch('user.PooledKeyPair.GetShortfall')
+  def testRefillKeyPairPoolHandler(self, mock_shortfall, mock_enqueue):
+    """Test a refill is split across parallel key generation tasks."""
+    mock_shortfall.return_value = 2 * user.KEY_PAIRS_PER_TASK + 1
+
+    self.testapp.get(PATHS['cron_user_refill_key_pairs'])
+
+    mock_enqueue.assert_called_once_with(PATHS['task_user_fill_key_pairs'],
+                                         [{}, {}, {}])
+
+    mock_enqueue.reset_mock()
+    mock_shortfall.return_value = 0
+
+    self.testapp.get(PATHS['cron_user_refill_key_pairs'])
+
+    mock_enqueue.assert_called_once_with(PATHS['task_user_fill_key_pairs'],
+                                         [])
+
+  @patch('user.PooledKeyPair.Fill')
+  def testFillKeyPairPoolTaskHandler(self, mock_fill):
+    """Test each refill task adds its share of key pairs to the pool."""
+    self.testapp.post(PATHS['task_user_fill_key_pairs'])
+
+    mock_fill.assert_called_once_with(user.KEY_PAIRS_PER_TASK)
+
+  @patch('user.taskqueue.Queue')
+  def testEnqueueMissingKeyPairs(self, mock_queue):
+    """Test users waiting for key pairs are split into keygen tasks."""
+    # pylint: disable=protected-access
+    user_ids = ['user%d' % index
+                for index in range(user.KEY_PAIRS_PER_TASK + 1)]
+
+    user._EnqueueMissingKeyPairs(user_ids)
+
+    mock_queue.assert_called_once_with(user.KEY_GENERATION_QUEUE)
+    tasks = mock_queue.return_value.add.call_args[0][0]
+    self.assertEqual(len(tasks), 2)
+    self.assertEqual(tasks[0].url, PATHS['task_user_generate_key_pairs'])
+    self.assertEqual(tasks[0].payload.count('id='), user.KEY_PAIRS_PER_TASK)
+    self.assertEqual(tasks[1].payload, 'id=user%d' % user.KEY_PAIRS_PER_TASK)
+
+  @patch('user.key_distributor.ScheduleDistribution')
+  @patch('user.User.AddMissingKeyPairs')
+  def testGenerateKeyPairsTaskHandler(self, mock_add, mock_schedule):
+    """Test a keygen task keys its users and distributes any it keyed."""
+    mock_add.return_value = 2
+
+    self.testapp.post(PATHS['task_user_generate_key_pairs'] +
+                      '?id=a&id=b')
+
+    mock_add.assert_called_once_with(['a', 'b'])
+    mock_schedule.assert_called_once_with()
+
+    mock_schedule.reset_mock()
+    mock_add.return_value = 0
+
+    self.testapp.post(PATHS['task_user_generate_key_pairs'] + '?id=a')
+
+    mock_schedule.assert_not_called()
+
+  @patch('user._EnqueueKeyBucketBuild')
+  @patch('user.KeyBucket.AreBuilt')
+  def testBuildKeyBucketsHandler(self, mock_are_built, mock_enqueue):
+    """Test the build is only started while the buckets are not built."""
+    mock_are_built.return_value = False
+
+    self.testapp.get(PATHS['cron_user_build_key_buckets'])
+
+    mock_enqueue.assert_called_once_with(0)
+
+    mock_enqueue.reset_mock()
+    mock_are_built.return_value = True
+
+    self.testapp.get(PATHS['cron_user_build_key_buckets'])
+
+    mock_enqueue.assert_not_called()
+
+  @patch('user._EnqueueKeyBucketBuild')
+  @patch('user.KeyBucket.BuildBatch')
+  def testBuildKeyBucketsTaskHandler(self, mock_build, mock_enqueue):
+    """Test each batch of the build queues the next until the last."""
+    mock_build.return_value = 32
+
+    self.testapp.post(PATHS['task_user_build_key_buckets'], {'start': '16'})
+
+    mock_build.assert_called_once_with(16)
+    mock_enqueue.assert_called_once_with(32)
+
+    mock_enqueue.reset_mock()
+    mock_build.return_value = None
+
+    self.testapp.post(PATHS['task_user_build_key_buckets'], {'start': '240'})
+
+    mock_enqueue.assert_not_called()
+
+  @patch('user._EnqueueKeyRotation')
+  @patch('user.KeyRotationJob.Start')
+  def testRotateKeysHandler(self, mock_start, mock_enqueue):
+    """Test a key rotation job is started for keys over the given age."""
+    fake_job = MagicMock()
+    mock_start.return_value = fake_job
+
+    response = self.testapp.post(PATHS['user_rotate_keys_path'],
+                                 {'max_key_age_days': '90'})
+
+    mock_start.assert_called_once_with(datetime.timedelta(days=90))
+    mock_enqueue.assert_called_once_with(fake_job)
+    self.assertEqual(response.status_int, 302)
+
+    mock_start.reset_mock()
+    self.testapp.post(PATHS['user_rotate_keys_path'])
+
+    mock_start.assert_called_once_with(None)
+
+    response = self.testapp.post(PATHS['user_rotate_keys_path'],
+                                 {'max_key_age_days': 'soon'},
+                                 expect_errors=True)
+
+    self.assertEqual(response.status_int, 400)
+
+  @patch('user._ScheduleKeyPairRefill')
+  @patch('user.key_distributor.ScheduleDistribution')
+  @patch('user._EnqueueKeyRotation')
+  @patch('user.KeyRotationJob.RotateBatch')
+  def testRotateKeysTaskHandler(self, mock_rotate, mock_enqueue,
+                                mock_schedule, mock_refill):
+    """Test each batch queues the next until the job is finished."""
+    fake_job = MagicMock(finished=None)
+    mock_rotate.return_value = fake_job
+
+    self.testapp.post(PATHS['task_user_rotate_keys'], {'id': '7'})
+
+    mock_rotate.assert_called_once_with(7)
+    mock_schedule.assert_called_once_with()
+    mock_refill.assert_called_once_with()
+    mock_enqueue.assert_called_once_with(fake_job)
+
+    mock_enqueue.reset_mock()
+    fake_job.finished = datetime.datetime(2016, 1, 1)
+
+    self.testapp.post(PATHS['task_user_rotate_keys'], {'id': '7'})
+
+    mock_enqueue.assert_not_called()
+
 if __name__ == '__main__':
   unittest.main()